@@ -1,48 +1,75 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
-from models import db, Quote
-from forms import QuoteForm
-from datetime import datetime
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, Response, stream_with_context
+from models import db, Quote, QuoteLineItem, PhotoUpload, Job, SERVICES, SERVICE_NAMES
+from forms import QuoteForm, BASE_FIELDS, QUOTE_FIELDS, validate_fields
+from flask_wtf.csrf import validate_csrf
+from wtforms.validators import ValidationError
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, or_, and_
+from sqlalchemy.exc import IntegrityError
+import io
+from concurrent.futures.process import BrokenProcessPool
 import os
-from io import BytesIO
+import re
+import click
+from functools import lru_cache
 from uuid import uuid4
 from werkzeug.utils import secure_filename
-from azure.storage.blob import BlobServiceClient
-from PIL import Image
-import pillow_heif
 from dotenv import load_dotenv
 load_dotenv()
 import requests
 import secrets
 import base64
 from urllib.parse import urlencode
-from token_manager import save_tokens, get_access_token, is_token_valid, clear_tokens
-from xero_service import send_quote_to_xero
-
-
-# Register HEIF opener with Pillow
-pillow_heif.register_heif_opener()
+from token_manager import save_tokens, get_access_token, is_token_valid, clear_tokens, start_background_refresher
+from jobs import enqueue_job, latest_job, pending_job, work
+from xero_service import sync_changed_quotes, XERO_BATCH_SIZE
+import xero_client
+import blob_storage
+import image_pipeline
+from search import apply_text_filters, search_quotes, rebuild_search_index
+from export import export_query, iter_export, EXPORT_FORMATS
+from quote_import import import_quotes, IMPORT_BATCH_SIZE
+import quote_pdf
+import assets
+import metrics
+from page_cache import cached_page, invalidate_quote, quotes_version
+from reporting import revenue_report, rebuild_rollups, parse_report_args, PERIODS
+from migrations import upgrade, pending_migrations
+from sqlite_config import sqlite_engine_options, init_sqlite
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here-change-in-production'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///quotes.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///quotes.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Azure Blob Storage configuration (set via environment variables)
-AZURE_CONNECTION_STRING = os.environ.get('AZURE_CONNECTION_STRING', '')
-AZURE_CONTAINER = os.environ.get('AZURE_CONTAINER', 'pictures')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = sqlite_engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+# Caps every request body, including chunked ones that send no Content-Length;
+# the slack is for the multipart envelope around an upload
+app.config['MAX_CONTENT_LENGTH'] = blob_storage.UPLOAD_MAX_BYTES + 1024 * 1024
 
 # Xero OAuth Configuration
 XERO_CLIENT_ID = os.environ.get('XERO_CLIENT_ID')
 XERO_CLIENT_SECRET = os.environ.get('XERO_CLIENT_SECRET')
 XERO_REDIRECT_URI = os.environ.get('XERO_REDIRECT_URI')
 XERO_TENANT_ID = os.environ.get('XERO_TENANT_ID')
-XERO_AUTH_URL = 'https://login.xero.com/identity/connect/authorize'
-XERO_TOKEN_URL = 'https://identity.xero.com/connect/token'
-XERO_API_BASE = 'https://api.xero.com/api.xro/2.0'
 
 db.init_app(app)
+init_sqlite(app, db)
+quote_pdf.init_app(app)
+assets.init_app(app)
+metrics.init_app(app)
+
+# Renew the Xero access token in the background before it expires. Started
+# by the first request each web worker serves, so CLI commands never start
+# it and workers forked by gunicorn --preload each get their own thread.
+if os.environ.get('XERO_BACKGROUND_REFRESH', '1') == '1':
+    app.before_request(start_background_refresher)
 
 # Custom Jinja2 filter to get form field by name
+@app.template_filter('rendition')
+def rendition(photo_link, size, ext):
+    """URL of a photo's preview rendition (see blob_storage.rendition_name)"""
+    return blob_storage.rendition_name(photo_link, size, ext)
+
 @app.template_filter('get_field')
 def get_field(form, field_name):
     """Get a form field by name"""
@@ -54,37 +81,32 @@ def inject_xero_status():
     """Make Xero connection status available in all templates."""
     return dict(is_xero_connected=is_token_valid)
 
-# Service names for iteration
-SERVICES = [
-    ('headlights_resurfacing', 'Headlights Re-surfacing'),
-    ('headlights_ceramic', 'Headlights Ceramic Coating'),
-    ('trim_ceramic', 'Trim Ceramic Coating'),
-    ('car_wizard_diy', 'Car Wizard DIY Kit'),
-    ('carspa_sealant', 'Car Spa (Sealant)'),
-    ('carspa_ceramic', 'Car Spa (Plus Ceramic)'),
-    ('mechanical', 'Mechanical'),
-    ('glass', 'Glass'),
-    ('tint', 'Tint'),
-    ('misc', 'Misc'),
-]
+@app.context_processor
+def inject_upload_types():
+    """Let the upload script route files by the same type tables as the server."""
+    return dict(upload_types=sorted(blob_storage.UPLOAD_TYPES),
+                direct_upload_types=sorted(DIRECT_UPLOAD_TYPES),
+                converted_upload_types=sorted(CONVERTED_UPLOAD_TYPES))
 
-@app.route('/')
-def index():
-    """List all quotes with search/filter functionality"""
-    search_invoice_number = request.args.get('invoice_number', '')
-    search_vehicle = request.args.get('vehicle', '')
-    search_stock_number = request.args.get('stock_number', '')
-    search_date_from = request.args.get('date_from', '')
-    search_date_to = request.args.get('date_to', '')
+# Quote listing pagination
+QUOTES_PER_PAGE = 50
+MAX_QUOTES_PER_PAGE = 200
 
-    query = Quote.query
+def apply_quote_filters(query, args):
+    """Apply the index search/filter query args to a Quote query"""
+    search_invoice_number = args.get('invoice_number', '')
+    search_vehicle = args.get('vehicle', '')
+    search_stock_number = args.get('stock_number', '')
+    search_date_from = args.get('date_from', '')
+    search_date_to = args.get('date_to', '')
+    search_min_total = args.get('min_total', '')
 
-    if search_invoice_number:
-        query = query.filter(Quote.invoice_number.contains(search_invoice_number))
-    if search_vehicle:
-        query = query.filter(Quote.vehicle.contains(search_vehicle))
-    if search_stock_number:
-        query = query.filter(Quote.stock_number.contains(search_stock_number))
+    # Substring filters are answered by the full-text search index
+    query = apply_text_filters(query, {
+        'invoice_number': search_invoice_number,
+        'vehicle': search_vehicle,
+        'stock_number': search_stock_number,
+    })
     if search_date_from:
         try:
             date_from = datetime.strptime(search_date_from, '%Y-%m-%d').date()
@@ -97,15 +119,195 @@ def index():
             query = query.filter(Quote.date <= date_to)
         except ValueError:
             pass
+    if search_min_total:
+        try:
+            query = query.filter(Quote.grand_total >= float(search_min_total))
+        except ValueError:
+            pass
+
+    return query
+
+def encode_cursor(quote_date, quote_id):
+    """Encode a (date, id) keyset position as an opaque cursor string"""
+    raw = f"{quote_date.isoformat()}|{quote_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a cursor string back into (date, id). Returns None if invalid."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        date_part, id_part = raw.split('|')
+        return datetime.strptime(date_part, '%Y-%m-%d').date(), int(id_part)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+# Query args the quote listing is filtered by
+QUOTE_FILTER_ARGS = ('invoice_number', 'vehicle', 'stock_number', 'date_from', 'date_to', 'min_total')
+
+@lru_cache(maxsize=256)
+def count_quotes(version, filters):
+    """Number of quotes matching `filters`, a tuple of (arg, value) pairs.
 
-    quotes = query.order_by(Quote.date.desc()).all()
+    Cached per process by the quote list's data version, which every
+    change to a filtered column bumps, so a count is never stale.
+    """
+    query = apply_quote_filters(db.session.query(Quote.id), dict(filters))
+    return query.with_entities(func.count(Quote.id)).scalar()
+
+def get_quote_page(args):
+    """Fetch one keyset page of the quote listing.
+
+    Only the columns shown in the list are selected. Pages are ordered by
+    (date, id) descending and continue from the `cursor` arg instead of an
+    OFFSET, so every page costs the same regardless of how deep it is.
+    """
+    try:
+        per_page = int(args.get('per_page', QUOTES_PER_PAGE))
+    except ValueError:
+        per_page = QUOTES_PER_PAGE
+    per_page = max(1, min(per_page, MAX_QUOTES_PER_PAGE))
+
+    query = db.session.query(Quote.id, Quote.invoice_number, Quote.date,
+                             Quote.to_name, Quote.vehicle)
+    query = apply_quote_filters(query, args)
+
+    # Counted once per filter set and version of the quote list, not per page
+    filters = tuple((name, args.get(name, '')) for name in QUOTE_FILTER_ARGS)
+    total = count_quotes(quotes_version()[0], filters)
+
+    cursor = args.get('cursor', '')
+    position = decode_cursor(cursor) if cursor else None
+
+    if position:
+        cursor_date, cursor_id = position
+        query = query.filter(or_(
+            Quote.date < cursor_date,
+            and_(Quote.date == cursor_date, Quote.id < cursor_id),
+        ))
+
+    # Fetch one extra row to know whether another page exists
+    rows = query.order_by(Quote.date.desc(), Quote.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1].date, rows[-1].id)
+
+    return rows, next_cursor, total
+
+@app.route('/')
+def index():
+    """List quotes with search/filter functionality"""
+    version, changed_at = quotes_version()
+    return cached_page(('index', request.query_string.decode()), ('index', version),
+                       changed_at, render_index)
+
+def render_index():
+    quotes, next_cursor, total = get_quote_page(request.args)
+
+    next_url = None
+    if next_cursor:
+        next_args = request.args.to_dict()
+        next_args.pop('total', None)
+        next_args.update(cursor=next_cursor)
+        next_url = url_for('index', **next_args)
 
     return render_template('index.html', quotes=quotes,
-                         search_invoice_number=search_invoice_number,
-                         search_vehicle=search_vehicle,
-                         search_stock_number=search_stock_number,
-                         search_date_from=search_date_from,
-                         search_date_to=search_date_to)
+                         total=total,
+                         next_url=next_url,
+                         is_first_page=not request.args.get('cursor'),
+                         search_invoice_number=request.args.get('invoice_number', ''),
+                         search_vehicle=request.args.get('vehicle', ''),
+                         search_stock_number=request.args.get('stock_number', ''),
+                         search_date_from=request.args.get('date_from', ''),
+                         search_date_to=request.args.get('date_to', ''),
+                         search_min_total=request.args.get('min_total', ''))
+
+@app.route('/api/quotes')
+def quote_list_json():
+    """JSON variant of the quote listing for infinite scroll"""
+    quotes, next_cursor, total = get_quote_page(request.args)
+    return jsonify({
+        'quotes': [{
+            'id': quote.id,
+            'invoice_number': quote.invoice_number,
+            'date': quote.date.isoformat() if quote.date else None,
+            'to_name': quote.to_name,
+            'vehicle': quote.vehicle,
+            'url': url_for('quote_detail', id=quote.id),
+        } for quote in quotes],
+        'next_cursor': next_cursor,
+        'total': total,
+    })
+
+@app.route('/api/quotes/search')
+def quote_search_json():
+    """Ranked quote search across invoice, vehicle, stock number and name"""
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), MAX_QUOTES_PER_PAGE))
+    except ValueError:
+        limit = 20
+    results = search_quotes(request.args.get('q', ''), limit=limit)
+    return jsonify({
+        'quotes': [{
+            'id': row['id'],
+            'invoice_number': row['invoice_number'],
+            'date': str(row['date']) if row['date'] else None,
+            'to_name': row['to_name'],
+            'vehicle': row['vehicle'],
+            'stock_number': row['stock_number'],
+            'rank': row['rank'],
+            'url': url_for('quote_detail', id=row['id']),
+        } for row in results],
+    })
+
+@app.route('/quotes/export')
+def export_quotes():
+    """Stream every quote matching the index filters as CSV or NDJSON"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    query = apply_quote_filters(export_query(), request.args)
+    filename = f"quotes-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{export_format}"
+    return Response(stream_with_context(iter_export(query, export_format)),
+                    mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/quotes/import', methods=['GET', 'POST'])
+def import_quotes_view():
+    """Import quotes from an uploaded CSV, reporting the rows that were skipped"""
+    result = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Choose a CSV file to import.', 'error')
+            return redirect(url_for('import_quotes_view'))
+
+        # Read the upload as a stream of lines rather than all at once
+        result = import_quotes(io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''))
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify(result)
+
+    return render_template('import_quotes.html', result=result)
+
+@app.route('/reports')
+def reports():
+    """Parts and labor revenue per period and service, from the daily rollups"""
+    date_from, date_to, services, period = parse_report_args(request.args)
+    report = revenue_report(date_from, date_to, services, period)
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    return render_template('reports.html', report=report, services=SERVICES, periods=PERIODS,
+                           service_names=SERVICE_NAMES, selected_services=services, period=period,
+                           date_from=request.args.get('date_from', ''),
+                           date_to=request.args.get('date_to', ''))
+
+def apply_service_fields(quote, form):
+    """Copy each service's form fields onto the quote's line items"""
+    for service_key, _ in SERVICES:
+        form_data = {name: getattr(form, f'{service_key}_{name}').data
+                     for name in ('photo_link', 'parts_cost', 'labor_cost')}
+        quote.set_service(service_key, **form_data)
 
 @app.route('/create', methods=['GET', 'POST'])
 def create_quote():
@@ -126,19 +328,13 @@ def create_quote():
             instructions=form.instructions.data or None,
         )
         
-        # Set service fields
-        for service_key, _ in SERVICES:
-            photo_link = getattr(form, f'{service_key}_photo_link').data
-            parts_cost = getattr(form, f'{service_key}_parts_cost').data or 0
-            labor_cost = getattr(form, f'{service_key}_labor_cost').data or 0
-            
-            setattr(quote, f'{service_key}_photo_link', photo_link or None)
-            setattr(quote, f'{service_key}_parts_cost', parts_cost)
-            setattr(quote, f'{service_key}_labor_cost', labor_cost)
-        
+        # Set service line items
+        apply_service_fields(quote, form)
+
         try:
             db.session.add(quote)
             db.session.commit()
+            invalidate_quote(quote.id)
             flash('Quote created successfully!', 'success')
             return redirect(url_for('quote_detail', id=quote.id))
         except Exception as e:
@@ -150,8 +346,34 @@ def create_quote():
 @app.route('/quote/<int:id>', methods=['GET', 'POST'])
 def quote_detail(id):
     """View and edit a single quote"""
+    if request.method == 'GET':
+        parts, last_modified = quote_page_version(id, with_xero_job=True)
+        return cached_page(('quote', id, 'detail'), parts, last_modified, lambda: edit_quote(id))
+    return edit_quote(id)
+
+def quote_page_version(id, with_xero_job=False):
+    """The data versions a quote page depends on, and when they last changed.
+
+    Only a handful of columns are read; a missing quote is a 404.
+    """
+    row = db.session.query(Quote.version, Quote.updated_at, Quote.xero_synced_at).filter(
+        Quote.id == id).first()
+    if row is None:
+        abort(404)
+    parts = [id, row.version, row.updated_at]
+    changed = [row.updated_at, row.xero_synced_at]
+    if with_xero_job:
+        # The Xero panel shows the latest send job's progress
+        job = db.session.query(Job.id, Job.status, Job.updated_at).filter(
+            Job.quote_id == id, Job.kind == 'send_quote_to_xero').order_by(Job.id.desc()).first()
+        parts.append(tuple(job) if job else None)
+        changed.append(job.updated_at if job else None)
+    return tuple(parts), max((c for c in changed if c), default=None)
+
+def edit_quote(id):
+    """Render the quote form, saving it first if it was submitted"""
     quote = Quote.query.get_or_404(id)
-    form = QuoteForm(obj=quote)
+    form = QuoteForm(obj=quote, data=quote.service_form_data())
     
     if form.validate_on_submit():
         quote.invoice_number = form.invoice_number.data
@@ -165,24 +387,70 @@ def quote_detail(id):
         quote.vehicle = form.vehicle.data or None
         quote.instructions = form.instructions.data or None
 
-        # Update service fields
-        for service_key, _ in SERVICES:
-            photo_link = getattr(form, f'{service_key}_photo_link').data
-            parts_cost = getattr(form, f'{service_key}_parts_cost').data or 0
-            labor_cost = getattr(form, f'{service_key}_labor_cost').data or 0
-            
-            setattr(quote, f'{service_key}_photo_link', photo_link or None)
-            setattr(quote, f'{service_key}_parts_cost', parts_cost)
-            setattr(quote, f'{service_key}_labor_cost', labor_cost)
-        
+        # Update service line items
+        apply_service_fields(quote, form)
+
         try:
             db.session.commit()
+            invalidate_quote(quote.id)
             flash('Quote updated successfully!', 'success')
         except Exception as e:
             db.session.rollback()
             flash(f'Error updating quote: {str(e)}', 'error')
     
-    return render_template('quote_detail.html', quote=quote, form=form, services=SERVICES)
+    return render_template('quote_detail.html', quote=quote, form=form, services=SERVICES,
+                           xero_job=latest_job(quote.id, 'send_quote_to_xero'))
+
+@app.route('/api/quotes/<int:id>', methods=['PATCH'])
+def patch_quote(id):
+    """Save just the quote fields sent as JSON, for autosave on the detail page.
+
+    Only the given fields are validated and written; the response carries
+    the recomputed service and grand totals.
+    """
+    # Checked like the forms check theirs, so WTF_CSRF_ENABLED applies here too
+    if app.config.get('WTF_CSRF_ENABLED', True):
+        try:
+            validate_csrf(request.headers.get('X-CSRFToken'))
+        except ValidationError as e:
+            return jsonify({'error': str(e)}), 400
+
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict) or not changes:
+        return jsonify({'error': 'Expected a JSON object of fields to update'}), 400
+    unknown = sorted(set(changes) - set(QUOTE_FIELDS))
+    if unknown:
+        return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    quote = Quote.query.get_or_404(id)
+    values = {name: '' if value is None else str(value).strip() for name, value in changes.items()}
+    data, errors = validate_fields(QuoteForm(formdata=None, meta={'csrf': False}), values)
+    if errors:
+        return jsonify({'errors': errors}), 422
+
+    # Unchanged attributes are left out of the UPDATE, so only dirty columns are written
+    for name in BASE_FIELDS:
+        if name in data:
+            setattr(quote, name, data[name] or None)
+    current = quote.service_form_data()
+    for service_key, _ in SERVICES:
+        names = [f'{service_key}_{field}' for field in ('photo_link', 'parts_cost', 'labor_cost')]
+        if any(name in data for name in names):
+            quote.set_service(service_key, *[data.get(name, current.get(name)) for name in names])
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'errors': {'invoice_number': ['Another quote already has this invoice number.']}}), 409
+    invalidate_quote(quote.id)
+
+    return jsonify({
+        'id': quote.id,
+        'version': quote.version,
+        'service_totals': {key: float(quote.get_service_total(key)) for key, _ in SERVICES},
+        'grand_total': quote.get_grand_total(),
+    })
 
 @app.route('/quote/<int:id>/send-to-xero', methods=['POST'])
 def send_quote_to_xero_route(id):
@@ -196,22 +464,99 @@ def send_quote_to_xero_route(id):
     # Get quote
     quote = Quote.query.get_or_404(id)
 
-    # Send to Xero
-    result = send_quote_to_xero(quote)
-
-    if result['success']:
-        flash(result['message'], 'success')
+    # Queue the send; the jobs worker does the Xero round-trip
+    if pending_job(quote.id, 'send_quote_to_xero'):
+        flash('This quote is already queued to be sent to Xero.', 'success')
     else:
-        flash(f"Failed to send to Xero: {result['error']}", 'error')
+        enqueue_job('send_quote_to_xero', quote_id=quote.id)
+        db.session.commit()
+        flash('Quote queued to be sent to Xero.', 'success')
 
     # Redirect back to quote detail
     return redirect(url_for('quote_detail', id=id))
 
+@app.route('/xero/sync', methods=['POST'])
+def xero_sync():
+    """Queue a bulk sync of every new or changed quote."""
+    if not is_token_valid():
+        flash('Please connect to Xero first.', 'error')
+        return redirect(url_for('xero_authorize'))
+
+    if pending_job(None, 'xero_bulk_sync'):
+        flash('A Xero sync is already queued.', 'success')
+    else:
+        enqueue_job('xero_bulk_sync')
+        db.session.commit()
+        flash('Xero sync queued.', 'success')
+    return redirect(url_for('index'))
+
+@app.route('/quote/<int:id>/xero-status')
+def quote_xero_status(id):
+    """Status of the latest Send to Xero job for a quote"""
+    job = latest_job(id, 'send_quote_to_xero')
+    if job is None:
+        return jsonify({'status': None})
+    return jsonify({
+        'status': job.status,
+        'attempts': job.attempts,
+        'last_error': job.last_error,
+        'updated_at': job.updated_at.isoformat(),
+    })
+
 @app.route('/quote/<int:id>/print')
 def quote_print(id):
     """Print-optimized view of a quote."""
+    parts, last_modified = quote_page_version(id)
+    return cached_page(('quote', id, 'print'), parts, last_modified, lambda: render_quote_print(id))
+
+def render_quote_print(id):
+    quote = Quote.query.get_or_404(id)
+    return render_template('quote_print.html', quote=quote, service_names=dict(SERVICES))
+
+def pdf_response(pdf, filename):
+    return Response(pdf, mimetype='application/pdf',
+                    headers={'Content-Disposition': f'inline; filename={filename}'})
+
+def render_pdf(quotes, **kwargs):
+    """quote_pdf.quotes_pdf's bytes, or a 503 if the render pool times out or breaks"""
+    try:
+        pdf, _ = quote_pdf.quotes_pdf(quotes, **kwargs)
+    except TimeoutError:
+        abort(Response('Rendering the PDF took too long, please retry shortly', 503, {'Retry-After': '5'}))
+    except BrokenProcessPool:
+        abort(Response('The PDF renderer restarted, please retry', 503, {'Retry-After': '1'}))
+    return pdf
+
+@app.route('/quote/<int:id>/pdf')
+def quote_pdf_view(id):
+    """The printed quote as a PDF"""
     quote = Quote.query.get_or_404(id)
-    return render_template('quote_print.html', quote=quote, services=SERVICES)
+    pdf = render_pdf([quote], title=f'Invoice {quote.invoice_number}')
+    return pdf_response(pdf, f'invoice-{secure_filename(quote.invoice_number)}.pdf')
+
+def quotes_for_pdf(args, ids=None):
+    """Quotes matching the index filters (or the given ids) in print order.
+
+    Returns None if more than PDF_BATCH_LIMIT quotes match.
+    """
+    query = Quote.query
+    if ids:
+        query = query.filter(Quote.id.in_(ids))
+    query = apply_quote_filters(query, args)
+    quotes = query.order_by(Quote.date, Quote.id).limit(quote_pdf.PDF_BATCH_LIMIT + 1).all()
+    return quotes if len(quotes) <= quote_pdf.PDF_BATCH_LIMIT else None
+
+@app.route('/quotes/pdf')
+def quotes_pdf_view():
+    """One PDF of every quote matching the index filters, or of ?ids=1,2,3"""
+    ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip().isdigit()]
+    quotes = quotes_for_pdf(request.args, ids)
+    if quotes is None:
+        abort(400, f'More than {quote_pdf.PDF_BATCH_LIMIT} quotes match; narrow the filters.')
+    if not quotes:
+        abort(404)
+    pdf = render_pdf(quotes)
+    return pdf_response(pdf, f"quotes-{datetime.now().strftime('%Y%m%d-%H%M%S')}.pdf")
 
 @app.route('/quote/<int:id>/delete', methods=['POST'])
 def delete_quote(id):
@@ -220,16 +565,26 @@ def delete_quote(id):
     try:
         db.session.delete(quote)
         db.session.commit()
+        invalidate_quote(id)
         flash('Quote deleted successfully!', 'success')
     except Exception as e:
         db.session.rollback()
         flash(f'Error deleting quote: {str(e)}', 'error')
     return redirect(url_for('index'))
 
+@app.errorhandler(413)
+def request_too_large(e):
+    """Oversized request bodies get a JSON error the upload scripts can show"""
+    return jsonify({'error': f'Request is larger than {app.config["MAX_CONTENT_LENGTH"]} bytes'}), 413
+
 @app.route('/upload-picture', methods=['POST'])
 def upload_picture():
-    """Upload a picture to Azure Blob Storage"""
-    if not AZURE_CONNECTION_STRING:
+    """Upload a picture to Azure Blob Storage
+
+    With ?async=1 the upload runs in the background and the response is a
+    202 with a status URL to poll.
+    """
+    if not blob_storage.is_configured():
         return jsonify({'error': 'Azure storage not configured'}), 500
     
     if 'file' not in request.files:
@@ -240,39 +595,302 @@ def upload_picture():
     
     filename = secure_filename(file.filename)
     ext = os.path.splitext(filename)[1].lower()
-    blob_service_client = BlobServiceClient.from_connection_string(AZURE_CONNECTION_STRING)
-    
-    # Convert HEIC to JPG if needed
-    if ext == '.heic':
-        heif_file = pillow_heif.read_heif(file)
-        image = Image.frombytes(
-            heif_file.mode,
-            heif_file.size,
-            heif_file.data,
-            "raw",
-        )
-        output = BytesIO()
-        image.save(output, format="JPEG")
-        output.seek(0)
-        blob_name = f"{uuid4().hex}.jpg"
-        blob_client = blob_service_client.get_blob_client(container=AZURE_CONTAINER, blob=blob_name)
-        blob_client.upload_blob(output, overwrite=True, content_type="image/jpeg")
-        blob_url = f"https://{blob_service_client.account_name}.blob.core.windows.net/{AZURE_CONTAINER}/{blob_name}"
-        return jsonify({'url': blob_url})
+    if ext not in blob_storage.UPLOAD_TYPES:
+        return jsonify({'error': f'File type not allowed: {ext or "none"}'}), 415
+    if (request.content_length or 0) > blob_storage.UPLOAD_MAX_BYTES:
+        return jsonify({'error': f'File is larger than {blob_storage.UPLOAD_MAX_BYTES} bytes'}), 413
+
+    # Convert HEIC/HEIF to JPG if needed (in the image worker pool)
+    if ext in CONVERTED_UPLOAD_TYPES:
+        ext = ".jpg"
+        content_type = "image/jpeg"
+        convert = image_pipeline.to_jpeg
     else:
-        # Not HEIC, upload as-is
-        blob_name = f"{uuid4().hex}{ext}"
-        blob_client = blob_service_client.get_blob_client(container=AZURE_CONTAINER, blob=blob_name)
-        blob_client.upload_blob(file, overwrite=True)
-        blob_url = f"https://{blob_service_client.account_name}.blob.core.windows.net/{AZURE_CONTAINER}/{blob_name}"
+        content_type = blob_storage.UPLOAD_TYPES[ext]
+        convert = None
+
+    # Reject oversized images before reading them into memory
+    if convert is not None and (request.content_length or 0) > image_pipeline.IMAGE_MAX_BYTES:
+        return jsonify({'error': f'Image is larger than {image_pipeline.IMAGE_MAX_BYTES} bytes'}), 413
+
+    # Name the blob after the uploaded bytes; a repeat upload is already stored.
+    # Content-Length may be missing, so the limits are enforced while reading too.
+    max_bytes = image_pipeline.IMAGE_MAX_BYTES if convert is not None else blob_storage.UPLOAD_MAX_BYTES
+    try:
+        digest, spooled = blob_storage.spool_and_hash(file.stream, max_bytes=max_bytes)
+    except blob_storage.UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    blob_name = blob_storage.content_blob_name(digest, ext)
+    exists = blob_storage.blob_exists(blob_name)
+
+    if request.args.get('async') == '1':
+        if exists:
+            upload = PhotoUpload(blob_name=blob_name, content_type=content_type,
+                                 url=blob_storage.blob_url(blob_name), status='succeeded')
+            db.session.add(upload)
+            db.session.commit()
+        else:
+            try:
+                upload = blob_storage.start_upload(app, blob_name, spooled, content_type, convert)
+            except blob_storage.UploadQueueFull as e:
+                return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+        data = upload.to_dict()
+        data['status_url'] = url_for('upload_status', upload_id=upload.id)
+        return jsonify(data), 200 if exists else 202
+
+    if exists:
+        # Recorded so photos-gc sees the stored blob is in use again
+        db.session.add(PhotoUpload(blob_name=blob_name, content_type=content_type,
+                                   url=blob_storage.blob_url(blob_name), status='succeeded'))
+        db.session.commit()
+        return jsonify({'url': blob_storage.blob_url(blob_name), 'deduplicated': True})
+
+    if convert is None:
+        blob_url = blob_storage.upload_blob(blob_name, spooled, content_type)
+        if (content_type or '').startswith('image/'):
+            enqueue_job('photo_renditions', payload={'blob_name': blob_name})
+        db.session.commit()
         return jsonify({'url': blob_url})
 
-# Xero OAuth Helper Function
-def get_xero_auth_header():
-    """Generate Basic Auth header for token exchange."""
-    credentials = f"{XERO_CLIENT_ID}:{XERO_CLIENT_SECRET}"
-    encoded = base64.b64encode(credentials.encode()).decode()
-    return f"Basic {encoded}"
+    try:
+        data, info = convert(spooled.read())
+    except image_pipeline.ImageUndecodable as e:
+        return jsonify({'error': str(e)}), 415
+    except image_pipeline.ImageRejected as e:
+        return jsonify({'error': str(e)}), 413
+    except image_pipeline.PipelineBusy as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+    except TimeoutError:
+        return jsonify({'error': 'Converting the image took too long, please retry shortly'}), 503, {'Retry-After': '5'}
+    except BrokenProcessPool:
+        return jsonify({'error': 'The image converter restarted, please retry'}), 503, {'Retry-After': '1'}
+    blob_url = blob_storage.upload_blob(blob_name, data, content_type)
+    enqueue_job('photo_renditions', payload={'blob_name': blob_name})
+    db.session.commit()
+    return jsonify({'url': blob_url, 'processing_ms': info['total_ms']})
+
+@app.route('/upload-picture/<upload_id>')
+def upload_status(upload_id):
+    """Status of a background picture upload"""
+    upload = PhotoUpload.query.get_or_404(upload_id)
+    return jsonify(upload.to_dict())
+
+# Types /upload-picture converts to JPEG, so they always go through it
+CONVERTED_UPLOAD_TYPES = {'.heic', '.heif'}
+
+# Image types browsers may upload straight to storage. Other allowed types
+# go through /upload-picture, or /upload-chunked when they are large.
+DIRECT_UPLOAD_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+}
+
+@app.route('/upload-url', methods=['POST'])
+def upload_url():
+    """Issue a short-lived SAS URL for uploading one picture directly to storage"""
+    if not blob_storage.is_configured():
+        return jsonify({'error': 'Azure storage not configured'}), 500
+
+    data = request.get_json(silent=True) or {}
+    ext = os.path.splitext(secure_filename(data.get('filename', '')))[1].lower()
+    content_type = DIRECT_UPLOAD_TYPES.get(ext)
+    if content_type is None:
+        return jsonify({'error': f'Unsupported file type for direct upload: {ext or "none"}'}), 400
+
+    # Browsers that can hash the file send its SHA-256 so repeats are skipped.
+    # The claimed hash is only used to look up a photo the app has hashed
+    # itself; a new upload never lands under a name the client chose.
+    digest = (data.get('sha256') or '').lower()
+    if re.fullmatch(r'[0-9a-f]{64}', digest):
+        blob_name = blob_storage.content_blob_name(digest, ext)
+        if blob_storage.blob_exists(blob_name):
+            upload = PhotoUpload(blob_name=blob_name, content_type=content_type,
+                                 url=blob_storage.blob_url(blob_name), status='succeeded')
+            db.session.add(upload)
+            db.session.commit()
+            result = upload.to_dict()
+            result['finalize_url'] = url_for('finalize_upload', upload_id=upload.id)
+            return jsonify(result)
+    blob_name = f"{uuid4().hex}{ext}"
+
+    try:
+        sas_url = blob_storage.upload_sas_url(blob_name)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 501
+
+    # The browser is uploading from here on
+    upload = PhotoUpload(blob_name=blob_name, content_type=content_type,
+                         url=blob_storage.blob_url(blob_name), status='running')
+    db.session.add(upload)
+    db.session.commit()
+
+    result = upload.to_dict()
+    result['upload_url'] = sas_url
+    result['content_type'] = content_type
+    result['finalize_url'] = url_for('finalize_upload', upload_id=upload.id)
+    return jsonify(result), 201
+
+@app.route('/upload-picture/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Verify a direct upload landed in storage and record it
+
+    If quote_id and service are posted, the picture is also saved as that
+    service's photo on the quote.
+    """
+    upload = PhotoUpload.query.get_or_404(upload_id)
+    data = request.get_json(silent=True) or {}
+
+    if upload.status != 'succeeded':
+        properties = blob_storage.get_blob_properties(upload.blob_name)
+        if properties is None:
+            return jsonify({'error': 'Upload not found in storage'}), 400
+        error = None
+        if properties.content_settings.content_type != upload.content_type or not properties.size:
+            error = 'Uploaded file does not match the requested type'
+        elif properties.size > blob_storage.UPLOAD_MAX_BYTES:
+            error = f'File is larger than {blob_storage.UPLOAD_MAX_BYTES} bytes'
+        if error:
+            blob_storage.delete_blob(upload.blob_name)
+            upload.status = 'failed'
+            upload.error = error
+            db.session.commit()
+            return jsonify(upload.to_dict()), 400
+        file_under_content_hash(upload)
+        upload.status = 'succeeded'
+        enqueue_job('photo_renditions', payload={'blob_name': upload.blob_name})
+
+    record_photo_on_quote(upload, data)
+    db.session.commit()
+    return jsonify(upload.to_dict())
+
+def file_under_content_hash(upload):
+    """Move a finished direct upload to the name of its SHA-256, as hashed here
+
+    If that photo is already stored, the new copy is dropped and the upload
+    points at the existing blob.
+    """
+    digest = blob_storage.hash_blob(upload.blob_name)
+    content_name = blob_storage.content_blob_name(digest, os.path.splitext(upload.blob_name)[1])
+    if not blob_storage.blob_exists(content_name):
+        blob_storage.copy_blob(upload.blob_name, content_name)
+    blob_storage.delete_blob(upload.blob_name)
+    upload.blob_name = content_name
+    upload.url = blob_storage.blob_url(content_name)
+
+def record_photo_on_quote(upload, data):
+    """Save a finished upload as a service photo if quote_id and service were posted"""
+    quote_id = data.get('quote_id')
+    service = data.get('service')
+    if quote_id and service in SERVICE_NAMES:
+        quote = Quote.query.get_or_404(quote_id)
+        item = quote.get_line_item(service)
+        quote.set_service(service, photo_link=upload.url,
+                          parts_cost=item.parts_cost if item else 0,
+                          labor_cost=item.labor_cost if item else 0)
+
+def chunked_upload_state(upload):
+    """JSON state of a chunked upload, including the chunks already stored"""
+    data = upload.to_dict()
+    data.update({
+        'size': upload.size,
+        'chunk_size': upload.chunk_size,
+        'chunk_count': upload.chunk_count,
+        'received': blob_storage.staged_block_indexes(upload.blob_name) if upload.status == 'running' else [],
+        'chunks_url': url_for('chunked_upload_status', upload_id=upload.id),
+        'commit_url': url_for('commit_chunked_upload', upload_id=upload.id),
+    })
+    return data
+
+def get_chunked_upload(upload_id):
+    upload = PhotoUpload.query.get_or_404(upload_id)
+    if not upload.chunk_size:
+        abort(404)
+    return upload
+
+@app.route('/upload-chunked', methods=['POST'])
+def start_chunked_upload():
+    """Start a chunked, resumable upload of a large file
+
+    Takes {filename, size}. The browser then PUTs each chunk to
+    <chunks_url>/<index>, can GET chunks_url to see which chunks storage
+    already has after an interruption, and finishes with commit_url.
+    """
+    if not blob_storage.is_configured():
+        return jsonify({'error': 'Azure storage not configured'}), 500
+
+    data = request.get_json(silent=True) or {}
+    ext = os.path.splitext(secure_filename(data.get('filename', '')))[1].lower()
+    content_type = blob_storage.UPLOAD_TYPES.get(ext)
+    if content_type is None:
+        return jsonify({'error': f'File type not allowed: {ext or "none"}'}), 415
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'File size is required'}), 400
+    if size <= 0:
+        return jsonify({'error': 'File is empty'}), 400
+    if size > blob_storage.UPLOAD_MAX_BYTES:
+        return jsonify({'error': f'File is larger than {blob_storage.UPLOAD_MAX_BYTES} bytes'}), 413
+
+    blob_name = f"{uuid4().hex}{ext}"
+    upload = PhotoUpload(blob_name=blob_name, content_type=content_type,
+                         url=blob_storage.blob_url(blob_name), status='running',
+                         size=size, chunk_size=blob_storage.UPLOAD_CHUNK_SIZE)
+    db.session.add(upload)
+    db.session.commit()
+    return jsonify(chunked_upload_state(upload)), 201
+
+@app.route('/upload-chunked/<upload_id>')
+def chunked_upload_status(upload_id):
+    """State of a chunked upload, for resuming it"""
+    return jsonify(chunked_upload_state(get_chunked_upload(upload_id)))
+
+@app.route('/upload-chunked/<upload_id>/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    """Store one chunk of a chunked upload as a staged block"""
+    upload = get_chunked_upload(upload_id)
+    if upload.status != 'running':
+        return jsonify({'error': f'Upload is {upload.status}'}), 409
+    if index >= upload.chunk_count:
+        return jsonify({'error': f'Chunk {index} is out of range'}), 400
+
+    # Every chunk has an exact expected size, so at most one chunk is read into memory
+    expected = upload.chunk_length(index)
+    if request.content_length != expected:
+        return jsonify({'error': f'Chunk {index} must be {expected} bytes'}), 400
+    chunk = request.stream.read(expected)
+    if len(chunk) != expected:
+        return jsonify({'error': f'Chunk {index} was cut short'}), 400
+
+    blob_storage.stage_block(upload.blob_name, index, chunk)
+    return jsonify({'index': index})
+
+@app.route('/upload-chunked/<upload_id>/commit', methods=['POST'])
+def commit_chunked_upload(upload_id):
+    """Commit the staged chunks as the finished blob
+
+    Takes the same optional quote_id and service as a direct upload finalize.
+    """
+    upload = get_chunked_upload(upload_id)
+    data = request.get_json(silent=True) or {}
+
+    if upload.status == 'running':
+        missing = sorted(set(range(upload.chunk_count)) - set(blob_storage.staged_block_indexes(upload.blob_name)))
+        if missing:
+            return jsonify({'error': 'Chunks missing', 'missing': missing}), 409
+        blob_storage.commit_blocks(upload.blob_name, upload.chunk_count, upload.content_type)
+        upload.status = 'succeeded'
+        if upload.content_type.startswith('image/'):
+            enqueue_job('photo_renditions', payload={'blob_name': upload.blob_name})
+    elif upload.status != 'succeeded':
+        return jsonify(upload.to_dict()), 409
+
+    record_photo_on_quote(upload, data)
+    db.session.commit()
+    return jsonify(upload.to_dict())
 
 # Xero OAuth Routes
 @app.route('/auth/xero/authorize')
@@ -292,7 +910,7 @@ def xero_authorize():
         'state': state
     }
 
-    auth_url = f"{XERO_AUTH_URL}?{urlencode(params)}"
+    auth_url = f"{xero_client.XERO_AUTH_URL}?{urlencode(params)}"
     return redirect(auth_url)
 
 @app.route('/auth/xero/callback')
@@ -319,13 +937,8 @@ def xero_callback():
         'redirect_uri': XERO_REDIRECT_URI
     }
 
-    headers = {
-        'Authorization': get_xero_auth_header(),
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-
     try:
-        response = requests.post(XERO_TOKEN_URL, data=token_data, headers=headers)
+        response = xero_client.token_request(token_data)
         response.raise_for_status()
         token_response = response.json()
 
@@ -353,14 +966,8 @@ def xero_test():
         return redirect(url_for('index'))
 
     # Make API call to Xero Quotes endpoint
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'xero-tenant-id': XERO_TENANT_ID,
-        'Accept': 'application/json'
-    }
-
     try:
-        response = requests.get(f'{XERO_API_BASE}/Quotes', headers=headers)
+        response = xero_client.api_request('GET', 'Quotes', access_token, tenant_id=XERO_TENANT_ID)
         response.raise_for_status()
         quotes_data = response.json()
 
@@ -387,7 +994,189 @@ def xero_disconnect():
     flash('Disconnected from Xero.', 'success')
     return redirect(url_for('index'))
 
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Create missing tables and apply pending schema migrations."""
+    applied = upgrade()
+    for version, description in applied:
+        print(f'Applied migration {version}: {description}')
+    for version, description in pending_migrations():
+        print(f'Migration {version} waits for the next db-upgrade: {description}')
+    if not applied and not pending_migrations():
+        print('Database is up to date.')
+
+@app.cli.command('jobs-worker')
+@click.option('--once', is_flag=True, help='Exit when the queue is empty.')
+def jobs_worker_command(once):
+    """Run the background job worker."""
+    work(once=once)
+
+@app.cli.command('xero-sync')
+@click.option('--batch-size', default=XERO_BATCH_SIZE, show_default=True, help='Quotes per Quotes API call.')
+@click.option('--limit', type=int, default=None, help='Maximum number of quotes to check.')
+def xero_sync_command(batch_size, limit):
+    """Send every new or changed quote to Xero in batches."""
+    summary = sync_changed_quotes(batch_size=batch_size, limit=limit)
+    print(f"Sent {summary['sent']} quotes in {summary['batches']} batches, "
+          f"{summary['skipped']} unchanged.")
+    for quote_id, invoice_number, error in summary['failed']:
+        print(f'  Quote {quote_id} ({invoice_number}) failed: {error}')
+    if summary['error']:
+        print(f"Stopped: {summary['error']}")
+
+@app.cli.command('blob-setup')
+def blob_setup_command():
+    """Create the pictures container and the CORS rule for direct uploads."""
+    blob_storage.configure_storage()
+    print(f'Container {blob_storage.AZURE_CONTAINER} ready for direct uploads '
+          f'from {blob_storage.BLOB_CORS_ORIGINS}.')
+
+@app.cli.command('photos-backfill')
+@click.option('--force', is_flag=True, help='Re-render renditions that already exist.')
+@click.option('--limit', type=int, default=None, help='Maximum number of photos to render.')
+def photos_backfill_command(force, limit):
+    """Render preview renditions for photos already on quotes."""
+    thumb_ext = next(iter(image_pipeline.RENDITION_FORMATS))
+    thumb_size = next(iter(image_pipeline.RENDITION_SIZES))
+    links = db.session.query(QuoteLineItem.photo_link) \
+        .filter(QuoteLineItem.photo_link.isnot(None)).distinct()
+    rendered = skipped = failed = 0
+    for (link,) in links:
+        if limit is not None and rendered >= limit:
+            break
+        blob_name = blob_storage.blob_name_from_url(link)
+        if blob_name is None:
+            skipped += 1
+            continue
+        thumb = blob_storage.rendition_name(blob_name, thumb_size, thumb_ext)
+        if not force and blob_storage.get_blob_properties(thumb) is not None:
+            skipped += 1
+            continue
+        try:
+            blob_storage.store_renditions(blob_name)
+            rendered += 1
+        except Exception as e:
+            failed += 1
+            print(f'  {blob_name} failed: {e}')
+    print(f'Rendered {rendered} photos, skipped {skipped}, {failed} failed.')
+
+def photo_in_use(blob_name, since):
+    """Whether a photo blob (or the photo a rendition belongs to) is on a quote
+    now, or was uploaded or reused since `since`"""
+    stem = os.path.splitext(blob_name)[0]
+    for size in image_pipeline.RENDITION_SIZES:
+        if stem.endswith(f'_{size}'):
+            stem = stem[:-len(size) - 1]
+            break
+    on_quote = db.session.query(QuoteLineItem.id).filter(
+        QuoteLineItem.photo_link.startswith(blob_storage.blob_url(stem) + '.', autoescape=True)).first()
+    recent = db.session.query(PhotoUpload.id).filter(
+        PhotoUpload.blob_name.startswith(stem + '.', autoescape=True),
+        PhotoUpload.updated_at >= since.replace(tzinfo=None)).first()
+    return on_quote is not None or recent is not None
+
+@app.cli.command('photos-gc')
+@click.option('--delete', is_flag=True, help='Delete the blobs instead of only listing them.')
+@click.option('--min-age-hours', default=24, show_default=True,
+              help='Keep blobs newer than this, e.g. uploads not yet saved on a quote.')
+def photos_gc_command(delete, min_age_hours):
+    """Find (and optionally delete) blobs that no quote photo references."""
+    referenced = set()
+    links = db.session.query(QuoteLineItem.photo_link) \
+        .filter(QuoteLineItem.photo_link.isnot(None)).distinct()
+    for (link,) in links:
+        blob_name = blob_storage.blob_name_from_url(link)
+        if blob_name is None:
+            continue
+        referenced.add(blob_name)
+        for size in image_pipeline.RENDITION_SIZES:
+            for ext in image_pipeline.RENDITION_FORMATS:
+                referenced.add(blob_storage.rendition_name(blob_name, size, ext))
+
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=min_age_hours)
+    unreferenced = total = 0
+    for name, last_modified in blob_storage.list_blobs():
+        total += 1
+        if name in referenced or last_modified > cutoff:
+            continue
+        # Deduplicated uploads reuse a blob without rewriting it, so an old
+        # blob may have been picked up since the references were read
+        if photo_in_use(name, cutoff):
+            continue
+        unreferenced += 1
+        if delete:
+            blob_storage.delete_blob(name)
+            print(f'  deleted {name}')
+        else:
+            print(f'  unreferenced {name}')
+    action = 'Deleted' if delete else 'Found'
+    print(f'{action} {unreferenced} unreferenced blobs out of {total}.')
+
+@app.cli.command('quotes-export')
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)), default='csv', show_default=True)
+@click.option('--output', type=click.File('w'), default='-', help='File to write to (default stdout).')
+@click.option('--invoice-number', default='')
+@click.option('--vehicle', default='')
+@click.option('--stock-number', default='')
+@click.option('--date-from', default='', help='YYYY-MM-DD')
+@click.option('--date-to', default='', help='YYYY-MM-DD')
+@click.option('--min-total', default='')
+def quotes_export_command(export_format, output, **filters):
+    """Export quotes as CSV or NDJSON, with the same filters as the quote list."""
+    query = apply_quote_filters(export_query(), filters)
+    for chunk in iter_export(query, export_format):
+        output.write(chunk)
+
+@app.cli.command('quotes-import')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True, help='Rows per transaction.')
+def quotes_import_command(csv_file, batch_size):
+    """Import quotes from a CSV file, updating quotes whose invoice number exists."""
+    result = import_quotes(csv_file, batch_size=batch_size)
+    for error in result['errors']:
+        messages = '; '.join(f"{field}: {' '.join(msgs)}" for field, msgs in error['errors'].items())
+        print(f"  line {error['line']} ({error['invoice_number'] or 'no invoice number'}): {messages}")
+    print(f"Imported {result['inserted']} new and {result['updated']} existing quotes, "
+          f"skipped {result['failed']} rows.")
+
+@app.cli.command('quotes-pdf')
+@click.argument('output', type=click.File('wb'))
+@click.option('--id', 'ids', type=int, multiple=True, help='Quote id (repeatable).')
+@click.option('--date-from', default='', help='YYYY-MM-DD')
+@click.option('--date-to', default='', help='YYYY-MM-DD')
+def quotes_pdf_command(output, ids, **filters):
+    """Write one PDF of the given quotes, or of the quotes in a date range."""
+    quotes = quotes_for_pdf(filters, ids)
+    if quotes is None:
+        raise click.ClickException(f'More than {quote_pdf.PDF_BATCH_LIMIT} quotes match; narrow the filters.')
+    if not quotes:
+        raise click.ClickException('No quotes match.')
+    pdf, info = quote_pdf.quotes_pdf(quotes)
+    output.write(pdf)
+    print(f"Wrote {info['quotes']} quotes on {info['pages']} pages "
+          f"({info['rendered']} rendered, {info['cached']} from cache) in {info['total_ms']}ms.")
+
+@app.cli.command('assets-build')
+@click.option('--skip-build', is_flag=True, help='Only fingerprint and compress the existing build output.')
+def assets_build_command(skip_build):
+    """Build the CSS bundle and write hashed, precompressed copies and the manifest."""
+    manifest = assets.fingerprint() if skip_build else assets.build_assets()
+    for name, hashed in manifest.items():
+        print(f'{name} -> {hashed}')
+
+@app.cli.command('search-rebuild')
+def search_rebuild_command():
+    """Rebuild the full-text search index from the quotes table."""
+    count = rebuild_search_index()
+    print(f'Search index rebuilt for {count} quotes.')
+
+@app.cli.command('reports-rebuild')
+def reports_rebuild_command():
+    """Recompute the daily revenue rollups from the quotes table."""
+    count = rebuild_rollups()
+    print(f'Revenue rollups rebuilt: {count} day/service rows.')
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        upgrade()
     app.run(host='0.0.0.0', debug=True)                                                                                                                                                                   
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask assets-build` runs the Tailwind build (`npm run build:css`), which
+writes a purged, minified CSS bundle to static/dist. Each built file is
+then copied to a name containing a hash of its contents, with gzip and
+(when the brotli package is installed) brotli variants next to it, and
+static/dist/manifest.json maps the plain name to the hashed one.
+
+Templates link assets with `asset_url('css/app.css')`. Hashed files are
+served from /assets with a one-year immutable Cache-Control and the
+smallest precompressed variant the browser accepts. Without a manifest,
+in development with `npm run watch:css`, asset_url points at the plain
+file, which is served with no-cache.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import shlex
+import subprocess
+
+from flask import abort, request, send_file, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSETS_DIR = os.path.join(ROOT_DIR, 'static', 'dist')
+MANIFEST_PATH = os.path.join(ASSETS_DIR, 'manifest.json')
+
+# Command that writes the plain bundles into ASSETS_DIR
+ASSET_BUILD_CMD = os.environ.get('ASSET_BUILD_CMD', 'npm run build:css')
+# Bundles produced by the build, relative to ASSETS_DIR
+BUILT_ASSETS = ['css/app.css']
+
+# Hashed names never change content, so they can be cached for a year
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+# Content-Encoding and file suffix of each precompressed variant, best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+_manifest = {}
+_manifest_mtime = None
+
+
+def _hashed_name(name, data):
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+
+
+def _write(path, data):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _remove_stale(name, keep):
+    """Delete older hashed copies (and their variants) of a built asset."""
+    directory, filename = os.path.split(os.path.join(ASSETS_DIR, name))
+    stem, ext = os.path.splitext(filename)
+    pattern = re.compile(rf'{re.escape(stem)}\.[0-9a-f]{{12}}{re.escape(ext)}(\.gz|\.br)?$')
+    keep = os.path.basename(keep)
+    for existing in os.listdir(directory):
+        if pattern.match(existing) and not existing.startswith(keep):
+            os.remove(os.path.join(directory, existing))
+
+
+def fingerprint(names=BUILT_ASSETS):
+    """Copy built assets to content-hashed names with compressed variants
+    and write the manifest. Returns the manifest."""
+    manifest = {}
+    for name in names:
+        with open(os.path.join(ASSETS_DIR, name), 'rb') as f:
+            data = f.read()
+        hashed = _hashed_name(name, data)
+        path = os.path.join(ASSETS_DIR, hashed)
+
+        _write(path, data)
+        # mtime=0 keeps the gzip output identical between builds
+        _write(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write(path + '.br', brotli.compress(data, quality=11))
+        else:
+            logger.warning('brotli is not installed; only gzip variants were written')
+
+        _remove_stale(name, hashed)
+        manifest[name] = hashed
+
+    _write(MANIFEST_PATH, json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def build_assets():
+    """Run the asset build, then fingerprint and compress its output."""
+    subprocess.run(shlex.split(ASSET_BUILD_CMD), cwd=ROOT_DIR, check=True)
+    return fingerprint()
+
+
+def load_manifest():
+    """The asset manifest, re-read whenever the file changes."""
+    global _manifest, _manifest_mtime
+    try:
+        mtime = os.stat(MANIFEST_PATH).st_mtime
+    except OSError:
+        _manifest, _manifest_mtime = {}, None
+        return _manifest
+    if mtime != _manifest_mtime:
+        with open(MANIFEST_PATH) as f:
+            _manifest = json.load(f)
+        _manifest_mtime = mtime
+    return _manifest
+
+
+def asset_url(name):
+    """URL of a built asset, by its plain name, e.g. asset_url('css/app.css')."""
+    return url_for('assets', filename=load_manifest().get(name, name))
+
+
+def serve_asset(filename):
+    """Serve a built asset, precompressed when the browser allows it."""
+    path = safe_join(ASSETS_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    # Only hashed names are cached; anything else is revalidated every time
+    immutable = filename in load_manifest().values()
+    max_age = ASSET_MAX_AGE if immutable else None
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in ENCODINGS:
+        if encoding in request.accept_encodings and os.path.isfile(path + suffix):
+            response = send_file(path + suffix, mimetype=mimetype, max_age=max_age, conditional=True)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_file(path, mimetype=mimetype, max_age=max_age, conditional=True)
+
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    """Register the /assets route and the asset_url template helper."""
+    app.add_url_rule('/assets/<path:filename>', 'assets', serve_asset)
+    app.add_template_global(asset_url)
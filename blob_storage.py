@@ -0,0 +1,456 @@
+"""Shared Azure Blob Storage client and background photo uploads.
+
+One `BlobServiceClient` is created per process on first use and reused for
+every upload, with a pooled keep-alive HTTP session underneath, so photos
+don't pay for client construction and a new TLS connection each time.
+
+Uploads can also run on a small thread pool: the request records a
+`PhotoUpload` row, hands the bytes to the pool and returns at once, and the
+browser polls the row's status until the blob is in storage.
+
+Every photo also gets small WebP and JPEG renditions for previews, stored
+next to it as `<name>_<size>.<ext>` (see `rendition_name`).
+
+Photos are stored under the SHA-256 of the uploaded bytes, so uploading
+the same photo again (typically a retry) finds the existing blob and
+transfers nothing.
+
+Browsers can skip the app entirely: `upload_sas_url` issues a short-lived,
+write-only SAS URL for one blob, the browser PUTs the file straight to
+storage, and the app only verifies the finished blob. Those uploads land
+under a random name and are filed under their content hash at finalize,
+once the app has hashed what actually arrived. Direct uploads need a
+CORS rule on the storage account (`flask --app app blob-setup`).
+
+Large files use a chunked protocol instead: each chunk is staged as a block
+of a block blob and the blocks are committed once all have arrived, so a
+worker holds at most one chunk in memory and an interrupted upload can
+resume from the chunks storage already has.
+
+For local testing run Azurite and set
+AZURE_CONNECTION_STRING=UseDevelopmentStorage=true.
+"""
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import (
+    BlobBlock, BlobSasPermissions, BlobServiceClient, ContentSettings, CorsRule, generate_blob_sas,
+)
+
+import image_pipeline
+import metrics
+from models import db, PhotoUpload
+
+logger = logging.getLogger(__name__)
+
+AZURE_CONNECTION_STRING = os.environ.get('AZURE_CONNECTION_STRING', '')
+AZURE_CONTAINER = os.environ.get('AZURE_CONTAINER', 'pictures')
+
+# Azurite's well-known development account, used for UseDevelopmentStorage=true
+AZURITE_CONNECTION_STRING = (
+    'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;'
+    'AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;'
+    'BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;'
+)
+
+# Lifetime in seconds of direct-upload SAS URLs
+UPLOAD_SAS_TTL = int(os.environ.get('UPLOAD_SAS_TTL', 600))
+
+# Browser origins allowed to upload directly to storage (comma separated)
+BLOB_CORS_ORIGINS = os.environ.get('BLOB_CORS_ORIGINS', '*')
+
+# Connection pool and timeouts (seconds) for blob transfers
+BLOB_POOL_SIZE = int(os.environ.get('BLOB_POOL_SIZE', 10))
+BLOB_CONNECT_TIMEOUT = float(os.environ.get('BLOB_CONNECT_TIMEOUT', 5))
+BLOB_READ_TIMEOUT = float(os.environ.get('BLOB_READ_TIMEOUT', 60))
+
+# Uploads are hashed in chunks of this size and kept in memory up to
+# SPOOL_MAX_MEMORY bytes before spilling to a temporary file
+HASH_CHUNK_SIZE = 1024 * 1024
+SPOOL_MAX_MEMORY = int(os.environ.get('UPLOAD_SPOOL_MAX_MEMORY', 8 * 1024 * 1024))
+
+# Upload limits. UPLOAD_ALLOWED_EXTENSIONS (comma separated) narrows UPLOAD_TYPES.
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 200 * 1024 * 1024))
+UPLOAD_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.heic': 'image/heic',
+    '.heif': 'image/heif',
+    '.dng': 'image/x-adobe-dng',
+    '.mp4': 'video/mp4',
+    '.mov': 'video/quicktime',
+}
+if os.environ.get('UPLOAD_ALLOWED_EXTENSIONS'):
+    _allowed = {ext.strip().lower() for ext in os.environ['UPLOAD_ALLOWED_EXTENSIONS'].split(',')}
+    UPLOAD_TYPES = {ext: ctype for ext, ctype in UPLOAD_TYPES.items() if ext in _allowed}
+
+# Chunked uploads are staged as block blob blocks of this size
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+
+# Cache header for preview renditions
+RENDITION_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Threads per process running background uploads, and uploads per process
+# allowed to wait for one (each holds its spooled file, on disk past
+# SPOOL_MAX_MEMORY) before new ones are turned away
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+UPLOAD_QUEUE_SIZE = int(os.environ.get('UPLOAD_QUEUE_SIZE', 16))
+
+_client = None
+_client_pid = None
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(UPLOAD_QUEUE_SIZE)
+
+
+class UploadQueueFull(RuntimeError):
+    """Too many background uploads are pending; try again shortly."""
+
+
+def is_configured():
+    """Whether blob storage credentials are set."""
+    return bool(AZURE_CONNECTION_STRING)
+
+
+def _connection_string():
+    # This SDK version doesn't understand the Azurite shorthand itself
+    if AZURE_CONNECTION_STRING.replace(' ', '').lower() == 'usedevelopmentstorage=true':
+        return AZURITE_CONNECTION_STRING
+    return AZURE_CONNECTION_STRING
+
+
+def _operation(request):
+    """Metric label for a storage call: the method and its `comp` (block, blocklist...)."""
+    comp = parse_qs(urlsplit(request.url).query).get('comp', ['blob'])[0]
+    return f'{request.method} {comp}'
+
+
+def get_blob_service_client():
+    """Return this process's blob service client, creating it on first use."""
+    global _client, _client_pid
+    # Compare pids so forked workers don't share sockets with their parent
+    if _client is None or _client_pid != os.getpid():
+        with _lock:
+            if _client is None or _client_pid != os.getpid():
+                session = requests.Session()
+                # The SDK's own retry policy handles retries
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=BLOB_POOL_SIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                metrics.instrument_session(session, 'azure', _operation)
+                transport = RequestsTransport(
+                    session=session, session_owner=False,
+                    connection_timeout=BLOB_CONNECT_TIMEOUT, read_timeout=BLOB_READ_TIMEOUT,
+                )
+                _client = BlobServiceClient.from_connection_string(_connection_string(), transport=transport)
+                _client_pid = os.getpid()
+    return _client
+
+
+def get_blob_client(blob_name):
+    """Client for one blob in the pictures container."""
+    return get_blob_service_client().get_blob_client(container=AZURE_CONTAINER, blob=blob_name)
+
+
+def blob_url(blob_name):
+    """Public URL of a blob (works for Azure and Azurite endpoints)."""
+    return get_blob_client(blob_name).url
+
+
+def upload_blob(blob_name, data, content_type=None, cache_control=None):
+    """Upload bytes or a file object to a blob and return its URL."""
+    blob_client = get_blob_client(blob_name)
+    content_settings = None
+    if content_type or cache_control:
+        content_settings = ContentSettings(content_type=content_type, cache_control=cache_control)
+    blob_client.upload_blob(data, overwrite=True, content_settings=content_settings)
+    return blob_client.url
+
+
+def blob_exists(blob_name):
+    """Whether a blob is already stored."""
+    return get_blob_client(blob_name).exists()
+
+
+def list_blobs():
+    """Yield (name, last_modified) for every blob in the pictures container."""
+    container = get_blob_service_client().get_container_client(AZURE_CONTAINER)
+    for blob in container.list_blobs():
+        yield blob.name, blob.last_modified
+
+
+class UploadTooLarge(ValueError):
+    """The upload is larger than the limit it was read with."""
+
+
+def spool_and_hash(stream, max_bytes=UPLOAD_MAX_BYTES, chunk_size=HASH_CHUNK_SIZE):
+    """Copy a stream to a temporary file while hashing it.
+
+    Small uploads stay in memory; larger ones spill to disk. Returns
+    (sha256 hex digest, file rewound to the start). Raises UploadTooLarge
+    as soon as more than max_bytes have been read, so a body without a
+    Content-Length can't fill the disk.
+    """
+    digest = hashlib.sha256()
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            spooled.close()
+            raise UploadTooLarge(f'File is larger than {max_bytes} bytes')
+        digest.update(chunk)
+        spooled.write(chunk)
+    spooled.seek(0)
+    return digest.hexdigest(), spooled
+
+
+def content_blob_name(digest, ext):
+    """Content-addressed blob name, so identical uploads share one blob."""
+    return f'{digest}{ext}'
+
+
+def download_blob(blob_name):
+    """Read a whole blob into memory."""
+    return get_blob_client(blob_name).download_blob().readall()
+
+
+def hash_blob(blob_name):
+    """SHA-256 hex digest of a stored blob, read in chunks."""
+    digest = hashlib.sha256()
+    for chunk in get_blob_client(blob_name).download_blob().chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_blob(source_name, dest_name):
+    """Copy a blob within the container, server side, waiting for the copy."""
+    source_url = _sas_url(source_name, BlobSasPermissions(read=True), UPLOAD_SAS_TTL)
+    get_blob_client(dest_name).upload_blob_from_url(source_url, overwrite=True)
+
+
+def blob_name_from_url(url):
+    """Blob name for a URL in the pictures container, or None for other URLs."""
+    prefix = get_blob_service_client().get_container_client(AZURE_CONTAINER).url + '/'
+    if not url or not url.startswith(prefix):
+        return None
+    return unquote(url[len(prefix):].split('?')[0])
+
+
+def rendition_name(name, size, ext):
+    """Predictable name of a rendition: photo.jpg -> photo_thumb.webp.
+
+    Works on blob names and on full blob URLs alike.
+    """
+    return f'{os.path.splitext(name)[0]}_{size}.{ext}'
+
+
+def _block_id(index):
+    # Block ids must all have the same length within a blob
+    return base64.b64encode(f'{index:08d}'.encode()).decode()
+
+
+def stage_block(blob_name, index, data):
+    """Stage one chunk of a chunked upload as an uncommitted block."""
+    get_blob_client(blob_name).stage_block(_block_id(index), data, length=len(data))
+
+
+def staged_block_indexes(blob_name):
+    """Indexes of the chunks already staged for a blob (empty if none)."""
+    try:
+        _, uncommitted = get_blob_client(blob_name).get_block_list('uncommitted')
+    except ResourceNotFoundError:
+        return []
+    indexes = []
+    for block in uncommitted:
+        try:
+            indexes.append(int(base64.b64decode(block.id)))
+        except ValueError:
+            continue
+    return sorted(indexes)
+
+
+def commit_blocks(blob_name, count, content_type=None):
+    """Commit chunks 0..count-1, in order, as the blob's content."""
+    content_settings = ContentSettings(content_type=content_type) if content_type else None
+    blocks = [BlobBlock(block_id=_block_id(index)) for index in range(count)]
+    get_blob_client(blob_name).commit_block_list(blocks, content_settings=content_settings)
+
+
+def store_renditions(blob_name, data=None):
+    """Render and upload the preview renditions of a stored photo.
+
+    Downloads the photo unless its bytes are passed in. Returns the
+    rendition blob names.
+    """
+    if data is None:
+        data = download_blob(blob_name)
+    renditions, _ = image_pipeline.renditions(data)
+    names = []
+    for size, ext, content in renditions:
+        name = rendition_name(blob_name, size, ext)
+        _, content_type = image_pipeline.RENDITION_FORMATS[ext]
+        # Renditions never change for a given photo name
+        upload_blob(name, content, content_type, cache_control=RENDITION_CACHE_CONTROL)
+        names.append(name)
+    return names
+
+
+def get_blob_properties(blob_name):
+    """Properties of a blob, or None if it doesn't exist."""
+    try:
+        return get_blob_client(blob_name).get_blob_properties()
+    except ResourceNotFoundError:
+        return None
+
+
+def delete_blob(blob_name):
+    """Delete a blob if it exists."""
+    try:
+        get_blob_client(blob_name).delete_blob()
+    except ResourceNotFoundError:
+        pass
+
+
+def _sas_url(blob_name, permission, ttl):
+    """Blob URL with a short-lived SAS; needs the account key from the connection string."""
+    client = get_blob_service_client()
+    account_key = getattr(client.credential, 'account_key', None)
+    if not account_key:
+        raise RuntimeError('Direct uploads need an account key in AZURE_CONNECTION_STRING')
+    now = datetime.utcnow()
+    sas = generate_blob_sas(
+        client.account_name, AZURE_CONTAINER, blob_name,
+        account_key=account_key,
+        permission=permission,
+        # Backdate the start a little to allow for clock skew
+        start=now - timedelta(minutes=5),
+        expiry=now + timedelta(seconds=ttl),
+    )
+    return f'{blob_url(blob_name)}?{sas}'
+
+
+def upload_sas_url(blob_name, ttl=UPLOAD_SAS_TTL):
+    """Short-lived URL that can only create or overwrite this one blob."""
+    return _sas_url(blob_name, BlobSasPermissions(create=True, write=True), ttl)
+
+
+def configure_storage(origins=BLOB_CORS_ORIGINS):
+    """Create the pictures container and allow browsers to upload to it."""
+    client = get_blob_service_client()
+    try:
+        client.create_container(AZURE_CONTAINER, public_access='blob')
+    except ResourceExistsError:
+        pass
+    rule = CorsRule(
+        [origin.strip() for origin in origins.split(',')],
+        ['PUT', 'GET', 'HEAD', 'OPTIONS'],
+        allowed_headers=['*'],
+        exposed_headers=['*'],
+        max_age_in_seconds=3600,
+    )
+    client.set_service_properties(cors=[rule])
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='blob-upload')
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def _set_status(upload_id, status, **fields):
+    upload = db.session.get(PhotoUpload, upload_id)
+    upload.status = status
+    for name, value in fields.items():
+        setattr(upload, name, value)
+    upload.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+def _run_upload(app, upload_id, file, convert):
+    try:
+        with app.app_context():
+            _upload_file(upload_id, file, convert)
+    finally:
+        file.close()
+        _pending.release()
+
+
+def _upload_file(upload_id, file, convert):
+    try:
+        _set_status(upload_id, 'running')
+        upload = db.session.get(PhotoUpload, upload_id)
+        processing_ms = None
+        data = None
+        if convert is not None:
+            data, info = convert(file.read())
+            processing_ms = info.get('total_ms')
+        upload_blob(upload.blob_name, data if data is not None else file, upload.content_type)
+        _set_status(upload_id, 'succeeded', processing_ms=processing_ms)
+    except Exception as e:
+        logger.warning('Photo upload %s failed: %s', upload_id, e)
+        db.session.rollback()
+        _set_status(upload_id, 'failed', error=str(e))
+        return
+
+    # The photo is usable already; previews fall back to it until these exist.
+    # Videos have none, and files too big for the image pipeline would only
+    # be rejected by it.
+    if not (upload.content_type or '').startswith('image/'):
+        return
+    if data is None:
+        file.seek(0, os.SEEK_END)
+        if file.tell() > image_pipeline.IMAGE_MAX_BYTES:
+            return
+        file.seek(0)
+        data = file.read()
+    try:
+        store_renditions(upload.blob_name, data)
+    except Exception as e:
+        logger.warning('Renditions for %s failed: %s', upload.blob_name, e)
+
+
+def start_upload(app, blob_name, file, content_type=None, convert=None):
+    """Record a PhotoUpload and upload `file` on the background pool.
+
+    `file` is an open file (a spooled upload, say) that the pool reads and
+    closes, so the upload is never held in memory as bytes. `convert`, if
+    given, is called on the file's bytes in the background before they are
+    uploaded and returns (new_bytes, info) with info['total_ms']. Returns
+    the committed PhotoUpload; its `url` is final as soon as this returns,
+    even though the blob may not exist yet. Raises UploadQueueFull when
+    UPLOAD_QUEUE_SIZE uploads are already pending in this process.
+    """
+    if not _pending.acquire(blocking=False):
+        raise UploadQueueFull('Too many uploads are in progress, please retry shortly')
+    try:
+        upload = PhotoUpload(blob_name=blob_name, content_type=content_type, url=blob_url(blob_name))
+        db.session.add(upload)
+        db.session.commit()
+        _get_executor().submit(_run_upload, app, upload.id, file, convert)
+    except Exception:
+        _pending.release()
+        raise
+    return upload
@@ -0,0 +1,122 @@
+"""Streaming CSV and NDJSON export of quotes.
+
+One query selects every quote with its per-service photo link, parts and
+labor pivoted into columns and the totals summed in SQL, so no Quote
+objects or line items are loaded. Rows come out in id order, the order
+the GROUP BY already scans quotes in, so SQLite never sorts the grouped
+result; they are read from a server-side cursor EXPORT_BATCH_SIZE at a
+time and written out as they arrive, which keeps memory flat however many
+quotes match.
+"""
+import csv
+import io
+import json
+import os
+
+from sqlalchemy import case, func
+from models import db, Quote, QuoteLineItem, SERVICE_KEYS
+
+# Rows fetched from the cursor, and written per chunk of output
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+BASE_COLUMNS = ['id', 'invoice_number', 'date', 'date_promised', 'date_delivered',
+                'stock_number', 'to_name', 'tag_number', 'color', 'vehicle', 'instructions']
+
+# Same names as the QuoteForm service fields, plus a total per service
+SERVICE_COLUMNS = [f'{key}_{field}' for key in SERVICE_KEYS
+                   for field in ('photo_link', 'parts_cost', 'labor_cost', 'total')]
+
+EXPORT_COLUMNS = BASE_COLUMNS + SERVICE_COLUMNS + ['grand_total']
+
+# Columns converted from date objects to ISO text on the way out
+DATE_COLUMNS = ['date', 'date_promised', 'date_delivered']
+
+
+def _money(value):
+    return func.coalesce(value, 0)
+
+
+def _money_text(value):
+    """Money formatted to two places by SQLite, so rows arrive as plain text."""
+    return func.printf('%.2f', value)
+
+
+def export_query():
+    """Quote query selecting EXPORT_COLUMNS, with filters still to be applied.
+
+    Line items are pivoted into per-service columns with conditional
+    aggregates over a left join, grouped by quote.
+    """
+    parts = _money(QuoteLineItem.parts_cost)
+    labor = _money(QuoteLineItem.labor_cost)
+
+    columns = [getattr(Quote, name).label(name) for name in BASE_COLUMNS]
+    for key in SERVICE_KEYS:
+        is_service = QuoteLineItem.service == key
+        service_parts = func.sum(case((is_service, parts), else_=0))
+        service_labor = func.sum(case((is_service, labor), else_=0))
+        columns += [
+            func.max(case((is_service, QuoteLineItem.photo_link))).label(f'{key}_photo_link'),
+            _money_text(service_parts).label(f'{key}_parts_cost'),
+            _money_text(service_labor).label(f'{key}_labor_cost'),
+            _money_text(service_parts + service_labor).label(f'{key}_total'),
+        ]
+    columns.append(_money_text(func.sum(parts + labor)).label('grand_total'))
+
+    return (db.session.query(*columns)
+            .select_from(Quote)
+            .outerjoin(QuoteLineItem, QuoteLineItem.quote_id == Quote.id)
+            .group_by(Quote.id))
+
+
+def _rows(query):
+    """Stream query rows in id order from a server-side cursor as lists of values."""
+    query = query.order_by(Quote.id)
+    date_indexes = [EXPORT_COLUMNS.index(name) for name in DATE_COLUMNS]
+    for row in query.execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE):
+        values = list(row)
+        for i in date_indexes:
+            if values[i] is not None:
+                values[i] = values[i].isoformat()
+        yield values
+
+
+def iter_csv(query):
+    """Yield the rows of an export query as CSV text, header first."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+
+    count = 0
+    for row in _rows(query):
+        writer.writerow(row)
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_ndjson(query):
+    """Yield the rows of an export query as newline-delimited JSON objects."""
+    lines = []
+    for row in _rows(query):
+        lines.append(json.dumps(dict(zip(EXPORT_COLUMNS, row))))
+        if len(lines) >= EXPORT_BATCH_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def iter_export(query, export_format):
+    """Yield an export query in one of EXPORT_FORMATS."""
+    if export_format == 'ndjson':
+        return iter_ndjson(query)
+    return iter_csv(query)
@@ -1,7 +1,9 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, DateField, DecimalField, TextAreaField, SubmitField
-from wtforms.validators import DataRequired, Optional, NumberRange
+from wtforms.validators import DataRequired, Optional, NumberRange, ValidationError
 from datetime import date
+from werkzeug.datastructures import MultiDict
+from models import SERVICES, SERVICE_KEYS
 
 class QuoteForm(FlaskForm):
     # Base fields
@@ -16,54 +18,41 @@ class QuoteForm(FlaskForm):
     vehicle = StringField('Vehicle (Year / Make / Model)', validators=[Optional()])
     instructions = TextAreaField('Instructions', validators=[Optional()])
 
-    # Service fields - headlights_resurfacing
-    headlights_resurfacing_photo_link = StringField('Headlights Re-surfacing Photo Link', validators=[Optional()])
-    headlights_resurfacing_parts_cost = DecimalField('Headlights Re-surfacing Parts Cost', validators=[Optional()], places=2)
-    headlights_resurfacing_labor_cost = DecimalField('Headlights Re-surfacing Labor Cost', validators=[Optional()], places=2)
-
-    # Service fields - headlights_ceramic
-    headlights_ceramic_photo_link = StringField('Headlights Ceramic Coating Photo Link', validators=[Optional()])
-    headlights_ceramic_parts_cost = DecimalField('Headlights Ceramic Coating Parts Cost', validators=[Optional()], places=2)
-    headlights_ceramic_labor_cost = DecimalField('Headlights Ceramic Coating Labor Cost', validators=[Optional()], places=2)
-
-    # Service fields - trim_ceramic
-    trim_ceramic_photo_link = StringField('Trim Ceramic Coating Photo Link', validators=[Optional()])
-    trim_ceramic_parts_cost = DecimalField('Trim Ceramic Coating Parts Cost', validators=[Optional()], places=2)
-    trim_ceramic_labor_cost = DecimalField('Trim Ceramic Coating Labor Cost', validators=[Optional()], places=2)
-
-    # Service fields - car_wizard_diy
-    car_wizard_diy_photo_link = StringField('Car Wizard DIY Kit Photo Link', validators=[Optional()])
-    car_wizard_diy_parts_cost = DecimalField('Car Wizard DIY Kit Parts Cost', validators=[Optional()], places=2)
-    car_wizard_diy_labor_cost = DecimalField('Car Wizard DIY Kit Labor Cost', validators=[Optional()], places=2)
-
-    # Service fields - carspa_sealant
-    carspa_sealant_photo_link = StringField('Car Spa (Sealant) Photo Link', validators=[Optional()])
-    carspa_sealant_parts_cost = DecimalField('Car Spa (Sealant) Parts Cost', validators=[Optional()], places=2)
-    carspa_sealant_labor_cost = DecimalField('Car Spa (Sealant) Labor Cost', validators=[Optional()], places=2)
-
-    # Service fields - carspa_ceramic
-    carspa_ceramic_photo_link = StringField('Car Spa (Plus Ceramic) Photo Link', validators=[Optional()])
-    carspa_ceramic_parts_cost = DecimalField('Car Spa (Plus Ceramic) Parts Cost', validators=[Optional()], places=2)
-    carspa_ceramic_labor_cost = DecimalField('Car Spa (Plus Ceramic) Labor Cost', validators=[Optional()], places=2)
-
-    # Service fields - mechanical
-    mechanical_photo_link = StringField('Mechanical Photo Link', validators=[Optional()])
-    mechanical_parts_cost = DecimalField('Mechanical Parts Cost', validators=[Optional()], places=2)
-    mechanical_labor_cost = DecimalField('Mechanical Labor Cost', validators=[Optional()], places=2)
-
-    # Service fields - glass
-    glass_photo_link = StringField('Glass Photo Link', validators=[Optional()])
-    glass_parts_cost = DecimalField('Glass Parts Cost', validators=[Optional()], places=2)
-    glass_labor_cost = DecimalField('Glass Labor Cost', validators=[Optional()], places=2)
-
-    # Service fields - tint
-    tint_photo_link = StringField('Tint Photo Link', validators=[Optional()])
-    tint_parts_cost = DecimalField('Tint Parts Cost', validators=[Optional()], places=2)
-    tint_labor_cost = DecimalField('Tint Labor Cost', validators=[Optional()], places=2)
-
-    # Service fields - misc
-    misc_photo_link = StringField('Misc Photo Link', validators=[Optional()])
-    misc_parts_cost = DecimalField('Misc Parts Cost', validators=[Optional()], places=2)
-    misc_labor_cost = DecimalField('Misc Labor Cost', validators=[Optional()], places=2)
-    
     submit = SubmitField('Save Quote')
+
+def finite(form, field):
+    """Reject NaN and Infinity, which Decimal parses but a cost can't be."""
+    if field.data is not None and not field.data.is_finite():
+        raise ValidationError('Not a valid decimal value.')
+
+# Service fields - a photo link, parts cost and labor cost for each service
+for _service_key, _service_name in SERVICES:
+    setattr(QuoteForm, f'{_service_key}_photo_link',
+            StringField(f'{_service_name} Photo Link', validators=[Optional()]))
+    setattr(QuoteForm, f'{_service_key}_parts_cost',
+            DecimalField(f'{_service_name} Parts Cost', validators=[Optional(), finite], places=2))
+    setattr(QuoteForm, f'{_service_key}_labor_cost',
+            DecimalField(f'{_service_name} Labor Cost', validators=[Optional(), finite], places=2))
+
+# Names of the fields holding quote data, base fields first
+BASE_FIELDS = ['invoice_number', 'date', 'date_promised', 'date_delivered', 'stock_number',
+               'to_name', 'tag_number', 'color', 'vehicle', 'instructions']
+SERVICE_FIELDS = ['photo_link', 'parts_cost', 'labor_cost']
+QUOTE_FIELDS = BASE_FIELDS + [f'{key}_{field}' for key in SERVICE_KEYS for field in SERVICE_FIELDS]
+
+def validate_fields(form, values):
+    """Validate just the given fields of a bound form, by the form's own rules.
+
+    `values` maps field names to submitted strings. Returns (data, errors)
+    keyed by field name; fields not given are neither processed nor checked.
+    """
+    formdata = MultiDict(values)
+    data, errors = {}, {}
+    for name in values:
+        field = form[name]
+        field.process(formdata)
+        if field.validate(form):
+            data[name] = field.data
+        else:
+            errors[name] = field.errors
+    return data, errors
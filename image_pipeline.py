@@ -0,0 +1,255 @@
+"""Out-of-process image conversion for uploaded photos.
+
+Decoding and re-encoding full-size phone photos is CPU and memory heavy, so
+it runs in a small process pool instead of the request worker. At most
+IMAGE_QUEUE_SIZE conversions may be running or waiting per web process;
+beyond that callers get `PipelineBusy` rather than piling up more work.
+
+Each image is checked against byte and pixel limits before it is decoded
+(so decompression bombs are rejected from the header alone), downscaled to
+IMAGE_MAX_DIMENSION, rotated upright and re-encoded as JPEG without EXIF
+or XMP metadata. The same pool renders the small WebP and JPEG renditions
+shown as previews. Timings are logged and returned for every image.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from PIL import Image, ImageOps
+import pillow_heif
+
+import metrics
+
+# Register HEIF opener with Pillow (also runs in each worker process)
+pillow_heif.register_heif_opener()
+
+logger = logging.getLogger(__name__)
+
+# Worker processes per web process, and conversions allowed in flight
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_QUEUE_SIZE = int(os.environ.get('IMAGE_QUEUE_SIZE', 8))
+# Seconds to wait for a queue slot, then for the conversion itself
+IMAGE_QUEUE_TIMEOUT = float(os.environ.get('IMAGE_QUEUE_TIMEOUT', 10))
+IMAGE_CONVERT_TIMEOUT = float(os.environ.get('IMAGE_CONVERT_TIMEOUT', 60))
+
+# Output size and quality
+IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 2048))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+
+# Preview renditions: longest side in pixels per size name, and the
+# formats each size is stored in (WebP first, JPEG as the fallback)
+RENDITION_SIZES = {'thumb': 320, 'medium': 1024}
+RENDITION_FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpg': ('JPEG', 'image/jpeg')}
+RENDITION_QUALITY = int(os.environ.get('RENDITION_QUALITY', 80))
+
+# Input limits
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 25 * 1024 * 1024))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 50_000_000))
+
+
+class ImageRejected(ValueError):
+    """The upload isn't an image we are willing to decode."""
+
+
+class ImageUndecodable(ImageRejected):
+    """The upload is truncated, corrupt or not an image format we can read."""
+
+
+# What Pillow and pillow-heif raise for bad image data (UnidentifiedImageError
+# is an OSError; some plugins raise SyntaxError or ValueError)
+DECODE_ERRORS = (OSError, SyntaxError, ValueError)
+
+
+class PipelineBusy(RuntimeError):
+    """Every conversion slot is taken; try again shortly."""
+
+
+def _elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def _open_image(data, max_dimension, max_pixels):
+    """Open image bytes, enforce the pixel limit and decode an upright RGB
+    image no larger than max_dimension on either side."""
+    # Pillow raises DecompressionBombError past twice this; we check it ourselves first
+    Image.MAX_IMAGE_PIXELS = max_pixels
+
+    try:
+        image = Image.open(BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise ImageRejected(str(e))
+    except Image.UnidentifiedImageError:
+        raise ImageUndecodable('Not an image format that can be read')
+    except DECODE_ERRORS as e:
+        raise ImageUndecodable(f'Cannot read image: {e}')
+
+    # Only the header has been read so far
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageRejected(f'Image is {width}x{height}; the limit is {max_pixels} pixels')
+
+    # JPEG sources decode straight to a reduced scale; other formats are
+    # reduced right after decoding
+    try:
+        image.draft('RGB', (max_dimension, max_dimension))
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS, reducing_gap=2.0)
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+    except DECODE_ERRORS as e:
+        raise ImageUndecodable(f'Cannot decode image: {e}')
+    return image, width, height
+
+
+def convert_image(data, max_dimension=IMAGE_MAX_DIMENSION, quality=IMAGE_JPEG_QUALITY,
+                  max_pixels=IMAGE_MAX_PIXELS):
+    """Convert image bytes to a downscaled, metadata-free JPEG.
+
+    Runs in a worker process. Returns (jpeg_bytes, info) where info holds
+    the original and output sizes and decode/encode timings in ms.
+    """
+    started = time.perf_counter()
+    image, width, height = _open_image(data, max_dimension, max_pixels)
+    decoded = time.perf_counter()
+
+    # Saving without exif= drops EXIF (GPS, camera) and XMP; keep the colour profile
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True,
+               icc_profile=image.info.get('icc_profile'))
+    result = output.getvalue()
+
+    info = {
+        'original_width': width,
+        'original_height': height,
+        'width': image.width,
+        'height': image.height,
+        'bytes_in': len(data),
+        'bytes_out': len(result),
+        'decode_ms': round((decoded - started) * 1000, 1),
+        'encode_ms': _elapsed_ms(decoded),
+    }
+    return result, info
+
+
+def render_renditions(data, max_pixels=IMAGE_MAX_PIXELS):
+    """Render every size in RENDITION_SIZES in every format in RENDITION_FORMATS.
+
+    Runs in a worker process. The source is decoded once, at the largest
+    rendition size. Returns (renditions, info) where renditions is a list
+    of (size, ext, bytes).
+    """
+    started = time.perf_counter()
+    image, width, height = _open_image(data, max(RENDITION_SIZES.values()), max_pixels)
+    decoded = time.perf_counter()
+
+    renditions = []
+    for size, dimension in RENDITION_SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((dimension, dimension), Image.LANCZOS)
+        for ext, (pil_format, _) in RENDITION_FORMATS.items():
+            output = BytesIO()
+            resized.save(output, format=pil_format, quality=RENDITION_QUALITY,
+                         icc_profile=image.info.get('icc_profile'))
+            renditions.append((size, ext, output.getvalue()))
+
+    info = {
+        'original_width': width,
+        'original_height': height,
+        'width': image.width,
+        'height': image.height,
+        'bytes_in': len(data),
+        'bytes_out': sum(len(r[2]) for r in renditions),
+        'decode_ms': round((decoded - started) * 1000, 1),
+        'encode_ms': _elapsed_ms(decoded),
+    }
+    return renditions, info
+
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(IMAGE_QUEUE_SIZE)
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _lock:
+            if _executor is None or _executor_pid != os.getpid():
+                # Spawn, not fork: the web process has threads and open sockets
+                context = multiprocessing.get_context('spawn')
+                _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=context)
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def _discard_executor(executor):
+    """Drop a broken pool (a worker was killed, e.g. by the OOM killer) so
+    the next conversion starts a fresh one."""
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _run(func, data, timeout):
+    """Run func(data) in the worker pool, holding a queue slot until it ends.
+
+    Raises TimeoutError if it takes longer than `timeout` (the conversion
+    keeps its slot until it actually finishes) and BrokenProcessPool if a
+    worker died, in which case the pool is replaced for the next call.
+    """
+    if len(data) > IMAGE_MAX_BYTES:
+        raise ImageRejected(f'Image is {len(data)} bytes; the limit is {IMAGE_MAX_BYTES}')
+
+    started = time.perf_counter()
+    if not _slots.acquire(timeout=IMAGE_QUEUE_TIMEOUT):
+        raise PipelineBusy('Too many images are being processed, please retry shortly')
+    executor = _get_executor()
+    try:
+        future = executor.submit(func, data)
+    except BrokenProcessPool:
+        _slots.release()
+        _discard_executor(executor)
+        raise
+    future.add_done_callback(lambda f: _slots.release())
+
+    try:
+        with metrics.timed(func.__name__):
+            result, info = future.result(timeout=timeout)
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        raise
+
+    info['total_ms'] = _elapsed_ms(started)
+    info['queue_ms'] = round(info['total_ms'] - info['decode_ms'] - info['encode_ms'], 1)
+    logger.info('%s: %sx%s image -> %sx%s (%s -> %s bytes) in %sms '
+                '(queue %sms, decode %sms, encode %sms)', func.__name__,
+                info['original_width'], info['original_height'], info['width'], info['height'],
+                info['bytes_in'], info['bytes_out'], info['total_ms'],
+                info['queue_ms'], info['decode_ms'], info['encode_ms'])
+    return result, info
+
+
+def to_jpeg(data, timeout=IMAGE_CONVERT_TIMEOUT):
+    """Convert image bytes to JPEG in the worker pool and wait for the result.
+
+    Returns (jpeg_bytes, info); info includes queue and total time in ms.
+    Raises ImageRejected for oversized or undecodable images and
+    PipelineBusy when the queue is full.
+    """
+    return _run(convert_image, data, timeout)
+
+
+def renditions(data, timeout=IMAGE_CONVERT_TIMEOUT):
+    """Render the preview renditions of an image in the worker pool.
+
+    Returns (renditions, info) as for `render_renditions`; raises like `to_jpeg`.
+    """
+    return _run(render_renditions, data, timeout)
@@ -0,0 +1,194 @@
+"""Persistent background job queue backed by the app's SQLite database.
+
+Web requests enqueue jobs and return immediately. A separate worker process
+(`flask --app app jobs-worker`) claims queued jobs one at a time, runs the
+registered handler for the job's kind, and records the outcome. Failed jobs
+are retried with exponential backoff up to `max_attempts`; jobs left
+`running` by a worker that died are put back on the queue after
+JOB_LOCK_TIMEOUT seconds.
+"""
+import json
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+from models import db, Job, Quote
+import blob_storage
+from image_pipeline import ImageRejected
+from xero_service import send_quote_to_xero, sync_changed_quotes, XERO_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+JOB_LOCK_TIMEOUT = int(os.environ.get('JOB_LOCK_TIMEOUT', 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_BASE_DELAY = int(os.environ.get('JOB_RETRY_BASE_DELAY', 30))
+
+JOB_HANDLERS = {}
+
+
+class PermanentJobError(Exception):
+    """A job failure that retrying won't fix."""
+
+
+def job_handler(kind):
+    """Register a function as the handler for a job kind."""
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def enqueue_job(kind, quote_id=None, payload=None, max_attempts=JOB_MAX_ATTEMPTS):
+    """Add a job to the queue. The caller commits the session."""
+    job = Job(
+        kind=kind,
+        quote_id=quote_id,
+        payload=json.dumps(payload) if payload is not None else None,
+        max_attempts=max_attempts,
+    )
+    db.session.add(job)
+    return job
+
+
+def latest_job(quote_id, kind):
+    """Most recent job of a kind for a quote (None for global jobs), or None."""
+    return Job.query.filter_by(quote_id=quote_id, kind=kind).order_by(Job.id.desc()).first()
+
+
+def pending_job(quote_id, kind):
+    """A queued or running job of a kind for a quote (None for global jobs), or None."""
+    return Job.query.filter(
+        Job.quote_id == quote_id, Job.kind == kind, Job.status.in_(['queued', 'running'])
+    ).first()
+
+
+def requeue_stale_jobs():
+    """Put jobs locked by a worker that stopped responding back on the queue."""
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_LOCK_TIMEOUT)
+    result = db.session.execute(
+        update(Job)
+        .where(Job.status == 'running', Job.locked_at < cutoff)
+        .values(status='queued', locked_at=None, locked_by=None, updated_at=datetime.utcnow())
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def claim_next_job(worker_id):
+    """Atomically claim the next due job. Returns the Job or None."""
+    now = datetime.utcnow()
+    candidate = db.session.query(Job.id).filter(
+        Job.status == 'queued', Job.run_at <= now
+    ).order_by(Job.run_at, Job.id).first()
+    if candidate is None:
+        db.session.rollback()
+        return None
+
+    # The status check makes the claim safe against other workers
+    result = db.session.execute(
+        update(Job)
+        .where(Job.id == candidate.id, Job.status == 'queued')
+        .values(status='running', locked_at=now, locked_by=worker_id,
+                attempts=Job.attempts + 1, updated_at=now)
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        return None
+    return db.session.get(Job, candidate.id, populate_existing=True)
+
+
+def run_job(job):
+    """Run a claimed job and record success, a retry, or failure."""
+    handler = JOB_HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise PermanentJobError(f'No handler registered for job kind {job.kind!r}')
+        payload = json.loads(job.payload) if job.payload else {}
+        result = handler(job, payload)
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job.id, populate_existing=True)
+        job.last_error = str(e)
+        job.locked_at = None
+        job.locked_by = None
+        if isinstance(e, PermanentJobError) or job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            logger.warning('Job %s (%s) failed: %s', job.id, job.kind, e)
+        else:
+            job.status = 'queued'
+            delay = JOB_RETRY_BASE_DELAY * (2 ** (job.attempts - 1))
+            job.run_at = datetime.utcnow() + timedelta(seconds=delay)
+            logger.info('Job %s (%s) will retry in %ss: %s', job.id, job.kind, delay, e)
+        db.session.commit()
+        return False
+
+    job.status = 'succeeded'
+    job.result = json.dumps(result) if result is not None else None
+    job.last_error = None
+    job.locked_at = None
+    job.locked_by = None
+    db.session.commit()
+    return True
+
+
+def work(once=False):
+    """Worker loop: claim and run jobs until interrupted (or the queue is empty if `once`)."""
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    requeue_stale_jobs()
+    last_stale_check = time.monotonic()
+    while True:
+        if time.monotonic() - last_stale_check > JOB_LOCK_TIMEOUT:
+            requeue_stale_jobs()
+            last_stale_check = time.monotonic()
+
+        job = claim_next_job(worker_id)
+        if job is None:
+            if once:
+                return
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        run_job(job)
+        db.session.expunge_all()
+
+
+@job_handler('send_quote_to_xero')
+def send_quote_to_xero_job(job, payload):
+    """Create or update one quote in Xero."""
+    quote = db.session.get(Quote, job.quote_id)
+    if quote is None:
+        raise PermanentJobError('Quote no longer exists')
+
+    result = send_quote_to_xero(quote)
+    if not result['success']:
+        # Validation errors and the like fail the same way on every attempt
+        if not result['retryable']:
+            raise PermanentJobError(result['error'])
+        raise Exception(result['error'])
+
+    db.session.commit()
+    return {'xero_quote_id': result['xero_quote_id'], 'changed': result['changed']}
+
+
+@job_handler('xero_bulk_sync')
+def xero_bulk_sync_job(job, payload):
+    """Send every new or changed quote to Xero in batches."""
+    summary = sync_changed_quotes(batch_size=payload.get('batch_size') or XERO_BATCH_SIZE)
+    if summary['error']:
+        if not summary['retryable']:
+            raise PermanentJobError(summary['error'])
+        raise Exception(summary['error'])
+    return summary
+
+
+@job_handler('photo_renditions')
+def photo_renditions_job(job, payload):
+    """Render the preview renditions of an uploaded photo."""
+    try:
+        return {'renditions': blob_storage.store_renditions(payload['blob_name'])}
+    except ImageRejected as e:
+        raise PermanentJobError(f'Cannot render {payload["blob_name"]}: {e}')
@@ -0,0 +1,427 @@
+"""Request instrumentation and a Prometheus-format /metrics endpoint.
+
+Recorded per process:
+
+- request latency by endpoint, method and status
+- SQL statements per request and statement time by endpoint, with slow
+  statements logged and statements repeated METRICS_N_PLUS_ONE_THRESHOLD
+  times in one request (the usual sign of an N+1 query) logged once
+- template render time
+- outbound Azure and Xero HTTP calls by operation and status, timed to the
+  response headers (`requests`' `elapsed`)
+- other slow steps wrapped in `timed()`, such as image conversion
+
+Each response carries a Server-Timing header with the request's totals
+(app, db, render and any outbound or timed steps), which browser dev tools
+show in the network panel.
+
+Each process writes its metrics to METRICS_DIR/<pid>.json at most every
+METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the files of every
+process, so a scrape sees all gunicorn workers and the jobs worker
+whichever one answers it. Files of processes that have exited are folded
+into archive.json so their counts are kept.
+
+/metrics is off unless METRICS_TOKEN is set, and then requires it.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import Response, abort, g, has_request_context, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import fcntl
+except ImportError:  # Windows: scrapes aren't serialized across processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+# /metrics requires "Authorization: Bearer <token>" and is a 404 without one.
+# Behind nginx every request comes from loopback, so the address proves nothing.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', 100))
+METRICS_N_PLUS_ONE_THRESHOLD = int(os.environ.get('METRICS_N_PLUS_ONE_THRESHOLD', 10))
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+OUTBOUND_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name: (type, help, buckets for histograms)
+METRICS = {
+    'app_http_request_duration_seconds': (
+        'histogram', 'Time to build a response, by endpoint, method and status.', REQUEST_BUCKETS),
+    'app_sql_queries_per_request': (
+        'histogram', 'SQL statements executed per request, by endpoint.', QUERY_COUNT_BUCKETS),
+    'app_sql_query_duration_seconds': (
+        'histogram', 'SQL statement execution time, by endpoint.', SQL_BUCKETS),
+    'app_sql_slow_queries_total': (
+        'counter', f'SQL statements slower than {SQL_SLOW_QUERY_MS:g}ms, by endpoint.', None),
+    'app_sql_n_plus_one_total': (
+        'counter', 'Requests that repeated one SQL statement '
+                   f'{METRICS_N_PLUS_ONE_THRESHOLD} or more times, by endpoint.', None),
+    'app_template_render_seconds': (
+        'histogram', 'Jinja template render time, by template.', REQUEST_BUCKETS),
+    'app_outbound_request_duration_seconds': (
+        'histogram', 'Outbound HTTP call time to response headers, by service, operation and status.',
+        OUTBOUND_BUCKETS),
+    'app_operation_duration_seconds': (
+        'histogram', 'Time spent in instrumented steps, by operation.', REQUEST_BUCKETS),
+}
+
+
+class Registry:
+    """This process's counters and histograms, keyed by (name, labels)."""
+
+    def __init__(self):
+        self.counters = {}
+        # (name, labels): [per-bucket counts (last is +Inf), sum, count]
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            self._dirty = True
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+            self._dirty = True
+
+    def snapshot(self):
+        with self._lock:
+            self._dirty = False
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, list(counts), total, count]
+                               for (name, labels), (counts, total, count) in self.histograms.items()],
+            }
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+
+registry = Registry()
+_registry_pid = os.getpid()
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+
+
+def _registry():
+    """This process's registry; a forked child starts from zero."""
+    global registry, _registry_pid, _last_flush
+    if _registry_pid != os.getpid():
+        with _flush_lock:
+            if _registry_pid != os.getpid():
+                registry, _registry_pid, _last_flush = Registry(), os.getpid(), 0.0
+    return registry
+
+
+def _write_json(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def flush(force=False):
+    """Write this process's metrics to METRICS_DIR if due (or forced)."""
+    global _last_flush
+    reg = _registry()
+    if not METRICS_DIR or not reg.dirty:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < METRICS_FLUSH_INTERVAL:
+        return
+    with _flush_lock:
+        _last_flush = now
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _write_json(os.path.join(METRICS_DIR, f'{os.getpid()}.json'), reg.snapshot())
+
+
+def inc(name, amount=1, **labels):
+    _registry().inc(name, labels, amount)
+    flush()
+
+
+def observe(name, value, **labels):
+    _registry().observe(name, labels, value)
+    flush()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(into, data):
+    for name, labels, value in data.get('counters', []):
+        key = (name, tuple(map(tuple, labels)))
+        into['counters'][key] = into['counters'].get(key, 0) + value
+    for name, labels, counts, total, count in data.get('histograms', []):
+        key = (name, tuple(map(tuple, labels)))
+        entry = into['histograms'].setdefault(key, [[0] * len(counts), 0.0, 0])
+        if len(entry[0]) != len(counts):
+            # Buckets changed between deploys; those samples can't be combined
+            continue
+        entry[0] = [a + b for a, b in zip(entry[0], counts)]
+        entry[1] += total
+        entry[2] += count
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _as_lists(merged):
+    """The JSON file layout of merged metrics."""
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in merged['counters'].items()],
+        'histograms': [[name, labels, *entry] for (name, labels), entry in merged['histograms'].items()],
+    }
+
+
+def collect():
+    """Metrics of every process, as {'counters': {...}, 'histograms': {...}}."""
+    flush(force=True)
+    merged = {'counters': {}, 'histograms': {}}
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        _merge(merged, _registry().snapshot())
+        return merged
+
+    archive_path = os.path.join(METRICS_DIR, 'archive.json')
+    with open(os.path.join(METRICS_DIR, '.lock'), 'w') as lock:
+        # One scrape at a time folds the files of exited processes into the archive
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        archive = {'counters': {}, 'histograms': {}}
+        _merge(archive, _load(archive_path))
+        dead = []
+        for path in glob.glob(os.path.join(METRICS_DIR, '[0-9]*.json')):
+            data = _load(path)
+            if _pid_alive(int(os.path.basename(path).split('.')[0])):
+                _merge(merged, data)
+            else:
+                _merge(archive, data)
+                dead.append(path)
+        if dead:
+            _write_json(archive_path, _as_lists(archive))
+            for path in dead:
+                os.remove(path)
+    _merge(merged, _as_lists(archive))
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def render_prometheus(merged):
+    """Prometheus text exposition of collected metrics."""
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for (metric, labels), value in sorted(merged['counters'].items()):
+                if metric == name:
+                    lines.append(f'{name}{_labels(labels)} {value:g}')
+            continue
+        for (metric, labels), (counts, total, count) in sorted(merged['histograms'].items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for le, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_labels(labels, [("le", f"{le:g}" if le != "+Inf" else le)])} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {total:.6f}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return 'background'
+
+
+def _add_timing(name, seconds):
+    """Add to this request's Server-Timing totals, if there is a request."""
+    if has_request_context():
+        timings = g.setdefault('server_timing', {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timed(operation):
+    """Time a block as `operation`, e.g. `with timed('heic_convert'): ...`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe('app_operation_duration_seconds', elapsed, operation=operation)
+        _add_timing(operation, elapsed)
+
+
+def instrument_session(session, service, operation):
+    """Record each response of a requests.Session as an outbound call.
+
+    `operation(request)` names the call for the metric label; keep it to a
+    small fixed set of values (an endpoint name, not a full URL).
+    """
+    def record(response, *args, **kwargs):
+        elapsed = response.elapsed.total_seconds()
+        observe('app_outbound_request_duration_seconds', elapsed, service=service,
+                operation=operation(response.request), status=str(response.status_code))
+        _add_timing(service, elapsed)
+        return response
+
+    session.hooks['response'].append(record)
+    return session
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    endpoint = _endpoint()
+    observe('app_sql_query_duration_seconds', elapsed, endpoint=endpoint)
+    if elapsed * 1000 >= SQL_SLOW_QUERY_MS:
+        inc('app_sql_slow_queries_total', endpoint=endpoint)
+        logger.warning('Slow SQL (%.1fms) in %s: %s', elapsed * 1000, endpoint, statement[:500])
+
+    if not has_request_context() or 'metrics_started' not in g:
+        return
+    g.sql_time += elapsed
+    g.sql_statements[statement] += 1
+    if g.sql_statements[statement] == METRICS_N_PLUS_ONE_THRESHOLD:
+        inc('app_sql_n_plus_one_total', endpoint=endpoint)
+        logger.warning('Possible N+1 in %s: statement ran %s times: %s',
+                       endpoint, METRICS_N_PLUS_ONE_THRESHOLD, statement[:500])
+
+
+def _before_render(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault('render_starts', []).append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    starts = g.get('render_starts') if has_request_context() else None
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    observe('app_template_render_seconds', elapsed, template=template.name or 'string')
+    _add_timing('render', elapsed)
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    g.sql_time = 0.0
+    g.sql_statements = Counter()
+
+
+def _record_request(started, status):
+    """Record a finished request; returns (elapsed, query_count)."""
+    elapsed = time.perf_counter() - started
+    endpoint = _endpoint()
+    query_count = sum(g.sql_statements.values())
+    observe('app_http_request_duration_seconds', elapsed, endpoint=endpoint,
+            method=request.method, status=str(status))
+    observe('app_sql_queries_per_request', query_count, endpoint=endpoint)
+    return elapsed, query_count
+
+
+def _finish_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    elapsed, query_count = _record_request(started, response.status_code)
+
+    timings = [f'app;dur={elapsed * 1000:.1f}',
+               f'db;dur={g.sql_time * 1000:.1f};desc="queries: {query_count}"']
+    timings += [f'{name};dur={seconds * 1000:.1f}'
+                for name, seconds in g.get('server_timing', {}).items()]
+    response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
+def _teardown_request(exc):
+    # after_request is skipped when an exception escapes the error handlers
+    # (PROPAGATE_EXCEPTIONS), so count those requests as 500s here
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        _record_request(started, 500)
+
+
+def metrics_view():
+    """Prometheus scrape endpoint covering every worker process."""
+    if not METRICS_TOKEN:
+        abort(404)
+    if request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        abort(401)
+    return Response(render_prometheus(collect()), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """Install the request, SQL and template hooks and the /metrics route."""
+    global METRICS_DIR
+    if not METRICS_DIR:
+        METRICS_DIR = os.path.join(app.instance_path, 'metrics')
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_template_rendered, app)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    atexit.register(flush, force=True)
@@ -0,0 +1,265 @@
+"""Versioned schema migrations for the SQLite database.
+
+The schema version is kept in SQLite's `PRAGMA user_version`. Each migration
+bumps the version in the same transaction as its last change, so an
+interrupted upgrade picks up where it stopped. Long data copies may commit
+in batches along the way to keep write locks short while the app is live.
+Migrations are written to be idempotent because a fresh database built by
+`db.create_all()` already has the current tables and columns.
+
+`db-upgrade` runs while the previous release is still serving, so a
+migration may only add to the schema. Removing what old code still reads
+or writes is a contract migration: it never runs in the same upgrade as
+the migrations before it, so it lands a deploy later, once every process
+runs code that no longer touches what it removes.
+"""
+from datetime import datetime
+
+from sqlalchemy import text
+from models import db
+from search import create_search_index, FTS_TABLE
+from page_cache import create_version_triggers
+from reporting import create_rollups, fill_rollups
+
+MIGRATIONS = []
+
+# Services stored as *_photo_link/*_parts_cost/*_labor_cost columns on
+# `quotes` before line items were normalized into `quote_line_items`
+LEGACY_SERVICE_KEYS = ['headlights_resurfacing', 'headlights_ceramic', 'trim_ceramic',
+                       'car_wizard_diy', 'carspa_sealant', 'carspa_ceramic',
+                       'mechanical', 'glass', 'tint', 'misc']
+LEGACY_SERVICE_FIELDS = ['photo_link', 'parts_cost', 'labor_cost']
+
+# Rows copied per transaction by batched data migrations
+MIGRATION_BATCH_SIZE = 1000
+
+
+def migration(version, description, contract=False):
+    """Register a migration function for the given schema version.
+
+    A `contract` migration waits for the next upgrade if this one has
+    already applied earlier migrations (see the module docstring).
+    """
+    def decorator(func):
+        MIGRATIONS.append((version, description, func, contract))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+def get_schema_version(connection):
+    """Return the schema version stored in the database header."""
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+def column_exists(connection, table, column_name):
+    """Check whether a column exists on a table."""
+    rows = connection.execute(text(f'PRAGMA table_info({table})')).mappings().all()
+    return any(row['name'] == column_name for row in rows)
+
+
+def upgrade():
+    """Create missing tables and apply all pending migrations.
+
+    Returns a list of (version, description) for the migrations applied.
+    """
+    db.create_all()
+
+    applied = []
+    for version, description, func, contract in MIGRATIONS:
+        with db.engine.connect() as connection:
+            # Re-check in case another process upgraded in the meantime
+            if get_schema_version(connection) >= version:
+                connection.rollback()
+                continue
+            if contract and applied:
+                connection.rollback()
+                break
+            func(connection)
+            connection.execute(text(f'PRAGMA user_version = {int(version)}'))
+            connection.commit()
+        applied.append((version, description))
+    return applied
+
+
+def pending_migrations():
+    """(version, description) of migrations not applied yet."""
+    with db.engine.connect() as connection:
+        current = get_schema_version(connection)
+    return [(version, description) for version, description, _, _ in MIGRATIONS if version > current]
+
+
+def has_legacy_service_columns(connection):
+    """Check whether `quotes` still has the wide per-service columns."""
+    return column_exists(connection, 'quotes', f'{LEGACY_SERVICE_KEYS[0]}_parts_cost')
+
+
+@migration(1, 'Full-text search index on quotes')
+def add_search_index(connection):
+    create_search_index(connection)
+    connection.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+
+@migration(2, 'Secondary indexes and stored grand_total on quotes')
+def add_indexes_and_grand_total(connection):
+    if not column_exists(connection, 'quotes', 'grand_total'):
+        connection.execute(text('ALTER TABLE quotes ADD COLUMN grand_total NUMERIC(10, 2) DEFAULT 0.00'))
+
+    # Backfill the stored total from the service columns
+    if has_legacy_service_columns(connection):
+        total_expr = ' + '.join(
+            f'COALESCE({key}_parts_cost, 0) + COALESCE({key}_labor_cost, 0)'
+            for key in LEGACY_SERVICE_KEYS
+        )
+        connection.execute(text(f'UPDATE quotes SET grand_total = ROUND({total_expr}, 2)'))
+
+    for column_name in ('date', 'date_delivered', 'stock_number', 'to_name', 'vehicle', 'grand_total'):
+        connection.execute(text(
+            f'CREATE INDEX IF NOT EXISTS ix_quotes_{column_name} ON quotes ({column_name})'
+        ))
+    connection.execute(text('ANALYZE quotes'))
+
+
+def _legacy_service_used(row, key):
+    """SQL condition: `row` (new/old or a table) has data in service `key`'s columns."""
+    return (f'({row}.{key}_photo_link IS NOT NULL OR COALESCE({row}.{key}_parts_cost, 0) != 0 '
+            f'OR COALESCE({row}.{key}_labor_cost, 0) != 0)')
+
+
+def _mirror_statements():
+    """SQL copying one quote's per-service columns (`new`) into its line items."""
+    statements = []
+    for key in LEGACY_SERVICE_KEYS:
+        statements.append(f"""
+            INSERT INTO quote_line_items (quote_id, service, photo_link, parts_cost, labor_cost)
+            SELECT new.id, '{key}', new.{key}_photo_link,
+                   COALESCE(new.{key}_parts_cost, 0), COALESCE(new.{key}_labor_cost, 0)
+            WHERE {_legacy_service_used('new', key)}
+            ON CONFLICT (quote_id, service) DO UPDATE SET
+                photo_link = excluded.photo_link,
+                parts_cost = excluded.parts_cost,
+                labor_cost = excluded.labor_cost;
+            DELETE FROM quote_line_items WHERE quote_id = new.id AND service = '{key}'
+                AND NOT {_legacy_service_used('new', key)};""")
+    statements.append("""
+            UPDATE quotes SET grand_total = (
+                SELECT ROUND(COALESCE(SUM(parts_cost + labor_cost), 0), 2)
+                FROM quote_line_items WHERE quote_id = new.id)
+            WHERE id = new.id;""")
+    return ''.join(statements)
+
+
+def create_legacy_mirror_triggers(connection):
+    """Mirror writes to the per-service columns into quote_line_items.
+
+    Workers still running the previous release write only those columns
+    until they restart; these triggers keep their writes until migration
+    11 drops the columns. Current code never writes the columns, so they
+    don't fire for it.
+    """
+    columns = ', '.join(f'{key}_{field}' for key in LEGACY_SERVICE_KEYS for field in LEGACY_SERVICE_FIELDS)
+    any_used = ' OR '.join(_legacy_service_used('new', key) for key in LEGACY_SERVICE_KEYS)
+    connection.execute(text(
+        f"""CREATE TRIGGER IF NOT EXISTS quotes_legacy_services_ai AFTER INSERT ON quotes
+            WHEN {any_used} BEGIN
+            {_mirror_statements()}
+        END"""
+    ))
+    connection.execute(text(
+        f"""CREATE TRIGGER IF NOT EXISTS quotes_legacy_services_au AFTER UPDATE OF {columns} ON quotes BEGIN
+            {_mirror_statements()}
+        END"""
+    ))
+
+
+@migration(3, 'Copy per-service columns into quote_line_items')
+def copy_services_to_line_items(connection):
+    if not has_legacy_service_columns(connection):
+        return
+
+    # Created before the copy, so nothing old workers write is missed
+    create_legacy_mirror_triggers(connection)
+    connection.commit()
+
+    # Copy in id-range batches, committing each, so readers and writers are
+    # only ever blocked for one batch. INSERT OR IGNORE makes reruns safe.
+    max_id = connection.execute(text('SELECT COALESCE(MAX(id), 0) FROM quotes')).scalar()
+    for start in range(0, max_id, MIGRATION_BATCH_SIZE):
+        for key in LEGACY_SERVICE_KEYS:
+            connection.execute(text(f"""
+                INSERT OR IGNORE INTO quote_line_items (quote_id, service, photo_link, parts_cost, labor_cost)
+                SELECT id, :service, {key}_photo_link,
+                       COALESCE({key}_parts_cost, 0), COALESCE({key}_labor_cost, 0)
+                FROM quotes
+                WHERE id > :start AND id <= :end
+                  AND ({key}_photo_link IS NOT NULL
+                       OR COALESCE({key}_parts_cost, 0) != 0
+                       OR COALESCE({key}_labor_cost, 0) != 0)
+            """), {'service': key, 'start': start, 'end': start + MIGRATION_BATCH_SIZE})
+        connection.commit()
+
+
+@migration(5, 'Xero sync columns on quotes')
+def add_xero_sync_columns(connection):
+    if not column_exists(connection, 'quotes', 'xero_quote_id'):
+        connection.execute(text('ALTER TABLE quotes ADD COLUMN xero_quote_id VARCHAR(50)'))
+    if not column_exists(connection, 'quotes', 'xero_synced_at'):
+        connection.execute(text('ALTER TABLE quotes ADD COLUMN xero_synced_at DATETIME'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_quotes_xero_quote_id ON quotes (xero_quote_id)'))
+
+
+@migration(6, 'Change tracking and Xero content hash on quotes')
+def add_change_tracking_columns(connection):
+    if not column_exists(connection, 'quotes', 'updated_at'):
+        connection.execute(text('ALTER TABLE quotes ADD COLUMN updated_at DATETIME'))
+        # Same text format SQLAlchemy writes, so updated_at compares equal on read-back
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+        connection.execute(text('UPDATE quotes SET updated_at = :now'), {'now': now})
+    if not column_exists(connection, 'quotes', 'xero_content_hash'):
+        connection.execute(text('ALTER TABLE quotes ADD COLUMN xero_content_hash VARCHAR(64)'))
+    if not column_exists(connection, 'quotes', 'xero_dirty'):
+        # Every existing quote starts dirty; unchanged ones already in Xero are
+        # updated once by QuoteID and then tracked by hash from there on
+        connection.execute(text('ALTER TABLE quotes ADD COLUMN xero_dirty BOOLEAN NOT NULL DEFAULT 1'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_quotes_xero_dirty ON quotes (xero_dirty)'))
+
+
+@migration(7, 'Image processing time on photo uploads')
+def add_photo_upload_processing_ms(connection):
+    if not column_exists(connection, 'photo_uploads', 'processing_ms'):
+        connection.execute(text('ALTER TABLE photo_uploads ADD COLUMN processing_ms FLOAT'))
+
+
+@migration(8, 'Chunked upload sizes on photo uploads')
+def add_photo_upload_chunk_columns(connection):
+    if not column_exists(connection, 'photo_uploads', 'size'):
+        connection.execute(text('ALTER TABLE photo_uploads ADD COLUMN size BIGINT'))
+    if not column_exists(connection, 'photo_uploads', 'chunk_size'):
+        connection.execute(text('ALTER TABLE photo_uploads ADD COLUMN chunk_size INTEGER'))
+
+
+@migration(9, 'Quote versions and the data version table for page caching')
+def add_quote_versions(connection):
+    if not column_exists(connection, 'quotes', 'version'):
+        connection.execute(text('ALTER TABLE quotes ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+    create_version_triggers(connection)
+
+
+@migration(10, 'Daily per-service revenue rollups')
+def add_revenue_rollups(connection):
+    create_rollups(connection)
+    fill_rollups(connection)
+
+
+# Old workers write the per-service columns until the deploy that ran
+# migration 3 restarts them, and migration 3's triggers copy those writes
+# into line items, so the columns and triggers go in a later upgrade
+@migration(11, 'Drop per-service columns from quotes', contract=True)
+def drop_legacy_service_columns(connection):
+    connection.execute(text('DROP TRIGGER IF EXISTS quotes_legacy_services_ai'))
+    connection.execute(text('DROP TRIGGER IF EXISTS quotes_legacy_services_au'))
+    for key in LEGACY_SERVICE_KEYS:
+        for field in LEGACY_SERVICE_FIELDS:
+            column_name = f'{key}_{field}'
+            if column_exists(connection, 'quotes', column_name):
+                connection.execute(text(f'ALTER TABLE quotes DROP COLUMN {column_name}'))
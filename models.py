@@ -1,90 +1,255 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
 from datetime import datetime
+from uuid import uuid4
 
 db = SQLAlchemy()
 
+# Services offered, as (key, display name) in display order.
+# Adding a service only needs a new entry here.
+SERVICES = [
+    ('headlights_resurfacing', 'Headlights Re-surfacing'),
+    ('headlights_ceramic', 'Headlights Ceramic Coating'),
+    ('trim_ceramic', 'Trim Ceramic Coating'),
+    ('car_wizard_diy', 'Car Wizard DIY Kit'),
+    ('carspa_sealant', 'Car Spa (Sealant)'),
+    ('carspa_ceramic', 'Car Spa (Plus Ceramic)'),
+    ('mechanical', 'Mechanical'),
+    ('glass', 'Glass'),
+    ('tint', 'Tint'),
+    ('misc', 'Misc'),
+]
+SERVICE_KEYS = [key for key, _ in SERVICES]
+SERVICE_NAMES = dict(SERVICES)
+
 class Quote(db.Model):
     __tablename__ = 'quotes'
-    
+
     id = db.Column(db.Integer, primary_key=True)
 
     # Base columns
     invoice_number = db.Column(db.String(50), nullable=False, unique=True)
-    date = db.Column(db.Date, nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
     date_promised = db.Column(db.Date)
-    date_delivered = db.Column(db.Date)
-    stock_number = db.Column(db.String(50))
-    to_name = db.Column(db.String(100))
+    date_delivered = db.Column(db.Date, index=True)
+    stock_number = db.Column(db.String(50), index=True)
+    to_name = db.Column(db.String(100), index=True)
     tag_number = db.Column(db.String(50))
     color = db.Column(db.String(50))
-    vehicle = db.Column(db.String(100))
+    vehicle = db.Column(db.String(100), index=True)
     instructions = db.Column(db.Text, nullable=True)
 
-    # Service columns - headlights_resurfacing
-    headlights_resurfacing_photo_link = db.Column(db.String(500))
-    headlights_resurfacing_parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    headlights_resurfacing_labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
-
-    # Service columns - headlights_ceramic
-    headlights_ceramic_photo_link = db.Column(db.String(500))
-    headlights_ceramic_parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    headlights_ceramic_labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
-
-    # Service columns - trim_ceramic
-    trim_ceramic_photo_link = db.Column(db.String(500))
-    trim_ceramic_parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    trim_ceramic_labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
-
-    # Service columns - car_wizard_diy
-    car_wizard_diy_photo_link = db.Column(db.String(500))
-    car_wizard_diy_parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    car_wizard_diy_labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
-
-    # Service columns - carspa_sealant
-    carspa_sealant_photo_link = db.Column(db.String(500))
-    carspa_sealant_parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    carspa_sealant_labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
-
-    # Service columns - carspa_ceramic
-    carspa_ceramic_photo_link = db.Column(db.String(500))
-    carspa_ceramic_parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    carspa_ceramic_labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
-
-    # Service columns - mechanical
-    mechanical_photo_link = db.Column(db.String(500))
-    mechanical_parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    mechanical_labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
-
-    # Service columns - glass
-    glass_photo_link = db.Column(db.String(500))
-    glass_parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    glass_labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
-
-    # Service columns - tint
-    tint_photo_link = db.Column(db.String(500))
-    tint_parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    tint_labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
-
-    # Service columns - misc
-    misc_photo_link = db.Column(db.String(500))
-    misc_parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    misc_labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
-    
+    # Stored sum of all service costs, maintained on every flush
+    grand_total = db.Column(db.Numeric(10, 2), default=0.00, index=True)
+
+    # Change tracking, maintained on every flush. updated_at moves when the
+    # content changes; version is bumped on any change, including Xero state.
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    # Xero sync state. xero_dirty is set whenever the quote's content changes
+    # and cleared once Xero holds the version whose hash is xero_content_hash.
+    xero_quote_id = db.Column(db.String(50), index=True)
+    xero_synced_at = db.Column(db.DateTime)
+    xero_content_hash = db.Column(db.String(64))
+    xero_dirty = db.Column(db.Boolean, nullable=False, default=True, server_default='1', index=True)
+
+    # Only the services actually used on this quote have a line item
+    line_items = db.relationship('QuoteLineItem', backref='quote', lazy='selectin',
+                                 cascade='all, delete-orphan')
+
+    def get_line_items(self):
+        """Line items in service display order"""
+        order = {key: i for i, key in enumerate(SERVICE_KEYS)}
+        return sorted(self.line_items, key=lambda item: order.get(item.service, len(order)))
+
+    def get_line_item(self, service_name):
+        """Get the line item for a service, or None if the service isn't used"""
+        for item in self.line_items:
+            if item.service == service_name:
+                return item
+        return None
+
+    def set_service(self, service_name, photo_link=None, parts_cost=0, labor_cost=0):
+        """Create, update or remove the line item for a service"""
+        item = self.get_line_item(service_name)
+        if not photo_link and not parts_cost and not labor_cost:
+            if item is not None:
+                self.line_items.remove(item)
+            return None
+
+        if item is None:
+            item = QuoteLineItem(service=service_name)
+            self.line_items.append(item)
+        item.photo_link = photo_link or None
+        item.parts_cost = parts_cost or 0
+        item.labor_cost = labor_cost or 0
+        return item
+
+    def service_form_data(self):
+        """Service values keyed by QuoteForm field name, for populating the form"""
+        data = {}
+        for item in self.line_items:
+            data[f'{item.service}_photo_link'] = item.photo_link
+            data[f'{item.service}_parts_cost'] = item.parts_cost
+            data[f'{item.service}_labor_cost'] = item.labor_cost
+        return data
+
     def get_service_total(self, service_name):
         """Calculate total for a specific service (parts + labor)"""
-        parts = getattr(self, f'{service_name}_parts_cost', 0) or 0
-        labor = getattr(self, f'{service_name}_labor_cost', 0) or 0
-        return float(parts) + float(labor)
-    
-    def get_grand_total(self):
+        item = self.get_line_item(service_name)
+        return item.get_total() if item is not None else 0.0
+
+    def compute_grand_total(self):
         """Calculate grand total across all services"""
-        services = ['headlights_resurfacing', 'headlights_ceramic', 'trim_ceramic',
-                    'car_wizard_diy', 'carspa_sealant', 'carspa_ceramic',
-                    'mechanical', 'glass', 'tint', 'misc']
-        total = 0.0
-        for service in services:
-            total += self.get_service_total(service)
-        return total
-    
+        return sum(item.get_total() for item in self.line_items)
+
+    def get_grand_total(self):
+        """Grand total across all services, using the stored column when set"""
+        if self.grand_total is not None:
+            return float(self.grand_total)
+        return self.compute_grand_total()
+
     def __repr__(self):
         return f'<Quote {self.invoice_number}>'
+
+class QuoteLineItem(db.Model):
+    __tablename__ = 'quote_line_items'
+    __table_args__ = (
+        db.UniqueConstraint('quote_id', 'service', name='uq_quote_line_items_quote_service'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    quote_id = db.Column(db.Integer, db.ForeignKey('quotes.id', ondelete='CASCADE'), nullable=False)
+    service = db.Column(db.String(50), nullable=False)
+    photo_link = db.Column(db.String(500))
+    parts_cost = db.Column(db.Numeric(10, 2), default=0.00)
+    labor_cost = db.Column(db.Numeric(10, 2), default=0.00)
+
+    def get_total(self):
+        """Parts + labor for this line item"""
+        return float(self.parts_cost or 0) + float(self.labor_cost or 0)
+
+    def __repr__(self):
+        return f'<QuoteLineItem {self.quote_id}:{self.service}>'
+
+class Job(db.Model):
+    """A unit of background work, stored in SQLite and run by the jobs worker"""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+        db.Index('ix_jobs_quote_kind', 'quote_id', 'kind'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    quote_id = db.Column(db.Integer, db.ForeignKey('quotes.id', ondelete='CASCADE'))
+    payload = db.Column(db.Text)
+
+    # queued -> running -> succeeded / failed (queued again between retries)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(100))
+    last_error = db.Column(db.Text)
+    result = db.Column(db.Text)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @property
+    def is_pending(self):
+        return self.status in ('queued', 'running')
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
+
+class PhotoUpload(db.Model):
+    """A photo upload in progress (background, direct or chunked), polled by the browser"""
+    __tablename__ = 'photo_uploads'
+
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid4().hex)
+    blob_name = db.Column(db.String(200), nullable=False)
+    content_type = db.Column(db.String(100))
+    url = db.Column(db.String(500))
+
+    # queued -> running -> succeeded / failed
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    error = db.Column(db.Text)
+    # Time spent converting the image server-side, if it was converted
+    processing_ms = db.Column(db.Float)
+    # Chunked uploads only: total bytes expected and bytes per chunk
+    size = db.Column(db.BigInteger)
+    chunk_size = db.Column(db.Integer)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @property
+    def chunk_count(self):
+        if not self.size or not self.chunk_size:
+            return 0
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, index):
+        """Exact byte length of a chunk of a chunked upload"""
+        if index < self.chunk_count - 1:
+            return self.chunk_size
+        return self.size - self.chunk_size * (self.chunk_count - 1)
+
+    def to_dict(self):
+        return {'id': self.id, 'status': self.status, 'url': self.url, 'error': self.error,
+                'processing_ms': self.processing_ms}
+
+    def __repr__(self):
+        return f'<PhotoUpload {self.id} {self.status}>'
+
+def quote_totals(quote_ids=None):
+    """Grand totals per quote id, computed with a single SQL aggregate"""
+    query = db.session.query(
+        QuoteLineItem.quote_id,
+        func.sum(func.coalesce(QuoteLineItem.parts_cost, 0) + func.coalesce(QuoteLineItem.labor_cost, 0)),
+    ).group_by(QuoteLineItem.quote_id)
+    if quote_ids is not None:
+        query = query.filter(QuoteLineItem.quote_id.in_(quote_ids))
+    return {quote_id: float(total or 0) for quote_id, total in query}
+
+# Quote columns that record state about the quote rather than its content
+TRACKING_FIELDS = {'grand_total', 'updated_at', 'version', 'xero_quote_id', 'xero_synced_at',
+                   'xero_content_hash', 'xero_dirty'}
+
+def _content_changed(quote):
+    """Whether a pending quote has changes beyond its tracking columns"""
+    state = inspect(quote)
+    if state.pending:
+        return True
+    for attr in state.attrs:
+        if attr.key not in TRACKING_FIELDS and attr.history.has_changes():
+            return True
+    return False
+
+@event.listens_for(Session, 'before_flush')
+def track_quote_changes(session, flush_context, instances):
+    """Keep each changed quote's grand_total and change tracking up to date"""
+    changed = set()
+    modified = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Quote):
+            if obj not in session.deleted and _content_changed(obj):
+                changed.add(obj)
+            elif obj in session.dirty and session.is_modified(obj):
+                modified.add(obj)
+        elif isinstance(obj, QuoteLineItem) and obj.quote is not None:
+            changed.add(obj.quote)
+    for quote in changed:
+        if quote not in session.deleted:
+            quote.grand_total = round(quote.compute_grand_total(), 2)
+            quote.updated_at = datetime.utcnow()
+            quote.xero_dirty = True
+    for quote in changed | modified:
+        if quote not in session.deleted and not inspect(quote).pending:
+            # Incremented in SQL so concurrent writers never reuse a version
+            quote.version = Quote.version + 1
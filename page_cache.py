@@ -0,0 +1,205 @@
+"""Conditional GET and an in-process cache of rendered pages.
+
+Pages are identified by an ETag built from the versions of the data they
+show: a quote's `version` column (bumped on every change to the quote or
+its line items) for quote pages, and the `quotes` row of `data_versions`
+(bumped by triggers on any insert, delete or listed-column update, from
+any code path) for the quote list. A browser that already has that
+version gets `304 Not Modified`; otherwise the rendered HTML is served
+from a bounded LRU cache, and only rendered on a miss.
+
+Pages carry a per-session CSRF token. The cached HTML holds a placeholder
+that is swapped for the current token on the way out, so the cache is
+keyed on the data versions alone and shared by every session; only the
+ETag sent to the browser also covers the session's token and its
+validity window.
+Pages with flashed messages are rendered fresh and never cached.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import current_app, make_response, request, session
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import text
+from werkzeug.http import is_resource_modified
+
+from models import db
+
+# Pages kept, and total bytes of HTML kept, per process
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 256))
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+VERSIONS_TABLE = 'data_versions'
+
+# Quote columns shown or filtered on in the quote list
+LISTED_COLUMNS = ['invoice_number', 'date', 'to_name', 'vehicle', 'stock_number', 'grand_total']
+
+CSRF_PLACEHOLDER = '__page_cache_csrf_token__'
+
+
+def _create_statements():
+    """SQL for the data version table and the triggers that bump it."""
+    bump = (f"UPDATE {VERSIONS_TABLE} SET version = version + 1, "
+            f"updated_at = CURRENT_TIMESTAMP WHERE name = 'quotes';")
+    return [
+        f"""CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (
+            name VARCHAR(50) PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME NOT NULL)""",
+        f"""INSERT OR IGNORE INTO {VERSIONS_TABLE} (name, version, updated_at)
+            VALUES ('quotes', 0, CURRENT_TIMESTAMP)""",
+        f"""CREATE TRIGGER IF NOT EXISTS {VERSIONS_TABLE}_quotes_ai AFTER INSERT ON quotes BEGIN
+            {bump}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {VERSIONS_TABLE}_quotes_ad AFTER DELETE ON quotes BEGIN
+            {bump}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {VERSIONS_TABLE}_quotes_au
+            AFTER UPDATE OF {', '.join(LISTED_COLUMNS)} ON quotes BEGIN
+            {bump}
+        END""",
+    ]
+
+
+def create_version_triggers(connection):
+    """Create the data version table and its triggers if they don't exist yet."""
+    for statement in _create_statements():
+        connection.execute(text(statement))
+
+
+def quotes_version():
+    """(version, updated_at) of the quote list as a whole."""
+    row = db.session.execute(
+        text(f"SELECT version, updated_at FROM {VERSIONS_TABLE} WHERE name = 'quotes'")
+    ).first()
+    if row is None:
+        return 0, None
+    return row.version, datetime.strptime(row.updated_at, '%Y-%m-%d %H:%M:%S')
+
+
+class ResponseCache:
+    """Rendered pages by key, each stored with the version it was rendered for.
+
+    Least recently used pages are evicted beyond max_entries or max_bytes.
+    A key holds one version at a time; storing a newer one replaces it.
+    """
+
+    def __init__(self, max_entries=PAGE_CACHE_MAX_ENTRIES, max_bytes=PAGE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, version, body):
+        size = len(body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (version, body)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, kind=None, ident=None):
+        """Drop pages by kind (the key's first element) and optionally ident."""
+        with self._lock:
+            for key in list(self._entries):
+                if kind is None or (key[0] == kind and (ident is None or key[1] == ident)):
+                    self._pop(key)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def __len__(self):
+        return len(self._entries)
+
+
+page_cache = ResponseCache()
+
+
+def invalidate_quote(quote_id):
+    """Drop the cached pages of a quote and the quote list."""
+    page_cache.invalidate('quote', quote_id)
+    page_cache.invalidate('index')
+
+
+_templates_digest = None
+
+
+def _template_digest():
+    """Hash of the templates, so a deploy that changes them changes every ETag."""
+    global _templates_digest
+    if _templates_digest is None:
+        sha = hashlib.sha256()
+        folder = os.path.join(current_app.root_path, current_app.template_folder)
+        for root, _, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as f:
+                    sha.update(name.encode() + f.read())
+        _templates_digest = sha.hexdigest()
+    return _templates_digest
+
+
+def _version(parts):
+    """Server-side version of a page: its data versions and the templates."""
+    return hashlib.sha256(repr((parts, _template_digest())).encode()).hexdigest()
+
+
+def _etag(version):
+    # The session's CSRF token is only valid for WTF_CSRF_TIME_LIMIT seconds,
+    # so a page is never revalidated past the window its token was made in
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+    field_name = current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+    raw = repr((version, session.get(field_name), int(time.time() // time_limit)))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def cached_page(key, parts, last_modified, render):
+    """Serve a GET page with ETag/Last-Modified, from the cache when possible.
+
+    `parts` are the data versions the page depends on; `render` returns the
+    page HTML and is only called when it isn't cached.
+    """
+    if session.get('_flashes'):
+        return render()
+
+    # Makes sure the session has its raw token before the ETag is built
+    token = generate_csrf()
+    version = _version(parts)
+    etag = _etag(version)
+    last_modified = last_modified.replace(microsecond=0) if last_modified else None
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response('', 304)
+    else:
+        body = page_cache.get(key, version)
+        if body is None:
+            body = render().replace(token, CSRF_PLACEHOLDER)
+            page_cache.set(key, version, body)
+        response = make_response(body.replace(CSRF_PLACEHOLDER, token))
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Always revalidate: the page is cheap to check and may change at any time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
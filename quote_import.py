@@ -0,0 +1,157 @@
+"""Bulk import of quotes from CSV.
+
+The CSV is read one row at a time and each row is checked with the same
+field rules as `QuoteForm`. Columns are named like the form fields (and
+like the columns of a quote export, so an export can be loaded back in);
+unknown columns are ignored.
+
+Valid rows are written IMPORT_BATCH_SIZE at a time, one transaction per
+batch, as an INSERT ... ON CONFLICT (invoice_number) DO UPDATE, so a
+quote that already exists is updated instead of duplicated. Its line
+items are replaced by the ones in the row. Invalid rows are reported with
+their line number and skipped without affecting the rest of the batch.
+"""
+import csv
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from wtforms.validators import DataRequired
+
+from forms import QuoteForm, BASE_FIELDS, QUOTE_FIELDS, validate_fields
+from models import db, Quote, QuoteLineItem, SERVICE_KEYS
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 2000))
+# Row errors kept in the result; later ones are only counted
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 1000))
+
+IMPORT_FIELDS = set(QUOTE_FIELDS)
+
+
+class RowValidator:
+    """Validates CSV rows with one reused QuoteForm.
+
+    Building a QuoteForm binds every field, which is most of the cost of
+    validating a row, so one form is bound up front. Each row then only
+    processes its non-empty fields plus the required ones: a blank
+    optional field always validates to None, so skipping it gives the same
+    result as running the whole form.
+    """
+
+    def __init__(self):
+        self.form = QuoteForm(formdata=None, meta={'csrf': False})
+        self.required = [field.name for field in self.form
+                         if any(isinstance(v, DataRequired) for v in field.validators)]
+
+    def validate(self, row):
+        """Returns (data, errors) for a CSV row; data maps field name to value."""
+        values = {name: value.strip() for name, value in row.items()
+                  if name in IMPORT_FIELDS and value and value.strip()}
+        # Required fields are checked even when blank, as a submitted form would be
+        return validate_fields(self.form, dict({name: '' for name in self.required}, **values))
+
+
+def _quote_values(data, now):
+    """Column values for the quotes table, with the grand total computed here."""
+    values = {name: data.get(name) for name in BASE_FIELDS}
+    line_items = []
+    for key in SERVICE_KEYS:
+        photo_link = data.get(f'{key}_photo_link')
+        parts_cost = data.get(f'{key}_parts_cost') or 0
+        labor_cost = data.get(f'{key}_labor_cost') or 0
+        # Same rule as Quote.set_service: unused services get no line item
+        if photo_link or parts_cost or labor_cost:
+            line_items.append({'service': key, 'photo_link': photo_link,
+                               'parts_cost': parts_cost, 'labor_cost': labor_cost})
+
+    values.update(grand_total=sum(i['parts_cost'] + i['labor_cost'] for i in line_items),
+                  updated_at=now, xero_dirty=True)
+    return values, line_items
+
+
+def _write_batch(batch):
+    """Upsert a batch of {invoice_number: (line, values, line_items)} in one
+    transaction. Returns the number of those quotes that already existed."""
+    existing = db.session.execute(
+        select(func.count(Quote.id)).where(Quote.invoice_number.in_(list(batch)))
+    ).scalar()
+
+    stmt = sqlite_insert(Quote.__table__)
+    update_values = {name: stmt.excluded[name]
+                     for name in BASE_FIELDS + ['grand_total', 'updated_at', 'xero_dirty']}
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Quote.invoice_number],
+        set_=dict(update_values, version=Quote.__table__.c.version + 1),
+    ).returning(Quote.id, Quote.invoice_number)
+    rows = db.session.execute(stmt, [values for _, values, _ in batch.values()])
+    ids = {number: quote_id for quote_id, number in rows}
+
+    # An updated quote's line items are replaced by the row's
+    db.session.execute(delete(QuoteLineItem).where(QuoteLineItem.quote_id.in_(list(ids.values()))))
+    line_items = [dict(item, quote_id=ids[number])
+                  for number, (_, _, items) in batch.items() for item in items]
+    if line_items:
+        db.session.execute(insert(QuoteLineItem), line_items)
+    db.session.commit()
+    return existing
+
+
+def _add_error(result, line, invoice_number, errors):
+    result['failed'] += 1
+    if len(result['errors']) < IMPORT_MAX_ERRORS:
+        result['errors'].append({'line': line, 'invoice_number': invoice_number or None,
+                                 'errors': errors})
+
+
+def _flush(batch, result):
+    """Write a batch, falling back to one row at a time if a constraint
+    fails so that only the offending rows are reported."""
+    try:
+        existing = _write_batch(batch)
+    except IntegrityError as e:
+        db.session.rollback()
+        if len(batch) == 1:
+            (number, (line, _, _)), = batch.items()
+            _add_error(result, line, number, {'database': [str(e.orig)]})
+            return
+        logger.warning('Import batch of %s rows failed, retrying row by row: %s', len(batch), e.orig)
+        for number, row in batch.items():
+            _flush({number: row}, result)
+        return
+    result['updated'] += existing
+    result['inserted'] += len(batch) - existing
+
+
+def import_quotes(lines, batch_size=IMPORT_BATCH_SIZE):
+    """Import quotes from an iterable of CSV lines (a text file, say).
+
+    Returns {'inserted', 'updated', 'failed', 'errors'}, where errors lists
+    {'line', 'invoice_number', 'errors'} for rows that were skipped. When an
+    invoice number appears more than once, the last row wins.
+    """
+    reader = csv.DictReader(lines)
+    validator = RowValidator()
+    result = {'inserted': 0, 'updated': 0, 'failed': 0, 'errors': []}
+
+    batch = {}
+    now = datetime.utcnow()
+    for row in reader:
+        data, errors = validator.validate(row)
+        if errors:
+            _add_error(result, reader.line_num, (row.get('invoice_number') or '').strip(), errors)
+            continue
+
+        values, line_items = _quote_values(data, now)
+        batch[values['invoice_number']] = (reader.line_num, values, line_items)
+        if len(batch) >= batch_size:
+            _flush(batch, result)
+            batch = {}
+            now = datetime.utcnow()
+    if batch:
+        _flush(batch, result)
+    return result
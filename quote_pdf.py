@@ -0,0 +1,451 @@
+"""Server-side PDF rendering of printed quotes.
+
+Quotes are laid out with a small pure-Python PDF writer using the standard
+Helvetica fonts, so nothing needs installing and no browser is involved.
+The layout follows `quote_print.html`.
+
+Rendering works on plain dicts (see `quote_print_data`) and runs in a
+process pool. Each quote's rendered pages are cached on disk under the
+hash of everything that goes on the page, so an unchanged quote is never
+rendered twice, and a PDF of many quotes is mostly assembled from the
+cache. Bump PDF_LAYOUT_VERSION when the layout changes to invalidate it.
+"""
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from io import BytesIO
+
+from PIL import Image
+from models import SERVICE_NAMES
+
+logger = logging.getLogger(__name__)
+
+# Worker processes per web process, and seconds to wait for a batch
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 2))
+PDF_RENDER_TIMEOUT = float(os.environ.get('PDF_RENDER_TIMEOUT', 120))
+# Most quotes allowed in one PDF
+PDF_BATCH_LIMIT = int(os.environ.get('PDF_BATCH_LIMIT', 500))
+# Where rendered pages are cached; set by init_app when not given
+PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR')
+
+PDF_LAYOUT_VERSION = 1
+
+LOGO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'car-icon.jpeg')
+
+# US Letter, in points
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792
+MARGIN = 50
+
+# Glyph widths (per 1000 units of font size) for characters 32-126
+_WIDTHS = {
+    'F1': [278, 278, 355, 556, 556, 889, 667, 222, 333, 333, 389, 584, 278, 333, 278, 278,
+           556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+           1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+           667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+           222, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+           556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584],
+    'F2': [278, 333, 474, 556, 556, 889, 722, 278, 333, 333, 389, 584, 278, 333, 278, 278,
+           556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+           975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+           667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+           278, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+           611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584],
+}
+FONTS = {'F1': 'Helvetica', 'F2': 'Helvetica-Bold'}
+
+DARK = (0.12, 0.16, 0.22)
+GRAY = (0.42, 0.45, 0.5)
+TEXT = (0.12, 0.16, 0.22)
+LIGHT = (0.98, 0.98, 0.98)
+RULE = (0.9, 0.91, 0.92)
+WHITE = (1, 1, 1)
+
+
+def _encode(text):
+    return str(text).encode('cp1252', 'replace')
+
+
+def text_width(text, font, size):
+    widths = _WIDTHS[font]
+    return sum(widths[b - 32] if 32 <= b <= 126 else 556 for b in _encode(text)) * size / 1000
+
+
+def _pdf_string(text):
+    out = bytearray(b'(')
+    for b in _encode(text):
+        if b in b'()\\':
+            out += b'\\' + bytes([b])
+        elif 32 <= b <= 126:
+            out.append(b)
+        else:
+            out += b'\\%03o' % b
+    return bytes(out + b')')
+
+
+def _wrap(text, font, size, width):
+    """Split text into lines no wider than width, keeping explicit line breaks."""
+    lines = []
+    for paragraph in str(text).splitlines() or ['']:
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = f'{line} {word}' if line else word
+            if line and text_width(candidate, font, size) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+class _Canvas:
+    """Content streams for the pages of one quote, top-down coordinates."""
+
+    def __init__(self):
+        self.pages = []
+        self.new_page()
+
+    def new_page(self):
+        self.ops = []
+        self.pages.append(self.ops)
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def ensure(self, height):
+        """Start a new page unless `height` points still fit on this one."""
+        if self.y - height < MARGIN:
+            self.new_page()
+
+    def text(self, x, y, text, font='F1', size=10, color=TEXT, align='left'):
+        if align == 'right':
+            x -= text_width(text, font, size)
+        self.ops.append(b'BT %.3f %.3f %.3f rg /%s %d Tf %.2f %.2f Td %s Tj ET'
+                        % (*color, font.encode(), size, x, y, _pdf_string(text)))
+
+    def rect(self, x, y, width, height, color):
+        self.ops.append(b'%.3f %.3f %.3f rg %.2f %.2f %.2f %.2f re f' % (*color, x, y, width, height))
+
+    def line(self, x1, y1, x2, y2, color=DARK, width=1):
+        self.ops.append(b'%.3f %.3f %.3f RG %.2f w %.2f %.2f m %.2f %.2f l S'
+                        % (*color, width, x1, y1, x2, y2))
+
+    def image(self, name, x, y, width, height):
+        self.ops.append(b'q %.2f 0 0 %.2f %.2f %.2f cm /%s Do Q' % (width, height, x, y, name.encode()))
+
+
+def _format_date(value):
+    return value.strftime('%B %d, %Y') if value else None
+
+
+def _money(value):
+    return f'${value:.2f}'
+
+
+def quote_print_data(quote):
+    """Everything printed for a quote, as a plain (picklable, hashable) dict."""
+    line_items = []
+    for item in quote.get_line_items():
+        parts_cost = float(item.parts_cost or 0)
+        labor_cost = float(item.labor_cost or 0)
+        # Same rule as quote_print.html: only services with a cost are printed
+        if parts_cost > 0 or labor_cost > 0:
+            line_items.append({
+                'service': SERVICE_NAMES.get(item.service, item.service),
+                'parts_cost': parts_cost,
+                'labor_cost': labor_cost,
+                'total': item.get_total(),
+            })
+
+    fields = [
+        ('To', quote.to_name),
+        ('Vehicle', quote.vehicle),
+        ('Stock #', quote.stock_number),
+        ('Tag #', quote.tag_number),
+        ('Color', quote.color),
+        ('Date Promised', _format_date(quote.date_promised)),
+        ('Date Delivered', _format_date(quote.date_delivered)),
+    ]
+    return {
+        'id': quote.id,
+        'invoice_number': quote.invoice_number,
+        'date': _format_date(quote.date) or '-',
+        'fields': [[label, value] for label, value in fields if value],
+        'instructions': quote.instructions,
+        'line_items': line_items,
+        'grand_total': quote.get_grand_total(),
+    }
+
+
+def content_key(data):
+    """Cache key for a quote's pages: the hash of what is printed and the layout version."""
+    raw = json.dumps([PDF_LAYOUT_VERSION, data], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def render_quote_pages(data):
+    """Lay out one quote. Runs in a worker process.
+
+    Returns a list of zlib-compressed page content streams.
+    """
+    canvas = _Canvas()
+    left, right = MARGIN, PAGE_WIDTH - MARGIN
+
+    # Header: logo and name on the left, invoice number and date on the right
+    top = canvas.y
+    canvas.image('Logo', left, top - 40, 65, 40)
+    canvas.text(left + 75, top - 27, 'Car Tracker', 'F2', 18)
+    canvas.text(right, top - 18, f"Invoice #{data['invoice_number']}", 'F2', 18, align='right')
+    canvas.text(right, top - 34, f"Date: {data['date']}", 'F1', 10, GRAY, align='right')
+    canvas.y = top - 55
+    canvas.line(left, canvas.y, right, canvas.y, DARK, 2)
+    canvas.y -= 28
+
+    # Info grid, two columns
+    column = (right - left) / 2
+    for i, (label, value) in enumerate(data['fields']):
+        x = left + (i % 2) * column
+        canvas.text(x, canvas.y, label.upper(), 'F2', 7, GRAY)
+        canvas.text(x, canvas.y - 13, value, 'F1', 10)
+        if i % 2 == 1 or i == len(data['fields']) - 1:
+            canvas.y -= 32
+
+    if data['instructions']:
+        lines = _wrap(data['instructions'], 'F1', 9, right - left - 24)
+        canvas.y -= 4
+        canvas.text(left + 12, canvas.y, 'INSTRUCTIONS', 'F2', 7, GRAY)
+        canvas.y -= 14
+        for line in lines:
+            canvas.ensure(12)
+            canvas.text(left + 12, canvas.y, line, 'F1', 9)
+            canvas.y -= 12
+        canvas.y -= 14
+
+    # Services table
+    amounts = [right - 210, right - 105, right - 12]
+
+    def table_header():
+        canvas.rect(left, canvas.y - 26, right - left, 26, DARK)
+        for x, heading in zip([left + 12] + amounts, ['Service', 'Parts ($)', 'Labor ($)', 'Total']):
+            canvas.text(x, canvas.y - 17, heading, 'F2', 9, WHITE,
+                        align='left' if heading == 'Service' else 'right')
+        canvas.y -= 26
+
+    canvas.ensure(26 + 24)
+    table_header()
+    for i, item in enumerate(data['line_items']):
+        if canvas.y - 24 < MARGIN:
+            canvas.new_page()
+            table_header()
+        if i % 2:
+            canvas.rect(left, canvas.y - 24, right - left, 24, LIGHT)
+        canvas.line(left, canvas.y - 24, right, canvas.y - 24, RULE, 0.5)
+        canvas.text(left + 12, canvas.y - 16, item['service'], 'F2', 9)
+        canvas.text(amounts[0], canvas.y - 16,
+                    _money(item['parts_cost']) if item['parts_cost'] > 0 else '-', 'F1', 9, align='right')
+        canvas.text(amounts[1], canvas.y - 16,
+                    _money(item['labor_cost']) if item['labor_cost'] > 0 else '-', 'F1', 9, align='right')
+        canvas.text(amounts[2], canvas.y - 16, _money(item['total']), 'F2', 9, align='right')
+        canvas.y -= 24
+
+    canvas.ensure(32)
+    canvas.rect(left, canvas.y - 32, right - left, 32, DARK)
+    canvas.text(amounts[1], canvas.y - 20, 'GRAND TOTAL', 'F2', 10, WHITE, align='right')
+    canvas.text(amounts[2], canvas.y - 21, _money(data['grand_total']), 'F2', 14, WHITE, align='right')
+
+    return [zlib.compress(b'\n'.join(ops)) for ops in canvas.pages]
+
+
+@lru_cache(maxsize=1)
+def _logo():
+    """The logo JPEG and its pixel size, or None if it is missing."""
+    try:
+        with open(LOGO_PATH, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    with Image.open(BytesIO(data)) as image:
+        return data, image.size
+
+
+def build_pdf(pages, title='Quotes'):
+    """Assemble compressed page content streams into one PDF document."""
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(None)
+    page_tree = add(None)
+    fonts = {name: add(b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>'
+                       % base.encode()) for name, base in FONTS.items()}
+    info = add(b'<< /Title %s /Producer (oneshot quote_pdf) >>' % _pdf_string(title))
+
+    xobjects = b''
+    logo = _logo()
+    if logo:
+        data, (width, height) = logo
+        image = add(b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB '
+                    b'/BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n%s\nendstream'
+                    % (width, height, len(data), data))
+        xobjects = b' /XObject << /Logo %d 0 R >>' % image
+    font_refs = b' '.join(b'/%s %d 0 R' % (name.encode(), ref) for name, ref in fonts.items())
+    resources = b'<< /Font << %s >>%s >>' % (font_refs, xobjects)
+
+    kids = []
+    for stream in pages:
+        content = add(b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (len(stream), stream))
+        kids.append(add(b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] /Resources %s /Contents %d 0 R >>'
+                        % (page_tree, PAGE_WIDTH, PAGE_HEIGHT, resources, content)))
+
+    objects[catalog - 1] = b'<< /Type /Catalog /Pages %d 0 R >>' % page_tree
+    objects[page_tree - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % kid for kid in kids), len(kids))
+
+    out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+        len(objects) + 1, catalog, info, xref)
+    return bytes(out)
+
+
+def init_app(app):
+    """Default the page cache to the app's instance folder."""
+    global PDF_CACHE_DIR
+    if not PDF_CACHE_DIR:
+        PDF_CACHE_DIR = os.path.join(app.instance_path, 'pdf_cache')
+
+
+def _cache_path(quote_id, key):
+    return os.path.join(PDF_CACHE_DIR, f'{quote_id}-{key[:32]}.pages')
+
+
+def _read_cache(quote_id, key):
+    try:
+        with open(_cache_path(quote_id, key), 'rb') as f:
+            raw = f.read()
+    except OSError:
+        return None
+    pages, offset = [], 0
+    while offset < len(raw):
+        (length,) = struct.unpack_from('>I', raw, offset)
+        pages.append(raw[offset + 4:offset + 4 + length])
+        offset += 4 + length
+    return pages
+
+
+def _write_cache(quote_id, key, pages):
+    """Store a quote's pages, replacing any older version of them."""
+    os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    path = _cache_path(quote_id, key)
+    for old in glob.glob(os.path.join(PDF_CACHE_DIR, f'{quote_id}-*.pages')):
+        if old != path:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    # Write then rename, so readers never see a partial file
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        for page in pages:
+            f.write(struct.pack('>I', len(page)))
+            f.write(page)
+    os.replace(tmp, path)
+
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _lock:
+            if _executor is None or _executor_pid != os.getpid():
+                # Spawn, not fork: the web process has threads and open sockets
+                context = multiprocessing.get_context('spawn')
+                _executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=context)
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def _discard_executor(executor):
+    """Drop a broken pool (a worker died) so the next render starts a fresh one."""
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def quotes_pdf(quotes, title='Quotes'):
+    """Render quotes, in order, into one PDF. Returns (pdf_bytes, info).
+
+    Cached pages are reused; the rest are rendered in the worker pool and
+    cached. info holds the quote, page and cache-hit counts and timings.
+    Raises TimeoutError if rendering takes longer than PDF_RENDER_TIMEOUT
+    and BrokenProcessPool if a worker died, in which case the pool is
+    replaced for the next call.
+    """
+    started = time.perf_counter()
+    entries = []
+    missing = {}
+    for quote in quotes:
+        data = quote_print_data(quote)
+        key = content_key(data)
+        pages = _read_cache(quote.id, key)
+        entries.append((quote.id, key, pages))
+        if pages is None:
+            missing[(quote.id, key)] = data
+
+    if missing:
+        executor = _get_executor()
+        futures = {}
+        try:
+            for k, data in missing.items():
+                futures[k] = executor.submit(render_quote_pages, data)
+            deadline = time.monotonic() + PDF_RENDER_TIMEOUT
+            rendered = {k: future.result(timeout=max(0, deadline - time.monotonic()))
+                        for k, future in futures.items()}
+        except BrokenProcessPool:
+            _discard_executor(executor)
+            raise
+        except TimeoutError:
+            # Leave the pool to the renders already running, not the whole batch
+            for future in futures.values():
+                future.cancel()
+            raise
+        for (quote_id, key), pages in rendered.items():
+            _write_cache(quote_id, key, pages)
+        entries = [(quote_id, key, pages if pages is not None else rendered[(quote_id, key)])
+                   for quote_id, key, pages in entries]
+
+    pdf = build_pdf([page for _, _, pages in entries for page in pages], title=title)
+    info = {
+        'quotes': len(entries),
+        'pages': sum(len(pages) for _, _, pages in entries),
+        'rendered': len(missing),
+        'cached': len(entries) - len(missing),
+        'bytes': len(pdf),
+        'total_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+    logger.info('quotes_pdf: %s quotes, %s pages (%s rendered, %s cached), %s bytes in %sms',
+                info['quotes'], info['pages'], info['rendered'], info['cached'],
+                info['bytes'], info['total_ms'])
+    return pdf, info
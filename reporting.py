@@ -0,0 +1,217 @@
+"""Revenue reports from per-day, per-service rollups of quote line items.
+
+`service_daily_rollups` holds one row per quote date and service with the
+number of quotes using the service and their parts and labor totals in
+integer cents, so sums stay exact however often a row is adjusted.
+Triggers on `quotes` and `quote_line_items` adjust the affected rows on
+every insert, update and delete, whichever code path made the change, and
+`rebuild_rollups()` recomputes the table from scratch.
+
+Reports read only the rollups, so their cost depends on the number of
+days and services in the range, not on the number of quotes. A quote has
+at most one line item per service, so a service's quote count is its
+number of line items; summed across services it counts line items, not
+distinct quotes, and reports label it so.
+"""
+from datetime import date
+
+from sqlalchemy import text
+from models import db, SERVICE_KEYS
+
+ROLLUP_TABLE = 'service_daily_rollups'
+
+# Report periods and the strftime format that buckets days into them
+PERIODS = {
+    'day': '%Y-%m-%d',
+    'month': '%Y-%m',
+    'year': '%Y',
+}
+
+
+def _cents(value):
+    return f'CAST(ROUND(COALESCE({value}, 0) * 100) AS INTEGER)'
+
+
+def _add(rows):
+    """SQL adding `rows` (day, service, parts_cents, labor_cents) to the rollups."""
+    return f"""INSERT INTO {ROLLUP_TABLE} (day, service, quote_count, parts_cents, labor_cents)
+            SELECT day, service, count(*), sum(parts_cents), sum(labor_cents)
+            FROM ({rows}) GROUP BY day, service
+            ON CONFLICT (day, service) DO UPDATE SET
+                quote_count = quote_count + excluded.quote_count,
+                parts_cents = parts_cents + excluded.parts_cents,
+                labor_cents = labor_cents + excluded.labor_cents;"""
+
+
+def _subtract(rows):
+    """SQL taking `rows` back out of the rollups, dropping rows left empty."""
+    return f"""UPDATE {ROLLUP_TABLE} SET
+                quote_count = quote_count - r.n,
+                parts_cents = parts_cents - r.parts,
+                labor_cents = labor_cents - r.labor
+            FROM (SELECT day, service, count(*) AS n, sum(parts_cents) AS parts,
+                         sum(labor_cents) AS labor
+                  FROM ({rows}) GROUP BY day, service) AS r
+            WHERE {ROLLUP_TABLE}.day = r.day AND {ROLLUP_TABLE}.service = r.service;
+            DELETE FROM {ROLLUP_TABLE} WHERE quote_count <= 0
+                AND (day, service) IN (SELECT day, service FROM ({rows}));"""
+
+
+def _item_row(item):
+    """Rollup row of one line item (`new` or `old`), dated by its quote."""
+    return (f'SELECT q.date AS day, {item}.service AS service, '
+            f'{_cents(f"{item}.parts_cost")} AS parts_cents, '
+            f'{_cents(f"{item}.labor_cost")} AS labor_cents '
+            f'FROM quotes q WHERE q.id = {item}.quote_id')
+
+
+def _quote_rows(day, quote_id):
+    """Rollup rows of every line item of a quote, dated `day`."""
+    return (f'SELECT {day} AS day, service, {_cents("parts_cost")} AS parts_cents, '
+            f'{_cents("labor_cost")} AS labor_cents '
+            f'FROM quote_line_items WHERE quote_id = {quote_id}')
+
+
+def _create_statements():
+    """SQL for the rollup table and the triggers that keep it up to date."""
+    return [
+        f"""CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+            day DATE NOT NULL,
+            service VARCHAR(50) NOT NULL,
+            quote_count INTEGER NOT NULL DEFAULT 0,
+            parts_cents INTEGER NOT NULL DEFAULT 0,
+            labor_cents INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, service))""",
+        f"""CREATE INDEX IF NOT EXISTS ix_{ROLLUP_TABLE}_service_day
+            ON {ROLLUP_TABLE} (service, day)""",
+        f"""CREATE TRIGGER IF NOT EXISTS {ROLLUP_TABLE}_items_ai AFTER INSERT ON quote_line_items BEGIN
+            {_add(_item_row('new'))}
+        END""",
+        # Line items deleted by the quotes foreign key cascade find no quote
+        # here; the quote's BEFORE DELETE trigger has already taken them out
+        f"""CREATE TRIGGER IF NOT EXISTS {ROLLUP_TABLE}_items_ad AFTER DELETE ON quote_line_items BEGIN
+            {_subtract(_item_row('old'))}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {ROLLUP_TABLE}_items_au
+            AFTER UPDATE OF quote_id, service, parts_cost, labor_cost ON quote_line_items BEGIN
+            {_subtract(_item_row('old'))}
+            {_add(_item_row('new'))}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {ROLLUP_TABLE}_quotes_bd BEFORE DELETE ON quotes BEGIN
+            {_subtract(_quote_rows('old.date', 'old.id'))}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {ROLLUP_TABLE}_quotes_au AFTER UPDATE OF date ON quotes
+            WHEN old.date IS NOT new.date BEGIN
+            {_subtract(_quote_rows('old.date', 'old.id'))}
+            {_add(_quote_rows('new.date', 'new.id'))}
+        END""",
+    ]
+
+
+def create_rollups(connection):
+    """Create the rollup table and its triggers if they don't exist yet."""
+    for statement in _create_statements():
+        connection.execute(text(statement))
+
+
+def fill_rollups(connection):
+    """Replace the rollups with totals recomputed from the line items."""
+    connection.execute(text(f'DELETE FROM {ROLLUP_TABLE}'))
+    connection.execute(text(
+        f"""INSERT INTO {ROLLUP_TABLE} (day, service, quote_count, parts_cents, labor_cents)
+            SELECT q.date, li.service, count(*),
+                   sum({_cents('li.parts_cost')}), sum({_cents('li.labor_cost')})
+            FROM quote_line_items li JOIN quotes q ON q.id = li.quote_id
+            GROUP BY q.date, li.service"""
+    ))
+
+
+def rebuild_rollups():
+    """Recompute every rollup row from `quotes` in one transaction.
+
+    Returns the number of rollup rows written.
+    """
+    with db.engine.begin() as connection:
+        create_rollups(connection)
+        fill_rollups(connection)
+        return connection.execute(text(f'SELECT count(*) FROM {ROLLUP_TABLE}')).scalar()
+
+
+def _filters(date_from=None, date_to=None, services=None):
+    clauses, params = [], {}
+    if date_from:
+        clauses.append('day >= :date_from')
+        params['date_from'] = date_from.isoformat()
+    if date_to:
+        clauses.append('day <= :date_to')
+        params['date_to'] = date_to.isoformat()
+    if services:
+        names = [f'service_{i}' for i in range(len(services))]
+        clauses.append(f"service IN ({', '.join(':' + name for name in names)})")
+        params.update(zip(names, services))
+    return ' AND '.join(clauses) or '1', params
+
+
+def _totals(row):
+    parts = row['parts_cents'] / 100
+    labor = row['labor_cents'] / 100
+    return {'line_items': row['line_items'], 'parts': parts, 'labor': labor,
+            'total': round(parts + labor, 2)}
+
+
+def revenue_report(date_from=None, date_to=None, services=None, period='month'):
+    """Parts and labor revenue per period and service for a date range.
+
+    Returns {'periods': [{'period', 'services': {key: totals}, 'totals'}],
+    'services': {key: totals}, 'totals': totals}, where totals are
+    {'line_items', 'parts', 'labor', 'total'}. Periods are newest first.
+    """
+    where, params = _filters(date_from, date_to, services)
+    params['format'] = PERIODS[period]
+    rows = db.session.execute(text(
+        f"""SELECT strftime(:format, day) AS period, service, sum(quote_count) AS line_items,
+                   sum(parts_cents) AS parts_cents, sum(labor_cents) AS labor_cents
+            FROM {ROLLUP_TABLE}
+            WHERE {where}
+            GROUP BY period, service
+            ORDER BY period DESC"""
+    ), params).mappings().all()
+
+    order = {key: i for i, key in enumerate(SERVICE_KEYS)}
+    periods, by_service = {}, {}
+    grand = {'line_items': 0, 'parts_cents': 0, 'labor_cents': 0}
+    for row in rows:
+        periods.setdefault(row['period'], []).append(row)
+        service = by_service.setdefault(row['service'], dict.fromkeys(grand, 0))
+        for name in grand:
+            service[name] += row[name]
+            grand[name] += row[name]
+
+    def summarize(service_rows):
+        sums = {name: sum(r[name] for r in service_rows) for name in grand}
+        return {'services': {r['service']: _totals(r) for r in
+                             sorted(service_rows, key=lambda r: order.get(r['service'], len(order)))},
+                'totals': _totals(sums)}
+
+    return {
+        'periods': [dict(period=name, **summarize(service_rows))
+                    for name, service_rows in periods.items()],
+        'services': {key: _totals(sums) for key, sums in
+                     sorted(by_service.items(), key=lambda s: order.get(s[0], len(order)))},
+        'totals': _totals(grand),
+    }
+
+
+def parse_report_args(args):
+    """(date_from, date_to, services, period) from request args, ignoring bad values."""
+    def parse_date(value):
+        try:
+            return date.fromisoformat(value) if value else None
+        except ValueError:
+            return None
+
+    services = [key for key in args.getlist('service') if key in SERVICE_KEYS]
+    period = args.get('period', 'month')
+    if period not in PERIODS:
+        period = 'month'
+    return parse_date(args.get('date_from')), parse_date(args.get('date_to')), services, period
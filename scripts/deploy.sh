@@ -1,6 +1,13 @@
+set -e
 cd /var/www/oneshotauto/oneshotauto
 git pull
 source .venv/bin/activate
 pip install -r requirements.txt
+# The CSS bundle is built on the server (static/dist is not in git) and needs node
+command -v npm >/dev/null || { sudo apt-get update && sudo apt-get install -y nodejs npm; }
+npm ci
+flask --app app assets-build
+flask --app app db-upgrade
 sudo systemctl restart myproject
-sudo systemctl restart nginx
\ No newline at end of file
+sudo systemctl restart myproject-worker
+sudo systemctl restart nginx
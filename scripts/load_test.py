@@ -0,0 +1,147 @@
+"""Concurrent read/write load test for the SQLite configuration.
+
+Runs the same mixed workload twice against a scratch database: once with
+SQLAlchemy's stock SQLite settings (rollback journal) and once with the
+settings from sqlite_config (WAL, pragmas, pooling). Readers run the index
+listing query, writers insert a quote with line items and update another,
+each in its own process, like gunicorn workers.
+
+Usage:
+    python scripts/load_test.py [--readers 4] [--writers 2] [--seconds 10] [--rows 20000]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from models import db
+from search import create_search_index
+from sqlite_config import sqlite_engine_options, apply_sqlite_pragmas
+
+READ_SQL = text("""
+    SELECT id, invoice_number, date, to_name, vehicle FROM quotes
+    WHERE date <= :before ORDER BY date DESC, id DESC LIMIT 50
+""")
+
+
+def make_engine(uri, tuned):
+    """Engine with either stock or tuned SQLite settings."""
+    if not tuned:
+        return create_engine(uri)
+    engine = create_engine(uri, **sqlite_engine_options(uri))
+    event.listen(engine, 'connect', apply_sqlite_pragmas)
+    return engine
+
+
+def seed(uri, rows):
+    """Create the schema and fill it with random quotes."""
+    engine = create_engine(uri)
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        create_search_index(connection)
+        connection.execute(text("""
+            INSERT INTO quotes (invoice_number, date, vehicle, to_name, grand_total)
+            VALUES (:invoice_number, :date, :vehicle, :to_name, :grand_total)
+        """), [{
+            'invoice_number': f'SEED-{i}',
+            'date': date(2020, 1, 1) + timedelta(days=i % 1500),
+            'vehicle': f'Vehicle {i}',
+            'to_name': f'Dealer {i % 50}',
+            'grand_total': 0,
+        } for i in range(rows)])
+    engine.dispose()
+
+
+def reader(uri, tuned, seconds, results):
+    engine = make_engine(uri, tuned)
+    ops = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            with engine.connect() as connection:
+                before = date(2020, 1, 1) + timedelta(days=random.randint(0, 1500))
+                connection.execute(READ_SQL, {'before': before}).all()
+            ops += 1
+        except OperationalError:
+            errors += 1
+    results.put(('read', ops, errors))
+
+
+def writer(uri, tuned, seconds, worker_id, results):
+    engine = make_engine(uri, tuned)
+    ops = errors = 0
+    deadline = time.monotonic() + seconds
+    n = 0
+    while time.monotonic() < deadline:
+        n += 1
+        try:
+            with engine.begin() as connection:
+                quote_id = connection.execute(text("""
+                    INSERT INTO quotes (invoice_number, date, vehicle, grand_total)
+                    VALUES (:invoice_number, :date, :vehicle, 30)
+                """), {'invoice_number': f'LOAD-{worker_id}-{n}-{tuned}',
+                       'date': date.today(), 'vehicle': 'Load Test'}).lastrowid
+                connection.execute(text("""
+                    INSERT INTO quote_line_items (quote_id, service, parts_cost, labor_cost)
+                    VALUES (:quote_id, :service, 10, 5)
+                """), [{'quote_id': quote_id, 'service': 'glass'},
+                       {'quote_id': quote_id, 'service': 'tint'}])
+                connection.execute(text('UPDATE quotes SET to_name = :name WHERE id = :id'),
+                                   {'name': f'Writer {worker_id}', 'id': random.randint(1, quote_id)})
+            ops += 1
+        except OperationalError:
+            errors += 1
+    results.put(('write', ops, errors))
+
+
+def run(label, tuned, args):
+    """Run one workload and return (reads/s, writes/s, read errors, write errors)."""
+    workdir = tempfile.mkdtemp(prefix='oneshot-load-')
+    uri = f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    seed(uri, args.rows)
+
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=reader, args=(uri, tuned, args.seconds, results))
+             for _ in range(args.readers)]
+    procs += [multiprocessing.Process(target=writer, args=(uri, tuned, args.seconds, i, results))
+              for i in range(args.writers)]
+    for proc in procs:
+        proc.start()
+    totals = {'read': [0, 0], 'write': [0, 0]}
+    for _ in procs:
+        kind, ops, errors = results.get()
+        totals[kind][0] += ops
+        totals[kind][1] += errors
+    for proc in procs:
+        proc.join()
+
+    reads, read_errors = totals['read']
+    writes, write_errors = totals['write']
+    print(f"{label:<10} {reads / args.seconds:>10.1f} {writes / args.seconds:>10.1f} "
+          f"{read_errors:>12} {write_errors:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--rows', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{args.readers} readers, {args.writers} writers, {args.seconds}s, {args.rows} seeded rows")
+    print(f"{'mode':<10} {'reads/s':>10} {'writes/s':>10} {'read errors':>12} {'write errors':>12}")
+    run('default', False, args)
+    run('tuned', True, args)
+
+
+if __name__ == '__main__':
+    main()
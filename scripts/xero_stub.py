@@ -0,0 +1,144 @@
+"""Local stub of the Xero token endpoint and Quotes API, for testing syncs.
+
+Quotes are kept in memory. POST /Quotes creates a quote per array element
+(or updates one when its QuoteID is given) and answers per element like
+Xero does with summarizeErrors=false, so partial failures can be exercised.
+
+Usage:
+    python scripts/xero_stub.py [--port 5055] [--reject PREFIX] [--rate-limit 60]
+
+Then point the app at it:
+    XERO_TOKEN_URL=http://127.0.0.1:5055/connect/token
+    XERO_API_BASE=http://127.0.0.1:5055/api.xro/2.0
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+API_PREFIX = '/api.xro/2.0'
+
+quotes = {}
+quote_numbers = {}
+request_times = []
+lock = threading.Lock()
+
+
+class XeroStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    reject_prefix = None
+    rate_limit = 60
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _check_rate_limit(self):
+        """Apply a rolling per-minute limit. Returns the remaining calls or None if exceeded."""
+        now = time.monotonic()
+        with lock:
+            request_times[:] = [t for t in request_times if now - t < 60]
+            if len(request_times) >= self.rate_limit:
+                retry_after = int(60 - (now - request_times[0])) + 1
+                self._send_json(429, {'Message': 'Rate limit exceeded'},
+                                {'Retry-After': retry_after, 'X-Rate-Limit-Problem': 'minute'})
+                return None
+            request_times.append(now)
+            return self.rate_limit - len(request_times)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._read_body()
+
+        if path == '/connect/token':
+            self._send_json(200, {
+                'access_token': f'stub-access-{uuid.uuid4().hex}',
+                'refresh_token': f'stub-refresh-{uuid.uuid4().hex}',
+                'expires_in': 1800,
+                'token_type': 'Bearer',
+            })
+            return
+
+        if path != f'{API_PREFIX}/Quotes':
+            self._send_json(404, {'Message': 'Not found'})
+            return
+
+        remaining = self._check_rate_limit()
+        if remaining is None:
+            return
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self._send_json(401, {'Message': 'Unauthorized'})
+            return
+
+        summarize = parse_qs(urlparse(self.path).query).get('summarizeErrors', ['true'])[0] != 'false'
+        results = []
+        with lock:
+            for item in json.loads(body or b'{}').get('Quotes', []):
+                results.append(self._save_quote(item))
+        has_errors = any(r.get('HasErrors') for r in results)
+        headers = {'X-MinLimit-Remaining': remaining, 'X-DayLimit-Remaining': 5000}
+        if has_errors and summarize:
+            self._send_json(400, {'Message': 'A validation exception occurred', 'Elements': results}, headers)
+        else:
+            self._send_json(200, {'Quotes': results}, headers)
+
+    def _save_quote(self, item):
+        number = item.get('QuoteNumber')
+        errors = []
+        if not item.get('Contact', {}).get('ContactID'):
+            errors.append({'Message': 'A Contact must be specified'})
+        if self.reject_prefix and number and number.startswith(self.reject_prefix):
+            errors.append({'Message': f'Quote number {number} rejected by stub'})
+
+        quote_id = item.get('QuoteID')
+        if quote_id and quote_id not in quotes:
+            errors.append({'Message': f'Quote {quote_id} not found'})
+        elif not quote_id and number in quote_numbers:
+            errors.append({'Message': 'Quote number must be unique'})
+
+        if errors:
+            return dict(item, HasErrors=True, StatusAttributeString='ERROR', ValidationErrors=errors)
+
+        quote_id = quote_id or str(uuid.uuid4())
+        stored = dict(item, QuoteID=quote_id, Status='DRAFT', StatusAttributeString='OK')
+        quotes[quote_id] = stored
+        quote_numbers[number] = quote_id
+        return stored
+
+    def do_GET(self):
+        if urlparse(self.path).path != f'{API_PREFIX}/Quotes':
+            self._send_json(404, {'Message': 'Not found'})
+            return
+        with lock:
+            self._send_json(200, {'Quotes': list(quotes.values())})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Xero stub server')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--reject', default=None, help='Reject quotes whose QuoteNumber starts with this prefix.')
+    parser.add_argument('--rate-limit', type=int, default=60, help='Calls allowed per rolling minute.')
+    args = parser.parse_args()
+
+    XeroStubHandler.reject_prefix = args.reject
+    XeroStubHandler.rate_limit = args.rate_limit
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), XeroStubHandler)
+    print(f'Xero stub listening on http://127.0.0.1:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
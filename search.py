@@ -0,0 +1,147 @@
+"""Full-text search over quotes backed by an SQLite FTS5 index.
+
+The index is an external-content FTS5 table over the searchable `quotes`
+columns. Triggers on `quotes` keep it in sync with every insert, update and
+delete, whichever code path made the change. The trigram tokenizer lets
+MATCH answer substring searches from the index instead of a table scan.
+"""
+from sqlalchemy import text, column
+from models import db, Quote
+
+FTS_TABLE = 'quotes_fts'
+
+# Columns copied into the search index
+SEARCH_COLUMNS = ['invoice_number', 'vehicle', 'stock_number', 'to_name']
+
+# The trigram tokenizer cannot match terms shorter than three characters
+MIN_TRIGRAM_LENGTH = 3
+
+_index_ready = False
+
+
+def _create_statements():
+    """SQL for the FTS table and the triggers that keep it in sync."""
+    cols = ', '.join(SEARCH_COLUMNS)
+    new_values = ', '.join(f'new.{c}' for c in SEARCH_COLUMNS)
+    old_values = ', '.join(f'old.{c}' for c in SEARCH_COLUMNS)
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+            {cols}, content='quotes', content_rowid='id', tokenize='trigram')""",
+        f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON quotes BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, {cols}) VALUES (new.id, {new_values});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON quotes BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF {cols} ON quotes BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO {FTS_TABLE}(rowid, {cols}) VALUES (new.id, {new_values});
+        END""",
+    ]
+
+
+def create_search_index(connection):
+    """Create the FTS table and sync triggers if they don't exist yet."""
+    for statement in _create_statements():
+        connection.execute(text(statement))
+
+
+def rebuild_search_index():
+    """Drop and recreate the search index, then repopulate it from `quotes`."""
+    global _index_ready
+    with db.engine.begin() as connection:
+        for suffix in ('ai', 'ad', 'au'):
+            connection.execute(text(f'DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}'))
+        connection.execute(text(f'DROP TABLE IF EXISTS {FTS_TABLE}'))
+        create_search_index(connection)
+        connection.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+        count = connection.execute(text('SELECT count(*) FROM quotes')).scalar()
+    _index_ready = True
+    return count
+
+
+def search_index_ready():
+    """Check (once per process) whether the FTS table exists in this database."""
+    global _index_ready
+    if not _index_ready:
+        result = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': FTS_TABLE},
+        ).first()
+        _index_ready = result is not None
+    return _index_ready
+
+
+def _quote_term(term):
+    """Quote a user-supplied term as an FTS5 string literal."""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def build_match_expression(filters):
+    """Build an FTS5 MATCH expression from a {column: term} dict.
+
+    Returns None if no term is long enough to be answered by the index.
+    """
+    clauses = []
+    for col, term in filters.items():
+        term = (term or '').strip()
+        if len(term) >= MIN_TRIGRAM_LENGTH:
+            clauses.append(f'{col} : {_quote_term(term)}')
+    return ' AND '.join(clauses) or None
+
+
+def apply_text_filters(query, filters):
+    """Filter a Quote query by substring on each {column: term} pair.
+
+    Terms of three or more characters are answered by the FTS index. Shorter
+    terms, or any term when the index hasn't been built, fall back to LIKE.
+    """
+    filters = {col: term for col, term in filters.items() if term}
+    if not filters:
+        return query
+
+    if search_index_ready():
+        indexed = {col: term for col, term in filters.items()
+                   if len(term.strip()) >= MIN_TRIGRAM_LENGTH}
+        match = build_match_expression(indexed)
+        if match:
+            matching_ids = text(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match'
+            ).bindparams(match=match).columns(column('rowid'))
+            query = query.filter(Quote.id.in_(matching_ids))
+        filters = {col: term for col, term in filters.items() if col not in indexed}
+
+    for col, term in filters.items():
+        query = query.filter(getattr(Quote, col).contains(term))
+    return query
+
+
+def search_quotes(term, limit=20):
+    """Ranked search across all indexed columns.
+
+    Returns a list of row mappings ordered best match first (bm25 rank).
+    """
+    term = (term or '').strip()
+    if not term:
+        return []
+
+    if len(term) < MIN_TRIGRAM_LENGTH or not search_index_ready():
+        # Too short for the index: prefix match on the identifier columns
+        rows = db.session.query(Quote.id, Quote.invoice_number, Quote.date,
+                                Quote.to_name, Quote.vehicle, Quote.stock_number) \
+            .filter(db.or_(Quote.invoice_number.startswith(term),
+                           Quote.stock_number.startswith(term))) \
+            .order_by(Quote.date.desc(), Quote.id.desc()) \
+            .limit(limit).all()
+        return [dict(row._mapping, rank=None) for row in rows]
+
+    rows = db.session.execute(text(
+        f"""SELECT q.id, q.invoice_number, q.date, q.to_name, q.vehicle, q.stock_number,
+                   bm25({FTS_TABLE}) AS rank
+            FROM {FTS_TABLE}
+            JOIN quotes q ON q.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH :match
+            ORDER BY rank
+            LIMIT :limit"""
+    ), {'match': _quote_term(term), 'limit': limit}).mappings().all()
+    return [dict(row) for row in rows]
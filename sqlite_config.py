@@ -0,0 +1,67 @@
+"""SQLite production settings: WAL mode, per-connection pragmas and pooling.
+
+With the default rollback journal a writer blocks every reader while it
+commits, which shows up as "database is locked" under several gunicorn
+workers. In WAL mode readers never block writers (and vice versa), and
+`busy_timeout` makes competing writers wait for each other instead of
+failing. All settings can be overridden with environment variables.
+"""
+import os
+import sqlite3
+from sqlalchemy import event
+
+# Pragmas applied to every new SQLite connection
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    # Negative cache_size is in KiB: 20 MiB page cache per connection
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -20000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'temp_store': os.environ.get('SQLITE_TEMP_STORE', 'MEMORY'),
+    'foreign_keys': os.environ.get('SQLITE_FOREIGN_KEYS', 'ON'),
+}
+
+# Connection pool per worker process
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 5))
+SQLITE_MAX_OVERFLOW = int(os.environ.get('SQLITE_MAX_OVERFLOW', 10))
+SQLITE_POOL_TIMEOUT = int(os.environ.get('SQLITE_POOL_TIMEOUT', 30))
+
+
+def is_file_sqlite(uri):
+    """True for a file-backed SQLite URI (in-memory databases can't be pooled)."""
+    return uri.startswith('sqlite') and ':memory:' not in uri and uri not in ('sqlite://', 'sqlite:///')
+
+
+def sqlite_engine_options(uri):
+    """SQLAlchemy engine options for the given database URI."""
+    if not is_file_sqlite(uri):
+        return {}
+    return {
+        'pool_size': SQLITE_POOL_SIZE,
+        'max_overflow': SQLITE_MAX_OVERFLOW,
+        'pool_timeout': SQLITE_POOL_TIMEOUT,
+        'connect_args': {
+            # The driver's own lock wait, matching busy_timeout
+            'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000,
+        },
+    }
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record=None):
+    """Apply SQLITE_PRAGMAS to a freshly opened sqlite3 connection."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
+
+
+def init_sqlite(app, db):
+    """Attach the pragma hook to the app's engine. Call after db.init_app."""
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', apply_sqlite_pragmas)
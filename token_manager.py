@@ -1,11 +1,167 @@
 import json
 import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing, contextmanager
 from datetime import datetime, timedelta
 
-TOKEN_FILE = 'xero_tokens.json'
+import xero_client
+
+try:
+    import fcntl
+except ImportError:  # Windows: refreshes are only single-flight within a process
+    fcntl = None
+
+TOKEN_FILE = os.environ.get('XERO_TOKEN_FILE', 'xero_tokens.json')
+
+# Token storage backend: 'json' (TOKEN_FILE) or 'sqlite' (TOKEN_DB)
+TOKEN_BACKEND = os.environ.get('XERO_TOKEN_BACKEND', 'json')
+TOKEN_DB = os.environ.get('XERO_TOKEN_DB', 'xero_tokens.db')
+
+# Seconds between checks for tokens written by other worker processes
+TOKEN_CHECK_INTERVAL = float(os.environ.get('XERO_TOKEN_CHECK_INTERVAL', 5))
+
+# Lock file that makes token refreshes single-flight across processes
+TOKEN_LOCK_FILE = os.environ.get('XERO_TOKEN_LOCK_FILE', 'xero_tokens.lock')
+
+# The background refresher renews tokens this many seconds before expiry
+TOKEN_REFRESH_AHEAD = int(os.environ.get('XERO_TOKEN_REFRESH_AHEAD', 600))
+
+class JsonFileBackend:
+    """Stores tokens in a JSON file. The file's mtime is its version."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def version(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write(self, data):
+        # Write a temp file and rename it over the old one so readers never
+        # see a half-written file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.xero_tokens.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class SqliteBackend:
+    """Stores tokens in a single-row SQLite table with a version counter."""
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS xero_tokens (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                data TEXT,
+                version INTEGER NOT NULL DEFAULT 0
+            )""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def version(self):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT version FROM xero_tokens WHERE id = 1').fetchone()
+        return row[0] if row else None
+
+    def read(self):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT data FROM xero_tokens WHERE id = 1').fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def write(self, data):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""INSERT INTO xero_tokens (id, data, version) VALUES (1, ?, 1)
+                ON CONFLICT(id) DO UPDATE SET data = excluded.data, version = version + 1""",
+                (json.dumps(data),))
+
+    def clear(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM xero_tokens')
+
+class TokenStore:
+    """In-memory token cache in front of a storage backend.
+
+    Reads are served from memory. The backend is only consulted when the
+    cached copy is older than `check_interval` seconds, and even then it
+    is only re-read if its version changed (another worker saved tokens).
+    """
+
+    def __init__(self, backend, check_interval=TOKEN_CHECK_INTERVAL):
+        self.backend = backend
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._version = None
+        self._checked_at = None
+
+    def get(self, force=False):
+        """Return the current tokens (or None), reloading if another worker changed them."""
+        now = time.monotonic()
+        if not force and self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return self._tokens
+
+        with self._lock:
+            version = self.backend.version()
+            if force or self._checked_at is None or version != self._version:
+                self._tokens = self.backend.read() if version is not None else None
+                self._version = version
+            self._checked_at = now
+            return self._tokens
+
+    def set(self, data):
+        with self._lock:
+            self.backend.write(data)
+            self._tokens = data
+            self._version = self.backend.version()
+            self._checked_at = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self.backend.clear()
+            self._tokens = None
+            self._version = None
+            self._checked_at = time.monotonic()
+
+def create_backend(name=TOKEN_BACKEND):
+    """Create the token storage backend by name."""
+    if name == 'sqlite':
+        return SqliteBackend(TOKEN_DB)
+    return JsonFileBackend(TOKEN_FILE)
+
+token_store = TokenStore(create_backend())
+
+def set_token_backend(backend):
+    """Swap the storage backend (e.g. for a SqliteBackend or a custom store)."""
+    global token_store
+    token_store = TokenStore(backend)
 
 def save_tokens(access_token, refresh_token, expires_in, tenant_id=None):
-    """Save tokens to JSON file with expiry timestamp."""
+    """Save tokens with expiry timestamp."""
     expires_at = (datetime.now() + timedelta(seconds=expires_in)).timestamp()
     data = {
         'access_token': access_token,
@@ -13,25 +169,27 @@ def save_tokens(access_token, refresh_token, expires_in, tenant_id=None):
         'expires_at': expires_at,
         'tenant_id': tenant_id or os.environ.get('XERO_TENANT_ID')
     }
-    with open(TOKEN_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+    token_store.set(data)
 
 def load_tokens():
-    """Load tokens from JSON file. Returns None if file doesn't exist."""
-    if not os.path.exists(TOKEN_FILE):
-        return None
-    with open(TOKEN_FILE, 'r') as f:
-        return json.load(f)
+    """Load tokens from the in-memory store. Returns None if there are none."""
+    return token_store.get()
 
-def is_token_valid():
-    """Check if access token exists and hasn't expired."""
-    tokens = load_tokens()
+def _expires_within(tokens, seconds):
+    """Check if the access token expires within the given number of seconds."""
+    return datetime.now().timestamp() >= (tokens.get('expires_at', 0) - seconds)
+
+def _tokens_valid(tokens):
+    """Check if tokens exist and the access token hasn't expired."""
     if not tokens:
         return False
 
     # Check if expired (with 5-minute buffer)
-    expires_at = tokens.get('expires_at', 0)
-    return datetime.now().timestamp() < (expires_at - 300)
+    return not _expires_within(tokens, 300)
+
+def is_token_valid():
+    """Check if access token exists and hasn't expired."""
+    return _tokens_valid(load_tokens())
 
 def get_access_token():
     """Get current access token, refresh if needed."""
@@ -40,58 +198,104 @@ def get_access_token():
         return None
 
     # If token is still valid, return it
-    if is_token_valid():
+    if _tokens_valid(tokens):
         return tokens['access_token']
 
     # Token expired, refresh it
     return refresh_access_token()
 
-def refresh_access_token():
-    """Refresh the access token using refresh token."""
-    import requests
-    import base64
+_refresh_thread_lock = threading.Lock()
 
-    tokens = load_tokens()
-    if not tokens or not tokens.get('refresh_token'):
-        return None
+@contextmanager
+def _refresh_lock():
+    """Hold the refresh lock across threads (mutex) and processes (flock)."""
+    with _refresh_thread_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(TOKEN_LOCK_FILE, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
-    # Token refresh endpoint
-    XERO_TOKEN_URL = 'https://identity.xero.com/connect/token'
-    XERO_CLIENT_ID = os.environ.get('XERO_CLIENT_ID')
-    XERO_CLIENT_SECRET = os.environ.get('XERO_CLIENT_SECRET')
+def refresh_access_token(refresh_ahead=300):
+    """Refresh the access token using refresh token.
 
-    credentials = f"{XERO_CLIENT_ID}:{XERO_CLIENT_SECRET}"
-    auth_header = f"Basic {base64.b64encode(credentials.encode()).decode()}"
+    Only one refresh runs at a time across all threads and worker
+    processes. Callers that waited on the lock re-read the stored tokens
+    and reuse them if another caller already refreshed, so a rotated
+    refresh token is never spent twice.
+    """
+    with _refresh_lock():
+        # Re-read from the backend: another worker may have rotated the refresh token
+        tokens = token_store.get(force=True)
+        if not tokens or not tokens.get('refresh_token'):
+            return None
+        if not _expires_within(tokens, refresh_ahead):
+            return tokens['access_token']
 
-    data = {
-        'grant_type': 'refresh_token',
-        'refresh_token': tokens['refresh_token']
-    }
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': tokens['refresh_token']
+        }
 
-    headers = {
-        'Authorization': auth_header,
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
+        try:
+            response = xero_client.token_request(data)
+            response.raise_for_status()
+            token_response = response.json()
 
-    try:
-        response = requests.post(XERO_TOKEN_URL, data=data, headers=headers)
-        response.raise_for_status()
-        token_response = response.json()
-
-        # Save new tokens
-        save_tokens(
-            token_response['access_token'],
-            token_response['refresh_token'],
-            token_response['expires_in'],
-            tokens.get('tenant_id')
-        )
-
-        return token_response['access_token']
-    except Exception as e:
-        print(f"Token refresh failed: {e}")
-        return None
+            # Save new tokens
+            save_tokens(
+                token_response['access_token'],
+                token_response['refresh_token'],
+                token_response['expires_in'],
+                tokens.get('tenant_id')
+            )
+
+            return token_response['access_token']
+        except Exception as e:
+            print(f"Token refresh failed: {e}")
+            return None
+
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+
+def _background_refresh_loop():
+    """Renew the access token shortly before it expires."""
+    while True:
+        tokens = load_tokens()
+        if not tokens or not tokens.get('refresh_token'):
+            time.sleep(60)
+            continue
+
+        seconds_left = tokens.get('expires_at', 0) - TOKEN_REFRESH_AHEAD - datetime.now().timestamp()
+        if seconds_left > 0:
+            # Wake up at least once a minute to notice tokens saved elsewhere
+            time.sleep(min(seconds_left, 60))
+            continue
+
+        if refresh_access_token(refresh_ahead=TOKEN_REFRESH_AHEAD) is None:
+            time.sleep(60)
+
+def start_background_refresher():
+    """Start the proactive refresh thread once per process.
+
+    Cheap to call on every request: after the first call in a process it
+    only compares pids.
+    """
+    global _refresher_pid
+    # Compare pids so a forked worker starts its own thread
+    if _refresher_pid == os.getpid():
+        return
+    with _refresher_lock:
+        if _refresher_pid == os.getpid():
+            return
+        _refresher_pid = os.getpid()
+        thread = threading.Thread(target=_background_refresh_loop, name='xero-token-refresher', daemon=True)
+        thread.start()
 
 def clear_tokens():
-    """Delete token file."""
-    if os.path.exists(TOKEN_FILE):
-        os.remove(TOKEN_FILE)
+    """Delete stored tokens."""
+    token_store.clear()
@@ -0,0 +1,191 @@
+"""Shared HTTP client for all Xero calls.
+
+Every Xero request goes through one pooled, keep-alive `requests.Session`
+per process, so TCP and TLS connections are reused between calls. Each call
+gets connect/read timeouts, retries with exponential backoff, and handling
+of Xero's rate limits (429 + Retry-After and the X-*Limit-Remaining headers).
+"""
+import base64
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Endpoints (overridable to point at a local stub server)
+XERO_AUTH_URL = os.environ.get('XERO_AUTH_URL', 'https://login.xero.com/identity/connect/authorize')
+XERO_TOKEN_URL = os.environ.get('XERO_TOKEN_URL', 'https://identity.xero.com/connect/token')
+XERO_API_BASE = os.environ.get('XERO_API_BASE', 'https://api.xero.com/api.xro/2.0')
+
+# Timeouts in seconds
+XERO_CONNECT_TIMEOUT = float(os.environ.get('XERO_CONNECT_TIMEOUT', 3.05))
+XERO_READ_TIMEOUT = float(os.environ.get('XERO_READ_TIMEOUT', 30))
+
+# Retries
+XERO_MAX_RETRIES = int(os.environ.get('XERO_MAX_RETRIES', 3))
+XERO_BACKOFF_FACTOR = float(os.environ.get('XERO_BACKOFF_FACTOR', 0.5))
+# Longest Retry-After we will wait inside a call; longer waits fail fast
+XERO_MAX_RETRY_AFTER = float(os.environ.get('XERO_MAX_RETRY_AFTER', 30))
+
+# Connection pool
+XERO_POOL_SIZE = int(os.environ.get('XERO_POOL_SIZE', 10))
+
+RETRY_STATUSES = {500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+# Latest rate-limit headers seen by this process
+rate_limits = {
+    'minute_remaining': None,
+    'day_remaining': None,
+    'app_minute_remaining': None,
+    'updated_at': None,
+}
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def _operation(request):
+    """Metric label for a Xero call: 'token' or the method and API resource."""
+    if request.url.startswith(XERO_TOKEN_URL):
+        return 'token'
+    path = request.url[len(XERO_API_BASE):] if request.url.startswith(XERO_API_BASE) else ''
+    resource = path.split('?')[0].strip('/').split('/')[0] or 'other'
+    return f'{request.method} {resource}'
+
+
+def get_session():
+    """Return this process's pooled session, creating it on first use."""
+    global _session, _session_pid
+    # Compare pids so forked workers don't share sockets with their parent
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=XERO_POOL_SIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                metrics.instrument_session(session, 'xero', _operation)
+                _session = session
+                _session_pid = os.getpid()
+    return _session
+
+
+def _record_rate_limits(response):
+    """Remember the rate-limit headers from a Xero response."""
+    headers = response.headers
+    for key, header in (('minute_remaining', 'X-MinLimit-Remaining'),
+                        ('day_remaining', 'X-DayLimit-Remaining'),
+                        ('app_minute_remaining', 'X-AppMinLimit-Remaining')):
+        if header in headers:
+            try:
+                rate_limits[key] = int(headers[header])
+            except ValueError:
+                pass
+    rate_limits['updated_at'] = time.monotonic()
+
+
+def _wait_for_minute_limit():
+    """Pause before a call if the last response said the minute limit is spent."""
+    updated_at = rate_limits['updated_at']
+    if updated_at is None:
+        return
+    exhausted = rate_limits['minute_remaining'] == 0 or rate_limits['app_minute_remaining'] == 0
+    wait = 60 - (time.monotonic() - updated_at)
+    if exhausted and wait > 0:
+        logger.warning('Xero minute rate limit reached, waiting %.1fs', wait)
+        time.sleep(min(wait, XERO_MAX_RETRY_AFTER))
+
+
+def _backoff(attempt):
+    """Exponential backoff with jitter for the given retry attempt (0-based)."""
+    return XERO_BACKOFF_FACTOR * (2 ** attempt) * (0.5 + random.random())
+
+
+def request(method, url, timeout=None, max_retries=None, **kwargs):
+    """Send a request to Xero and return the final `requests.Response`.
+
+    Retries 429s (honouring Retry-After unless the day limit is spent),
+    5xx responses and connection failures. Only idempotent methods are
+    retried after the request may have reached Xero, so a POST is never
+    sent twice. Raises `requests.exceptions.RequestException` on network
+    errors once retries are exhausted; HTTP errors are left to the caller's
+    `raise_for_status()`.
+    """
+    method = method.upper()
+    timeout = timeout or (XERO_CONNECT_TIMEOUT, XERO_READ_TIMEOUT)
+    max_retries = XERO_MAX_RETRIES if max_retries is None else max_retries
+    idempotent = method in IDEMPOTENT_METHODS
+    session = get_session()
+
+    attempt = 0
+    while True:
+        _wait_for_minute_limit()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.ConnectTimeout:
+            # The request never reached Xero, so any method is safe to retry
+            if attempt >= max_retries:
+                raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
+            if not idempotent or attempt >= max_retries:
+                raise
+        else:
+            _record_rate_limits(response)
+
+            if response.status_code == 429 and attempt < max_retries:
+                problem = response.headers.get('X-Rate-Limit-Problem', '')
+                retry_after = float(response.headers.get('Retry-After', 1) or 1)
+                if problem.lower() == 'day' or retry_after > XERO_MAX_RETRY_AFTER:
+                    logger.warning('Xero %s rate limit hit, Retry-After %ss; not retrying', problem, retry_after)
+                    return response
+                logger.warning('Xero %s rate limit hit, retrying in %ss', problem or 'minute', retry_after)
+                time.sleep(retry_after)
+                attempt += 1
+                continue
+
+            if response.status_code in RETRY_STATUSES and idempotent and attempt < max_retries:
+                time.sleep(_backoff(attempt))
+                attempt += 1
+                continue
+
+            return response
+
+        time.sleep(_backoff(attempt))
+        attempt += 1
+
+
+def basic_auth_header():
+    """Basic Auth header for the token endpoint."""
+    credentials = f"{os.environ.get('XERO_CLIENT_ID')}:{os.environ.get('XERO_CLIENT_SECRET')}"
+    return f"Basic {base64.b64encode(credentials.encode()).decode()}"
+
+
+def token_request(data):
+    """POST a grant to the Xero token endpoint."""
+    headers = {
+        'Authorization': basic_auth_header(),
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+    return request('POST', XERO_TOKEN_URL, data=data, headers=headers)
+
+
+def api_request(method, path, access_token, tenant_id=None, **kwargs):
+    """Call the Xero Accounting API with bearer and tenant headers."""
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'xero-tenant-id': tenant_id or os.environ.get('XERO_TENANT_ID'),
+        'Accept': 'application/json',
+    }
+    if 'json' in kwargs:
+        headers['Content-Type'] = 'application/json'
+    headers.update(kwargs.pop('headers', {}))
+    return request(method, f'{XERO_API_BASE}/{path.lstrip("/")}', headers=headers, **kwargs)
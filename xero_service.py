@@ -1,9 +1,15 @@
-import requests
+import hashlib
+import json
 import os
+import requests
+from datetime import datetime
 from token_manager import get_access_token
+from sqlalchemy import update
+from models import db, Quote, SERVICE_NAMES
+import xero_client
 
-XERO_API_BASE = 'https://api.xero.com/api.xro/2.0'
-XERO_TENANT_ID = os.environ.get('XERO_TENANT_ID')
+# Quotes per Quotes API call when syncing in bulk
+XERO_BATCH_SIZE = int(os.environ.get('XERO_BATCH_SIZE', 50))
 
 def build_xero_quote_payload(quote):
     """Transform local Quote model to Xero Quote API format."""
@@ -11,24 +17,11 @@ def build_xero_quote_payload(quote):
     # Build line items from services
     line_items = []
 
-    # Service name mapping
-    service_names = {
-        'headlights_resurfacing': 'Headlights Re-surfacing',
-        'headlights_ceramic': 'Headlights Ceramic Coating',
-        'trim_ceramic': 'Trim Ceramic Coating',
-        'car_wizard_diy': 'Car Wizard DIY Kit',
-        'carspa_sealant': 'Car Spa (Sealant)',
-        'carspa_ceramic': 'Car Spa (Plus Ceramic)',
-        'mechanical': 'Mechanical',
-        'glass': 'Glass',
-        'tint': 'Tint',
-        'misc': 'Misc',
-    }
-
     # Add each service as line items (if costs exist)
-    for service_key, service_name in service_names.items():
-        parts_cost = getattr(quote, f'{service_key}_parts_cost', 0) or 0
-        labor_cost = getattr(quote, f'{service_key}_labor_cost', 0) or 0
+    for item in quote.get_line_items():
+        service_name = SERVICE_NAMES.get(item.service, item.service)
+        parts_cost = item.parts_cost or 0
+        labor_cost = item.labor_cost or 0
 
         # Only add if service has costs
         if parts_cost > 0 or labor_cost > 0:
@@ -50,77 +43,212 @@ def build_xero_quote_payload(quote):
 
     # Build Xero quote payload
     payload = {
-        'QuoteNumber': quote.quote_number,
+        'QuoteNumber': quote.invoice_number,
         'Date': quote.date.strftime('%Y-%m-%d') if quote.date else None,
         'ExpiryDate': None,  # Optional: could calculate 30 days from date
         'Contact': {
             'ContactID': '65b6f228-c03a-4059-9272-d78b5f7f5322'
         },
         'LineItems': line_items,
-        'Reference': f'{quote.year} {quote.make} {quote.model}',
-        'Summary': f'Vehicle: {quote.year} {quote.make} {quote.model}\\nVIN: {quote.vin_number}',
-        'Title': f'Body Work Quote - {quote.quote_number}',
+        'Reference': quote.vehicle or '',
+        'Summary': f'Vehicle: {quote.vehicle or ""}\nStock #: {quote.stock_number or ""}',
+        'Title': f'Body Work Quote - {quote.invoice_number}',
         'Notes': quote.instructions if quote.instructions else ''
     }
 
     return payload
 
+def quote_content_hash(payload):
+    """Stable hash of a quote's Xero payload, used to skip unchanged quotes."""
+    data = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
 def send_quote_to_xero(quote):
-    """Send quote to Xero Quotes API."""
+    """Send quote to Xero Quotes API, updating it in place if already there.
 
-    # Get access token (auto-refreshes if needed)
-    access_token = get_access_token()
-    if not access_token:
+    The caller commits. A failed result says whether retrying may help:
+    only network errors, rate limits and Xero server errors are retryable,
+    never a quote Xero rejected.
+    """
+    try:
+        sent, skipped, failed = sync_quotes([quote])
+    except XeroSyncError as e:
         return {
             'success': False,
-            'error': 'Not connected to Xero. Please authorize first.'
+            'error': str(e),
+            'retryable': e.retryable
         }
 
-    # Build payload
-    payload = build_xero_quote_payload(quote)
+    if failed:
+        return {
+            'success': False,
+            'error': failed[0][1],
+            'retryable': False
+        }
 
-    # Make API call
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'xero-tenant-id': XERO_TENANT_ID,
-        'Accept': 'application/json',
-        'Content-Type': 'application/json'
+    return {
+        'success': True,
+        'xero_quote_id': quote.xero_quote_id,
+        'changed': bool(sent),
+        'message': 'Quote successfully sent to Xero!' if sent else 'Quote is already up to date in Xero.'
     }
 
-    try:
-        # POST to Xero Quotes endpoint
-        response = requests.post(
-            f'{XERO_API_BASE}/Quotes',
-            json={'Quotes': [payload]},  # Xero expects array wrapper
-            headers=headers
-        )
-        response.raise_for_status()
+class XeroSyncError(Exception):
+    """A Quotes API call failed as a whole (auth, rate limit, network).
 
-        result = response.json()
+    `retryable` is true for network errors, 429 and 5xx responses.
+    """
 
-        return {
-            'success': True,
-            'data': result,
-            'xero_quote_id': result.get('Quotes', [{}])[0].get('QuoteID'),
-            'message': 'Quote successfully sent to Xero!'
-        }
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
 
-    except requests.exceptions.HTTPError as e:
-        error_message = str(e)
-        if e.response is not None:
-            try:
-                error_data = e.response.json()
-                error_message = error_data.get('Message', str(e))
-            except:
-                error_message = e.response.text
+def _response_error(response):
+    """Best error message from a failed Xero response."""
+    try:
+        return response.json().get('Message') or response.text
+    except ValueError:
+        return response.text or f'HTTP {response.status_code}'
+
+def _item_error(item):
+    """Validation error text for one quote in a Xero batch response, or None."""
+    errors = item.get('ValidationErrors') or []
+    if item.get('HasErrors') or item.get('StatusAttributeString') == 'ERROR' or errors:
+        return '; '.join(e.get('Message', '') for e in errors) or 'Rejected by Xero'
+    return None
+
+def send_quotes_to_xero(quotes, access_token=None):
+    """Send one batch of quotes to Xero in a single Quotes API call.
+
+    Quotes already in Xero are sent with their QuoteID so Xero updates them
+    instead of creating duplicates. Uses summarizeErrors=false so Xero
+    reports validation errors per quote instead of rejecting the whole
+    batch. Successful quotes get their QuoteID, content hash and sync time
+    stored and are marked clean; the caller commits.
+
+    Returns (sent, failed) where failed is a list of (quote, error).
+    Raises XeroSyncError if the call as a whole fails.
+    """
+    if not quotes:
+        return [], []
+
+    access_token = access_token or get_access_token()
+    if not access_token:
+        raise XeroSyncError('Not connected to Xero. Please authorize first.')
 
-        return {
-            'success': False,
-            'error': error_message
-        }
+    hashes = []
+    payloads = []
+    for quote in quotes:
+        payload = build_xero_quote_payload(quote)
+        hashes.append(quote_content_hash(payload))
+        if quote.xero_quote_id:
+            payload['QuoteID'] = quote.xero_quote_id
+        payloads.append(payload)
 
-    except Exception as e:
-        return {
-            'success': False,
-            'error': f'Unexpected error: {str(e)}'
-        }
+    try:
+        response = xero_client.api_request(
+            'POST', 'Quotes', access_token,
+            params={'summarizeErrors': 'false'},
+            json={'Quotes': payloads}
+        )
+    except requests.exceptions.RequestException as e:
+        raise XeroSyncError(f'Unexpected error: {str(e)}', retryable=True)
+
+    if not response.ok:
+        raise XeroSyncError(_response_error(response),
+                            retryable=response.status_code == 429 or response.status_code >= 500)
+
+    returned = response.json().get('Quotes', [])
+    by_number = {item.get('QuoteNumber'): item for item in returned}
+
+    sent, failed = [], []
+    now = datetime.utcnow()
+    for i, quote in enumerate(quotes):
+        # Xero answers in request order; fall back to matching on QuoteNumber
+        item = returned[i] if i < len(returned) else by_number.get(quote.invoice_number)
+        if item is None:
+            failed.append((quote, 'Missing from Xero response'))
+            continue
+        error = _item_error(item)
+        if error or not item.get('QuoteID'):
+            failed.append((quote, error or 'No QuoteID returned'))
+            continue
+        quote.xero_quote_id = item['QuoteID']
+        quote.xero_synced_at = now
+        quote.xero_content_hash = hashes[i]
+        sent.append(quote)
+    _mark_clean(sent)
+    return sent, failed
+
+def _mark_clean(quotes):
+    """Clear the dirty flag on synced quotes that weren't edited meanwhile.
+
+    The updated_at guard keeps a quote dirty if another request changed it
+    while its old content was on the way to Xero.
+    """
+    for quote in quotes:
+        db.session.execute(
+            update(Quote)
+            .where(Quote.id == quote.id, Quote.updated_at == quote.updated_at)
+            .values(xero_dirty=False, version=Quote.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+
+def sync_quotes(quotes, access_token=None):
+    """Bring quotes up to date in Xero with at most one Quotes API call.
+
+    Quotes already in Xero whose payload hash matches the last one sent are
+    skipped without a network call. The caller commits.
+
+    Returns (sent, skipped, failed) where failed is a list of (quote, error).
+    Raises XeroSyncError if the call as a whole fails.
+    """
+    changed, skipped = [], []
+    for quote in quotes:
+        if quote.xero_quote_id and quote.xero_content_hash == quote_content_hash(build_xero_quote_payload(quote)):
+            skipped.append(quote)
+        else:
+            changed.append(quote)
+    _mark_clean(skipped)
+    sent, failed = send_quotes_to_xero(changed, access_token)
+    return sent, skipped, failed
+
+def sync_changed_quotes(batch_size=XERO_BATCH_SIZE, limit=None):
+    """Push every new or changed quote to Xero, one batch per API call.
+
+    Only quotes flagged dirty since their last sync are read. Quotes are
+    walked in id order and committed batch by batch, so a large backlog
+    never sits in memory and progress survives an interruption. Stops at
+    the first batch that fails as a whole, since the next batch would fail
+    the same way. Returns a summary dict with counts, per-quote errors and
+    any batch-level error, with `retryable` saying whether that error may
+    go away on a retry (see XeroSyncError).
+    """
+    summary = {'sent': 0, 'skipped': 0, 'failed': [], 'batches': 0, 'error': None, 'retryable': False}
+    last_id = 0
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        batch = Quote.query.filter(Quote.xero_dirty.is_(True), Quote.id > last_id) \
+            .order_by(Quote.id).limit(size).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        try:
+            sent, skipped, failed = sync_quotes(batch)
+        except XeroSyncError as e:
+            db.session.rollback()
+            summary['error'] = str(e)
+            summary['retryable'] = e.retryable
+            break
+        db.session.commit()
+
+        if sent or failed:
+            summary['batches'] += 1
+        summary['sent'] += len(sent)
+        summary['skipped'] += len(skipped)
+        summary['failed'].extend((quote.id, quote.invoice_number, error) for quote, error in failed)
+        if remaining is not None:
+            remaining -= len(batch)
+    return summary